@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import threading
+from collections import Counter, OrderedDict
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+
+from UserDetail import ranking, sharding
+from UserDetail.trending import trending_posts
+
+logger = logging.getLogger(__name__)
+
+# Likes and shares are a state per (user, post), comments accumulate
+TOGGLED_ACTIONS = ('L', 'S')
+
+_local = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'FACEBOOK_POST_ACTION_BUFFER', False)
+
+
+def coalesce(operations):
+    """
+    Reduce queued operations to the likes and shares to set or clear, and the comments to add.
+
+    Only the last operation on a (user, post, action type) counts, so a
+    like followed by an unlike, or the same like sent twice, collapse.
+    """
+    final = OrderedDict()
+    comments = []
+    for kind, user_id, post_id, action_type, text in operations:
+        if action_type in TOGGLED_ACTIONS:
+            final[(user_id, post_id, action_type)] = kind
+        elif kind == 'add':
+            comments.append((user_id, post_id, action_type, text))
+        else:
+            final[(user_id, post_id, action_type)] = kind
+            comments = [comment for comment in comments if comment[:3] != (user_id, post_id, action_type)]
+    added = [key for key, kind in final.items() if kind == 'add']
+    removed = [key for key, kind in final.items() if kind == 'remove']
+    return added, removed, comments
+
+
+def collect_delete(action):
+    """ Count a deleted action into the bulk write running on this thread, False outside one """
+    deleted = getattr(_local, 'deleted', None)
+    if deleted is None:
+        return False
+    deleted[action.post_id, action.action_type] += 1
+    return True
+
+
+def write(operations):
+    """ Apply queued operations, shard by shard, returns (created, deleted) """
+    created = deleted = 0
+    for using, shard_operations in sharding.group_by_shard(
+            operations, lambda operation: sharding.shard_for_post(operation[2])).items():
+        shard_created, shard_deleted = write_shard(shard_operations, using)
+        created += shard_created
+        deleted += shard_deleted
+    # bulk_create sends no post_save for the affinity signal
+    ranking.invalidate_affinity(*set(operation[1] for operation in operations))
+    return created, deleted
+
+
+def write_shard(operations, using):
+    """ Apply operations with one bulk insert, one delete and one counter update per post """
+    from UserDetail.models import ACTION_COUNTERS, FacebookPost, PostAction, chunked
+
+    added, removed, comments = coalesce(operations)
+    posts = set(key[1] for key in added + removed)
+    posts.update(comment[1] for comment in comments)
+    # Posts deleted since their actions were queued
+    live = set()
+    for chunk in chunked(sorted(posts), 900):
+        live.update(FacebookPost.objects.using(using).filter(pk__in=chunk).values_list('pk', flat=True))
+    # Users deleted since, they live on the default database
+    users = set(key[0] for key in added)
+    users.update(comment[0] for comment in comments)
+    live_users = set()
+    for chunk in chunked(sorted(users), 900):
+        live_users.update(User.objects.filter(pk__in=chunk).values_list('pk', flat=True))
+
+    existing = {}
+    for chunk in chunked([key for key in added + removed if key[1] in live], 250):
+        rows = PostAction.objects.using(using).filter(reduce(or_, [
+            Q(user_id=user_id, post_id=post_id, action_type=action_type)
+            for user_id, post_id, action_type in chunk
+        ])).values_list('pk', 'user_id', 'post_id', 'action_type')
+        for pk, user_id, post_id, action_type in rows:
+            existing.setdefault((user_id, post_id, action_type), []).append(pk)
+
+    create = [PostAction(user_id=user_id, post_id=post_id, action_type=action_type)
+              for user_id, post_id, action_type in added
+              if post_id in live and user_id in live_users and (user_id, post_id, action_type) not in existing]
+    create.extend(PostAction(user_id=user_id, post_id=post_id, action_type=action_type, comments=text)
+                  for user_id, post_id, action_type, text in comments if post_id in live and user_id in live_users)
+    delete = []
+    for key in removed:
+        delete.extend(existing.get(key, []))
+
+    with transaction.atomic(using=using):
+        PostAction.objects.using(using).bulk_create(create)
+        # The post_delete counter signal counts the deleted rows into deltas
+        # instead of updating their posts one row at a time
+        deltas = _local.deleted = Counter()
+        try:
+            for chunk in chunked(delete, 900):
+                PostAction.objects.using(using).filter(pk__in=chunk).delete()
+        finally:
+            _local.deleted = None
+        for key in deltas:
+            deltas[key] = -deltas[key]
+        for action in create:
+            deltas[action.post_id, action.action_type] += 1
+
+        per_post = {}
+        for (post_id, action_type), delta in deltas.items():
+            field = ACTION_COUNTERS.get(action_type)
+            if field and delta:
+                value = F(field) + delta
+                if delta < 0:
+                    value = Greatest(value, Value(0))
+                per_post.setdefault(post_id, {})[field] = value
+        for post_id, counters in per_post.items():
+            FacebookPost.objects.using(using).filter(pk=post_id).update(**counters)
+    # bulk_create sends no post_save
+    for action in create:
+        trending_posts.record(action.post_id, action.action_type)
+    return len(create), len(delete)
+
+
+class PostActionBuffer(object):
+    """
+    Per-process queue of PostAction writes, flushed in bulk.
+
+    A flush happens once FACEBOOK_POST_ACTION_BUFFER_SIZE operations are
+    queued, FACEBOOK_POST_ACTION_BUFFER_DELAY seconds after the first one,
+    and at interpreter exit. With FACEBOOK_POST_ACTION_BUFFER_SYNC there is no
+    timer, tests flush explicitly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.operations = []
+        self.timer = None
+
+    def add(self, user_id, post_id, action_type, comments=None):
+        self.queue(('add', user_id, post_id, action_type, comments))
+
+    def remove(self, user_id, post_id, action_type):
+        self.queue(('remove', user_id, post_id, action_type, None))
+
+    def queue(self, operation):
+        with self.lock:
+            self.operations.append(operation)
+            size = len(self.operations)
+            if self.timer is None and not getattr(settings, 'FACEBOOK_POST_ACTION_BUFFER_SYNC', False):
+                self.timer = threading.Timer(getattr(settings, 'FACEBOOK_POST_ACTION_BUFFER_DELAY', 1.0),
+                                             self.flush_in_thread)
+                self.timer.daemon = True
+                self.timer.start()
+        if size >= getattr(settings, 'FACEBOOK_POST_ACTION_BUFFER_SIZE', 500):
+            self.flush()
+
+    def pending(self):
+        with self.lock:
+            return len(self.operations)
+
+    def flush(self):
+        """ Write everything queued so far, returns (created, deleted) """
+        with self.flush_lock:
+            with self.lock:
+                operations, self.operations = self.operations, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not operations:
+                return 0, 0
+            try:
+                return write(operations)
+            except Exception:
+                logger.exception('Dropped %s queued post actions', len(operations))
+                raise
+
+    def flush_in_thread(self):
+        """ Timer callback, the timer thread has its own connections """
+        try:
+            self.flush()
+        except Exception:
+            # Logged by flush, nothing to raise to
+            pass
+        finally:
+            connections.close_all()
+
+
+post_actions = PostActionBuffer()
+atexit.register(post_actions.flush)
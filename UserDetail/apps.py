@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class UserdetailConfig(AppConfig):
     name = 'UserDetail'
+
+    def ready(self):
+        import UserDetail.signals  # noqa
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI application of the project, needs Python 3.5+.
+
+Django 1.11 predates ASGI, this is a small ASGI 3 adapter around it.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest, get_script_name
+from django.core.signals import request_started
+from django.urls import Resolver404, get_resolver, set_script_prefix
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.module_loading import import_string
+
+from UserDetail import async_views
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    """ Threads serving the requests that have no coroutine view """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'FACEBOOK_ASYNC_REQUEST_THREADS', 20))
+    return _executor
+
+
+async def _relay(func, *args):
+    return await func(*args)
+
+
+def call_on_loop(loop, func, *args):
+    """ Await func(*args) on the event loop from another thread """
+    return asyncio.run_coroutine_threadsafe(_relay(func, *args), loop).result()
+
+
+class RequestBody(io.RawIOBase):
+    """
+    wsgi.input reading the ASGI body messages as the view asks for them.
+
+    Read from a request thread, each refill awaits the next message on the
+    event loop, so an upload chunk is never held in memory whole.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer and self.more:
+            message = call_on_loop(self.loop, self.receive)
+            if message['type'] == 'http.disconnect':
+                # The view sees a short body
+                self.more = False
+                break
+            self.buffer.extend(message.get('body', b''))
+            self.more = message.get('more_body', False)
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+
+def response_start(response):
+    """ The http.response.start message of a Django response """
+    headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in response.items()]
+    for cookie in response.cookies.values():
+        headers.append((b'Set-Cookie', cookie.output(header='').strip().encode('latin-1')))
+    return {'type': 'http.response.start', 'status': response.status_code, 'headers': headers}
+
+
+class ASGIHandler(object):
+    """
+    Serve requests with the coroutine views of UserDetail.async_views.
+
+    GET requests with a coroutine version run on the event loop. The hooks
+    of the MIDDLEWARE chain, the request signals and the queries of the view
+    run on the database threads, and no thread is held while the view
+    awaits. Middleware that only has a __call__ cannot be split around an
+    await, with one of those in the chain every request takes the path of
+    the other requests: the regular handler on one of the
+    FACEBOOK_ASYNC_REQUEST_THREADS request threads. Request bodies are read
+    and responses sent as the handler consumes and produces them.
+    """
+
+    def __init__(self):
+        self.handler = WSGIHandler()
+        self.middleware = self.load_middleware()
+
+    def load_middleware(self):
+        """ The MIDDLEWARE the coroutine path runs the hooks of, None when one has no hooks """
+        chain = []
+        for path in settings.MIDDLEWARE:
+            try:
+                middleware = import_string(path)(None)
+            except MiddlewareNotUsed:
+                continue
+            if not hasattr(middleware, 'start') and not isinstance(middleware, MiddlewareMixin):
+                return None
+            chain.append(middleware)
+        return chain
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %s' % scope['type'])
+
+        loop = asyncio.get_event_loop()
+        environ = self.environ(scope, RequestBody(receive, loop))
+        request, coroutine_view = self.coroutine_view(environ)
+        if coroutine_view is None:
+            await loop.run_in_executor(executor(), self.run_wsgi, environ, send, loop)
+        else:
+            await self.run_coroutine(environ, request, coroutine_view, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def environ(self, scope, body):
+        """ WSGI environ of an ASGI HTTP scope """
+        script_name = scope.get('root_path', '')
+        path = scope['path']
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name,
+            # WSGI carries the raw UTF-8 bytes of the path as latin-1
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0] if client else '',
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_%s' % name
+            value = value.decode('latin-1')
+            if key in environ:
+                value = '%s%s%s' % (environ[key], '; ' if key == 'HTTP_COOKIE' else ',', value)
+            environ[key] = value
+        return environ
+
+    def coroutine_view(self, environ):
+        """ (request, coroutine view), the view is None when the request stays synchronous """
+        if self.middleware is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None, None
+        request = WSGIRequest(environ)
+        try:
+            request.resolver_match = get_resolver().resolve(request.path_info)
+        except Resolver404:
+            return None, None
+        return request, async_views.async_view(request.resolver_match, request)
+
+    def run_wsgi(self, environ, send, loop):
+        """ Run the regular handler on a request thread, sending the response as it is iterated """
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        result = self.handler(environ, start_response)
+        try:
+            call_on_loop(loop, send, {
+                'type': 'http.response.start', 'status': started['status'],
+                'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']],
+            })
+            if environ['REQUEST_METHOD'] != 'HEAD':
+                # Streamed exports go out chunk by chunk
+                for chunk in result:
+                    if chunk:
+                        call_on_loop(loop, send, {'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            call_on_loop(loop, send, {'type': 'http.response.body', 'body': b''})
+        finally:
+            # Sends request_finished
+            result.close()
+
+    async def run_coroutine(self, environ, request, coroutine_view, send):
+        """ Serve a request with its coroutine view, holding no thread while the view awaits """
+        async_views.set_request_state({})
+        response, entered = await async_views.database(self.before_view, environ, request)
+        if response is None:
+            match = request.resolver_match
+            try:
+                response = await coroutine_view(request, *match.args, **match.kwargs)
+            except Exception as exc:
+                response = await async_views.database(response_for_exception, request, exc)
+        response = await async_views.database(self.after_view, request, response, entered)
+        response._handler_class = self.handler.__class__
+        try:
+            if response.streaming:
+                # The chunks of a streamed response come from one cursor, on one thread
+                await asyncio.get_event_loop().run_in_executor(
+                    executor(), self.send_streaming, response, send, asyncio.get_event_loop(),
+                    environ['REQUEST_METHOD'] == 'HEAD')
+            else:
+                await send(response_start(response))
+                await send({'type': 'http.response.body',
+                            'body': b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.content})
+        finally:
+            # Sends request_finished
+            await async_views.database(response.close)
+
+    def before_view(self, environ, request):
+        """ request_started and the request and view hooks, (early response, [(middleware, token)]) """
+        set_script_prefix(get_script_name(environ))
+        request_started.send(sender=self.handler.__class__, environ=environ)
+        entered = []
+        try:
+            for middleware in self.middleware:
+                if hasattr(middleware, 'start'):
+                    entered.append((middleware, middleware.start(request)))
+                    continue
+                entered.append((middleware, None))
+                response = middleware.process_request(request) if hasattr(middleware, 'process_request') else None
+                if response is not None:
+                    return response, entered
+            match = request.resolver_match
+            for middleware in self.middleware:
+                if hasattr(middleware, 'process_view'):
+                    response = middleware.process_view(request, match.func, match.args, match.kwargs)
+                    if response is not None:
+                        return response, entered
+        except Exception as exc:
+            return response_for_exception(request, exc), entered
+        return None, entered
+
+    def after_view(self, request, response, entered):
+        """ The response hooks of the middleware entered by before_view, innermost first """
+        for middleware, token in reversed(entered):
+            try:
+                if hasattr(middleware, 'finish'):
+                    response = middleware.finish(request, response, token)
+                elif hasattr(middleware, 'process_response'):
+                    response = middleware.process_response(request, response)
+            except Exception as exc:
+                response = response_for_exception(request, exc)
+        return response
+
+    def send_streaming(self, response, send, loop, head):
+        call_on_loop(loop, send, response_start(response))
+        if not head:
+            for chunk in response:
+                if chunk:
+                    call_on_loop(loop, send, {'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        call_on_loop(loop, send, {'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Coroutine versions of the read-heavy views, served by facebook/asgi.py.
+
+Django 1.11 has no async ORM. The coroutines await their queries on a
+bounded pool of database threads, so a slow query holds one of those
+threads instead of a whole worker. This module needs Python 3.5+.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.views import APIView
+
+from UserDetail import instrumentation, routers, views
+from UserDetail.models import FacebookPost, Follow, Friend
+from UserDetail.pagination import KeysetPagination, paginated_response
+from UserDetail.serializers import FacebookPostSerializer, FollowSerializer, FriendSerializer,\
+    FriendshipRequestSerializer
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6, the state rides on the current task instead
+    contextvars = None
+
+_executor = None
+_executor_lock = threading.Lock()
+
+if contextvars is not None:
+    _request_state = contextvars.ContextVar('request_state', default=None)
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'FACEBOOK_ASYNC_DB_THREADS', 10))
+    return _executor
+
+
+def _call(state, func, args, kwargs):
+    # What request_started does for a synchronous request
+    close_old_connections()
+    with instrumentation.bound_request_state(state), routers.bound_request_state(state):
+        return func(*args, **kwargs)
+
+
+def current_request_state():
+    """ Thread-local state of the request the running coroutine serves, carried to the database threads """
+    if contextvars is not None:
+        return _request_state.get()
+    return getattr(asyncio.Task.current_task(), 'request_state', None)
+
+
+def set_request_state(state):
+    if contextvars is not None:
+        _request_state.set(state)
+    else:
+        asyncio.Task.current_task().request_state = state
+
+
+async def database(func, *args, **kwargs):
+    """ Run blocking ORM work on a database thread """
+    loop = asyncio.get_event_loop()
+    state = current_request_state()
+    call = functools.partial(_call, {} if state is None else state, func, args, kwargs)
+    return await loop.run_in_executor(executor(), call)
+
+
+async def gather(*calls):
+    """
+    Run (func, arg, ...) database calls concurrently and return their results.
+
+    At most FACEBOOK_ASYNC_QUERY_CONCURRENCY of the calls run at once, so
+    one request cannot take every database thread.
+    """
+    semaphore = asyncio.Semaphore(getattr(settings, 'FACEBOOK_ASYNC_QUERY_CONCURRENCY', 4))
+    state = current_request_state()
+
+    async def limited(call):
+        # Before 3.7 the tasks of gather do not inherit the state
+        set_request_state(state)
+        async with semaphore:
+            return await database(*call)
+    return await asyncio.gather(*[limited(call) for call in calls])
+
+
+class AsyncAPIView(object):
+    """ DRF authentication, content negotiation and error handling around a coroutine view """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def __call__(self, django_request, *args, **kwargs):
+        view = APIView()
+        view.args, view.kwargs = args, kwargs
+        view.headers = view.default_response_headers
+        request = view.initialize_request(django_request, *args, **kwargs)
+        view.request = request
+        try:
+            # Authentication may load the session and the user
+            await database(view.initial, request, *args, **kwargs)
+            response = await self.handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = view.handle_exception(exc)
+        response = view.finalize_response(request, response, *args, **kwargs)
+        return response.render()
+
+
+async def paginated(request, queryset, serializer_class, ordering_field=None):
+    """ paginated_response, with the total count fetched alongside a requested page """
+    if not KeysetPagination.requested(request):
+        return await database(paginated_response, request, queryset, serializer_class, ordering_field)
+    response, total = await gather((paginated_response, request, queryset, serializer_class, ordering_field),
+                                   (queryset.count,))
+    response['X-Total-Count'] = str(total)
+    return response
+
+
+def list_view(queryset_method, serializer_class, ordering_field):
+    async def view(request):
+        return await paginated(request, queryset_method(request.user), serializer_class, ordering_field)
+    return AsyncAPIView(view)
+
+
+async def post_list(request, pk):
+    owner = await database(views.PostList().get_owner, request, pk)
+    posts = await database(FacebookPost.objects.profile_post, owner, request.user)
+    return await paginated(request, posts, FacebookPostSerializer, 'created_time')
+
+
+async def profile(request, pk):
+    return await database(views.UserProfileDetail().get, request, pk)
+
+
+ASYNC_VIEWS = {
+    views.friends_list: list_view(Friend.objects.friends_queryset, FriendSerializer, 'created'),
+    views.friendship_request_sent: list_view(
+        Friend.objects.sent_requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.friendship_request_receive: list_view(
+        Friend.objects.requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.friendship_request_viewed: list_view(
+        Friend.objects.read_requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.friendship_request_rejected: list_view(
+        Friend.objects.rejected_requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.friendship_request_unrejected: list_view(
+        Friend.objects.unrejected_requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.friendship_request_unread: list_view(
+        Friend.objects.unread_requests_queryset, FriendshipRequestSerializer, 'created'),
+    views.following: list_view(Follow.objects.following_queryset, FollowSerializer, 'created'),
+    views.followers: list_view(Follow.objects.followers_queryset, FollowSerializer, 'created'),
+    views.PostList: AsyncAPIView(post_list),
+    views.UserProfileDetail: AsyncAPIView(profile),
+}
+
+
+def async_view(match, request):
+    """ The coroutine view serving a resolved request, None when it stays synchronous """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    # Streamed exports iterate a server-side cursor, which cannot hop threads
+    if request.GET.get('stream') in ('1', 'true'):
+        return None
+    return ASYNC_VIEWS.get(match.func) or ASYNC_VIEWS.get(getattr(match.func, 'cls', None))
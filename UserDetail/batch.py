@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+from django.utils.six.moves.urllib.parse import urlsplit
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Request headers a sub-request inherits from the batch request
+INHERITED_META = ('REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST', 'HTTP_USER_AGENT',
+                  'HTTP_ACCEPT_LANGUAGE', 'wsgi.url_scheme')
+
+
+def sub_request(parent, method, path, body=None, headers=None):
+    """
+    Build the HttpRequest of one sub-request.
+
+    It carries the user already authenticated by the batch request, so the
+    sub-views do not authenticate again nor check CSRF a second time.
+    """
+    url = urlsplit(path)
+    request = HttpRequest()
+    request.method = method
+    request.path = request.path_info = url.path
+    request.GET = QueryDict(url.query)
+    request.META = dict((key, parent.META[key]) for key in INHERITED_META if key in parent.META)
+    request.META.update({'REQUEST_METHOD': method, 'PATH_INFO': url.path, 'QUERY_STRING': url.query})
+    for name, value in (headers or {}).items():
+        request.META['HTTP_%s' % name.upper().replace('-', '_')] = value
+    content = b''
+    if body is not None:
+        content = json.dumps(body).encode('utf-8')
+        request.META['CONTENT_TYPE'] = 'application/json'
+    request.META['CONTENT_LENGTH'] = str(len(content))
+    request._stream = io.BytesIO(content)
+    request._read_started = False
+    request.session = getattr(parent, 'session', None)
+    request.user = parent.user
+    request._force_auth_user = parent.user
+    request._force_auth_token = getattr(parent, 'auth', None)
+    request._dont_enforce_csrf_checks = True
+    return request
+
+
+def response_body(response):
+    """ The payload of a sub-response, decoded from JSON when it is JSON """
+    if isinstance(response, Response):
+        return response.data
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    if not content:
+        return None
+    text = content.decode(response.charset)
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(text)
+    return text
+
+
+def dispatch(parent, spec):
+    """ Resolve and run one sub-request, returns its {id, status, headers, body} """
+    method = spec['method']
+    result = {'id': spec.get('id'), 'method': method, 'path': spec['path']}
+    try:
+        match = resolve(urlsplit(spec['path']).path)
+        if match.url_name == 'batch':
+            raise Resolver404()
+        request = sub_request(parent, method, spec['path'], spec.get('body'), spec.get('headers'))
+        request.resolver_match = match
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        body = response_body(response)
+    except (Http404, Resolver404):
+        response, body = None, {'detail': 'Not found.'}
+        result['status'] = 404
+    except Exception:
+        if settings.DEBUG:
+            raise
+        logger.exception('Batch sub-request %s %s failed', method, spec['path'])
+        response, body = None, {'detail': 'Server error.'}
+        result['status'] = 500
+    if response is not None:
+        result['status'] = response.status_code
+        result['headers'] = dict((name, value) for name, value in response.items()
+                                 if name not in ('Content-Type', 'Content-Length', 'Vary', 'Allow'))
+    result['body'] = body
+    return result
+
+
+def in_thread(parent, spec):
+    """ Concurrent sub-requests run on a pool thread, which has its own connections """
+    try:
+        return dispatch(parent, spec)
+    finally:
+        connections.close_all()
+
+
+def run(parent, specs, parallel=False):
+    """
+    Run the sub-requests in order and return their results in the same order.
+
+    Sub-requests share the authenticated user and the thread's database
+    connection. With parallel, a batch of read-only sub-requests runs on
+    FACEBOOK_BATCH_WORKERS threads instead, each with its own connection.
+    """
+    workers = getattr(settings, 'FACEBOOK_BATCH_WORKERS', 4)
+    if parallel and workers > 1 and len(specs) > 1 and all(spec['method'] in READ_METHODS for spec in specs):
+        with ThreadPoolExecutor(max_workers=min(workers, len(specs))) as pool:
+            return list(pool.map(lambda spec: in_thread(parent, spec), specs))
+    return [dispatch(parent, spec) for spec in specs]
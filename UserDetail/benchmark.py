@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import math
+import platform
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import RegexURLResolver, get_resolver
+from django.utils import timezone
+
+from UserDetail import ranking
+from UserDetail.models import FacebookPost, Friend, FriendshipRequest, MediaUpload, UserProfile
+
+# Views the harness does not drive, with the reason reported for them
+SKIPPED_VIEWS = {
+    'login': 'needs the registration templates',
+    'logout': 'ends the benchmark session',
+}
+
+
+def percentile(samples, fraction):
+    """ Nearest-rank percentile of a list of samples """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+
+
+@contextmanager
+def capture_queries():
+    """ Capture the queries of every configured database """
+    contexts = [CaptureQueriesContext(connection) for connection in connections.all()]
+    for context in contexts:
+        context.__enter__()
+    try:
+        yield contexts
+    finally:
+        for context in reversed(contexts):
+            context.__exit__(None, None, None)
+
+
+def pick_fixture():
+    """ The best connected user and the rows the scenarios point at """
+    viewer = User.objects.annotate(degree=Count('friends')).order_by('-degree', 'pk').first()
+    if viewer is None:
+        raise ValueError('No users, run generate_social_graph first')
+    profile, _ = UserProfile.objects.get_or_create(user=viewer)
+    post = FacebookPost.objects.filter(owner=viewer).first() or FacebookPost.objects.create(
+        owner=viewer, message='Benchmark post', created_time=timezone.now(), post_type='PIC',
+        caption='', description='', story='')
+    located = FacebookPost.objects.filter(geohash__isnull=False).first()
+    request = FriendshipRequest.objects.filter(to_user=viewer).first()
+    other = User.objects.exclude(pk=viewer.pk).exclude(
+        pk__in=Friend.objects.filter(to_user=viewer).values('from_user')).first() or viewer
+    upload = MediaUpload.objects.create(owner=viewer, post=post, field='picture',
+                                        filename='benchmark.png', total_size=1)
+    return {
+        'viewer': viewer,
+        'profile': profile,
+        'post': post,
+        'located': located or post,
+        'request_ids': list(FriendshipRequest.objects.filter(to_user=viewer).values_list('pk', flat=True)[:100]),
+        'request_pk': request.pk if request else 0,
+        'other': other,
+        'upload': upload,
+        'user_ids': list(User.objects.values_list('pk', flat=True)[:1000]),
+    }
+
+
+def scenarios(fixture):
+    """ (method, path, json body) per view name """
+    viewer, post, located = fixture['viewer'], fixture['post'], fixture['located']
+    return {
+        'UserProfileDetail': ('get', '/facebook/%s/' % fixture['profile'].pk, None),
+        'ManageFriendRequest': ('get', '/facebook/manage_friend_request/%s/' % fixture['request_pk'], None),
+        'BulkFriendRequest': ('post', '/facebook/bulk_friend_request/',
+                              {'action': 'mark_viewed', 'ids': fixture['request_ids'] or [0]}),
+        'ManageFriends': ('post', '/facebook/manage_friends/None/',
+                          {'from_user': viewer.pk, 'to_user': fixture['other'].pk}),
+        'ManageFollowRequest': ('post', '/facebook/manage_follow_request/None/',
+                                {'from_user': viewer.pk, 'to_user': fixture['other'].pk}),
+        'PostList': ('get', '/facebook/post_list/None/', None),
+        'MediaUploadList': ('post', '/facebook/uploads/',
+                            {'post': post.pk, 'field': 'picture', 'filename': 'b.png', 'total_size': 10}),
+        'MediaUploadDetail': ('get', '/facebook/uploads/%s/' % fixture['upload'].pk, None),
+        'PostAction': ('get', '/facebook/post_action/%s/' % post.pk, None),
+        'friends_list': ('get', '/facebook/friends_list/', None),
+        'friendship_request_sent': ('get', '/facebook/friendship_request_sent/', None),
+        'friendship_request_receive': ('get', '/facebook/friendship_request_receive/', None),
+        'friendship_request_viewed': ('get', '/facebook/friendship_request_viewed/', None),
+        'friendship_request_rejected': ('get', '/facebook/friendship_request_rejected/', None),
+        'friendship_request_unrejected': ('get', '/facebook/friendship_request_unrejected/', None),
+        'friendship_request_unread': ('get', '/facebook/friendship_request_unread/', None),
+        'following': ('get', '/facebook/following/', None),
+        'followers': ('get', '/facebook/followers/', None),
+        'friend_suggestions': ('get', '/facebook/friend_suggestions/', None),
+        'relationships': ('post', '/facebook/relationships/', {'ids': fixture['user_ids']}),
+        'posts_near': ('get', '/facebook/posts_near/?lat=%s&long=%s&radius=50' % (
+            located.latitude or 0, located.longitude or 0), None),
+        'post_search': ('get', '/facebook/search/?q=post', None),
+        'trending': ('get', '/facebook/trending/', None),
+        'feed': ('get', '/facebook/feed/', None),
+        'batch': ('post', '/facebook/batch/', {'requests': [
+            {'path': '/facebook/friends_list/'}, {'path': '/facebook/friendship_request_unread/'},
+            {'path': '/facebook/followers/'}, {'path': '/facebook/post_list/None/'},
+            {'path': '/facebook/%s/' % fixture['profile'].pk},
+        ]}),
+    }
+
+
+def url_views(resolver=None):
+    """ View names of every URL pattern, leaving out included URLconfs such as the admin """
+    resolver = resolver or get_resolver()
+    names = []
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, RegexURLResolver):
+            continue
+        callback = pattern.callback
+        names.append(getattr(getattr(callback, 'cls', None), '__name__', None) or callback.__name__)
+    return names
+
+
+def measure(client, method, path, body, iterations):
+    """ Latencies, query count and peak traced memory of one scenario """
+    def call():
+        if body is None:
+            return getattr(client, method)(path)
+        return getattr(client, method)(path, json.dumps(body), content_type='application/json')
+
+    def isolated(contexts=None):
+        # Writes are rolled back so every iteration sees the same data
+        with transaction.atomic():
+            if contexts is None:
+                response = call()
+            else:
+                with capture_queries() as captured:
+                    response = call()
+                contexts.extend(captured)
+            if hasattr(response, 'streaming_content'):
+                b''.join(response.streaming_content)
+            transaction.set_rollback(True)
+        return response
+
+    response = isolated()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        isolated()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    contexts = []
+    isolated(contexts)
+    queries = sum(len(context) for context in contexts)
+
+    tracemalloc.start()
+    try:
+        isolated()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'method': method.upper(),
+        'path': path,
+        'status': response.status_code,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'queries': queries,
+        'peak_memory_kb': round(peak / 1024.0, 1),
+    }
+
+
+def run(iterations=20):
+    """ Drive every URL through the test client, returns a JSON serializable report """
+    report = {
+        'meta': {
+            'created': timezone.now().isoformat(),
+            'iterations': iterations,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connections['default'].vendor,
+            'users': User.objects.count(),
+            'posts': FacebookPost.objects.count(),
+            'friendships': Friend.objects.count(),
+        },
+        'endpoints': {},
+    }
+    with override_settings(ALLOWED_HOSTS=['testserver'], FACEBOOK_INSTRUMENTATION=False), transaction.atomic():
+        fixture = pick_fixture()
+        client = Client()
+        client.force_login(fixture['viewer'])
+        specs = scenarios(fixture)
+        for name in url_views():
+            if name in SKIPPED_VIEWS or name not in specs:
+                report['endpoints'][name] = {'skipped': SKIPPED_VIEWS.get(name, 'no benchmark scenario')}
+                continue
+            method, path, body = specs[name]
+            report['endpoints'][name] = measure(client, method, path, body, iterations)
+        # The fixture rows are benchmark scaffolding, leave the database as it was
+        transaction.set_rollback(True)
+    return report
+
+
+def compare(report, baseline):
+    """ Per endpoint p95 ratio and query delta against a previous report """
+    rows = []
+    for name, current in sorted(report['endpoints'].items()):
+        previous = baseline.get('endpoints', {}).get(name)
+        if 'skipped' in current or not previous or 'skipped' in previous:
+            continue
+        rows.append((name, current['p95_ms'] / previous['p95_ms'] if previous['p95_ms'] else None,
+                     current['queries'] - previous['queries']))
+    return rows
+
+
+def ranking_microbenchmark(candidates=500, iterations=200, authors=1000, seed=0):
+    """
+    Time the feed scoring of synthetic candidates, vectorized and one at a time.
+
+    Returns p50 and p95 in milliseconds of both paths and the p50 speedup,
+    the two paths must agree on the ranking.
+    """
+    rng = random.Random(seed)
+    data = {
+        'age': [rng.uniform(0, 7 * 86400) for _ in range(candidates)],
+        'owner': [rng.randrange(authors) for _ in range(candidates)],
+        'engagement': [int(rng.paretovariate(1.5)) for _ in range(candidates)],
+        'post_type': [rng.choice(('PIC', 'VID', 'URL')) for _ in range(candidates)],
+    }
+    known = sorted(rng.sample(range(authors), authors // 10))
+    vector = (known, [rng.random() for _ in known])
+    limit = min(getattr(settings, 'FACEBOOK_PAGE_SIZE', 50), candidates)
+
+    def timed(vectorized):
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            if vectorized:
+                ranked = ranking.top(ranking.scores(data, vector), limit)
+            else:
+                ranked = ranking.top(ranking.python_scores(data, *vector), limit)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples, ranked
+
+    report = {'candidates': candidates, 'iterations': iterations, 'limit': limit}
+    python_samples, python_ranked = timed(False)
+    report['python_p50_ms'] = percentile(python_samples, 0.5)
+    report['python_p95_ms'] = percentile(python_samples, 0.95)
+    if ranking.numpy is None:
+        report['numpy'] = None
+        return report
+    numpy_samples, numpy_ranked = timed(True)
+    report.update({
+        'numpy': ranking.numpy.__version__,
+        'numpy_p50_ms': percentile(numpy_samples, 0.5),
+        'numpy_p95_ms': percentile(numpy_samples, 0.95),
+        'speedup': percentile(python_samples, 0.5) / percentile(numpy_samples, 0.5),
+        'same_ranking': numpy_ranked == python_ranked,
+    })
+    return report
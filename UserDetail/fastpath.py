@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import six
+from rest_framework import fields, relations
+from rest_framework.settings import ISO_8601, api_settings
+
+_compiled = {}
+
+
+def enabled():
+    return getattr(settings, 'FACEBOOK_FAST_SERIALIZATION', False)
+
+
+def datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None:
+        return lambda value: value
+    if output_format.lower() != ISO_8601:
+        return lambda value: value.strftime(output_format)
+
+    def convert(value):
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return convert
+
+
+def file_converter(model_field, field):
+    if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+        return lambda value: value or None
+    url = model_field.storage.url
+    return lambda value: url(value) if value else None
+
+
+def choice_converter(field):
+    choices = field.choice_strings_to_values
+
+    def convert(value):
+        if value == '':
+            return value
+        return choices.get(six.text_type(value), value)
+    return convert
+
+
+def compile_field(model, field):
+    """ Converter from a raw column value to the DRF representation, None if unsupported """
+    if field.source == '*' or '.' in field.source:
+        return None
+    if isinstance(field, relations.PrimaryKeyRelatedField):
+        return lambda value: value
+    if isinstance(field, fields.FileField):
+        return file_converter(model._meta.get_field(field.source), field)
+    if isinstance(field, fields.DateTimeField):
+        return datetime_converter(field)
+    if isinstance(field, fields.ChoiceField):
+        return choice_converter(field)
+    if isinstance(field, fields.BooleanField):
+        return bool
+    if isinstance(field, fields.IntegerField):
+        return int
+    if isinstance(field, fields.FloatField):
+        return float
+    if isinstance(field, fields.CharField):
+        return six.text_type
+    return None
+
+
+def compile_serializer(serializer_class):
+    """
+    Precompile (output name, column, converter) extractors for a serializer.
+
+    Returns None when a field can't be rendered from its raw column value,
+    those serializers keep going through DRF.
+    """
+    if serializer_class not in _compiled:
+        serializer = serializer_class()
+        model = serializer.Meta.model
+        extractors = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            converter = compile_field(model, field)
+            if converter is None:
+                extractors = None
+                break
+            extractors.append((name, field.source, converter))
+        _compiled[serializer_class] = extractors
+    return _compiled[serializer_class]
+
+
+def supports(serializer_class):
+    return compile_serializer(serializer_class) is not None
+
+
+def columns(serializer_class):
+    return [column for _, column, _ in compile_serializer(serializer_class)]
+
+
+def render_rows(rows, serializer_class):
+    """ Render values() rows exactly like serializer_class(many=True).data """
+    extractors = compile_serializer(serializer_class)
+    data = []
+    for row in rows:
+        item = OrderedDict()
+        for name, column, convert in extractors:
+            value = row[column]
+            item[name] = None if value is None else convert(value)
+        data.append(item)
+    return data
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+GEOHASH_PRECISION = 9
+
+
+def parse_coordinate(value, limit):
+    """ Parse a stored coordinate string, None when it is missing or out of range """
+    try:
+        coordinate = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(coordinate) or abs(coordinate) > limit:
+        return None
+    return coordinate
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """ Geohash of a point """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            rng[0] = middle
+        else:
+            rng[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """ (height, width) in degrees of a geohash cell """
+    lon_bits = int(math.ceil(precision * 5 / 2.0))
+    lat_bits = precision * 5 - lon_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def radius_degrees(latitude, radius_km):
+    """ (latitude, longitude) span in degrees of a radius around a point """
+    cos_lat = max(math.cos(math.radians(latitude)), 0.01)
+    return radius_km / KM_PER_DEGREE, radius_km / (KM_PER_DEGREE * cos_lat)
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """
+    Geohash prefixes covering a circle: the cell of the point and its
+    neighbours, at the finest precision whose cells are larger than the radius.
+    """
+    dlat, dlon = radius_degrees(latitude, radius_km)
+    precision = 1
+    for candidate in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(candidate)
+        if height >= dlat and width >= dlon:
+            precision = candidate
+            break
+    height, width = cell_size(precision)
+    cells = set()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            lat = min(max(latitude + dy * height, -90.0), 90.0)
+            lon = (longitude + dx * width + 180.0) % 360.0 - 180.0
+            cells.add(encode(lat, lon, precision))
+    return sorted(cells)
+
+
+def distances(latitude, longitude, latitudes, longitudes):
+    """ Haversine distances in km from a point to many points, in one vectorized pass """
+    if numpy is not None:
+        lat1 = numpy.radians(latitude)
+        lat2 = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        dlat = lat2 - lat1
+        dlon = numpy.radians(numpy.asarray(longitudes, dtype=float) - longitude)
+        a = numpy.sin(dlat / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+        return (2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))).tolist()
+
+    lat1 = math.radians(latitude)
+    result = []
+    for lat, lon in zip(latitudes, longitudes):
+        lat2 = math.radians(lat)
+        dlat = lat2 - lat1
+        dlon = math.radians(lon - longitude)
+        a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+        result.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))))
+    return result
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Fixed per-entry cost on top of the id array (dict slot, key, timestamp)
+ENTRY_OVERHEAD = 128
+
+
+def load_friend_ids(user_id):
+    """ Sorted friend ids of a user, straight from the Friend table """
+    from UserDetail.models import Friend
+    return Friend.objects.filter(to_user=user_id).order_by('from_user') \
+        .values_list('from_user', flat=True)
+
+
+class FriendGraphCache(object):
+    """
+    Per-worker adjacency cache of the friend graph.
+
+    Each user maps to a sorted array of friend ids, entries are evicted in
+    LRU order once the cache goes over its memory cap. Invalidation only
+    reaches the current process, entries older than the ttl are reloaded
+    so other workers converge.
+    """
+
+    def __init__(self, loader, max_bytes=None, ttl=None):
+        self.loader = loader
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            getattr(settings, 'FACEBOOK_FRIEND_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'FACEBOOK_FRIEND_CACHE_TTL', 300)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            # user_id: [generation, loaders] of the entries being loaded
+            self.loading = {}
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    @staticmethod
+    def entry_size(ids):
+        return ids.itemsize * len(ids) + ENTRY_OVERHEAD
+
+    def friend_ids(self, user_id):
+        """ Sorted array of the friend ids of user_id """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            loading = self.loading.setdefault(user_id, [0, 0])
+            loading[1] += 1
+            generation = loading[0]
+
+        try:
+            ids = array('q', self.loader(user_id))
+        except Exception:
+            with self.lock:
+                self.loaded(user_id)
+            raise
+        with self.lock:
+            # Invalidated while loading, the ids may predate the change
+            if self.loaded(user_id) != generation:
+                return ids
+            self.discard(user_id)
+            self.entries[user_id] = (ids, now)
+            self.size += self.entry_size(ids)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= self.entry_size(evicted)
+                self.evictions += 1
+        return ids
+
+    def contains(self, user_id, friend_id):
+        """ Binary search friend_id in the adjacency of user_id """
+        ids = self.friend_ids(user_id)
+        index = bisect_left(ids, friend_id)
+        return index < len(ids) and ids[index] == friend_id
+
+    def loaded(self, user_id):
+        """ End a load of user_id, returns the generation it ends at, None after a clear() """
+        loading = self.loading.get(user_id)
+        if loading is None:
+            return None
+        loading[1] -= 1
+        if not loading[1]:
+            del self.loading[user_id]
+        return loading[0]
+
+    def discard(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= self.entry_size(entry[0])
+
+    def invalidate(self, *user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.discard(user_id)
+                if user_id in self.loading:
+                    self.loading[user_id][0] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+friend_graph = FriendGraphCache(load_friend_ids)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends import utils
+
+logger = logging.getLogger('UserDetail.metrics')
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ Raised when budgets are enforced and a view runs more queries than it declared """
+
+
+def query_budget(limit, methods=None):
+    """ Declare the most queries a view may run, outermost decorator of a view """
+    def decorator(view):
+        view.query_budget = (limit, methods)
+        return view
+    return decorator
+
+
+def view_budget(view_func, method):
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(view_func, 'cls', None), 'query_budget', None)
+    if budget is None:
+        return None
+    limit, methods = budget
+    if methods is not None and method not in methods:
+        return None
+    return limit
+
+
+class CountingCursorWrapper(utils.CursorWrapper):
+    """ Times each statement into the metrics of the current request, without the debug query log """
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record_query(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record_query(sql, time.time() - start)
+
+
+def record_query(sql, duration):
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        queries.append((sql, duration))
+
+
+def count_queries(connection):
+    """ Wrap the cursors of a connection in CountingCursorWrapper, once per connection """
+    if getattr(connection, 'counting_queries', False):
+        return
+    make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(make_cursor(cursor), connection)
+    connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(make_debug_cursor(cursor), connection)
+    connection.counting_queries = True
+
+
+def request_state(state=None):
+    """ Metrics of the request running on this thread, saved into state for the work it hands to other threads """
+    state = {} if state is None else state
+    state['metrics'], state['queries'] = getattr(_local, 'metrics', None), getattr(_local, 'queries', None)
+    return state
+
+
+@contextmanager
+def bound_request_state(state):
+    """ Count the queries of the enclosed block for the request state was taken from, keep its changes in state """
+    previous = request_state()
+    _local.metrics, _local.queries = state.get('metrics'), state.get('queries')
+    if _local.queries is not None:
+        for connection in connections.all():
+            count_queries(connection)
+    try:
+        yield
+    finally:
+        request_state(state)
+        _local.metrics, _local.queries = previous['metrics'], previous['queries']
+
+
+@contextmanager
+def serializing():
+    """ Count the enclosed block as serialization time of the current request """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if getattr(_local, 'metrics', None) is not None:
+            _local.metrics['serialization'] += time.time() - start
+
+
+class InstrumentationMiddleware(object):
+    """
+    Record query count, database time, serialization time and size of each response.
+
+    The numbers go out as X-* response headers and one JSON log line on the
+    UserDetail.metrics logger. With FACEBOOK_ENFORCE_QUERY_BUDGETS on, a view
+    going over its query_budget raises QueryBudgetExceeded.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            if token is not None:
+                self.stop(token)
+            raise
+        return self.finish(request, response, token)
+
+    def start(self, request):
+        """ Begin measuring a request, returns what finish needs """
+        if not getattr(settings, 'FACEBOOK_INSTRUMENTATION', True):
+            return None
+        for connection in connections.all():
+            count_queries(connection)
+
+        # Requests dispatched from inside another request keep their own
+        # numbers, their queries also count for the outer request
+        outer, outer_queries = getattr(_local, 'metrics', None), getattr(_local, 'queries', None)
+        _local.metrics = {'serialization': 0.0, 'budget': None, 'view': None}
+        _local.queries = []
+        return outer, outer_queries, time.time()
+
+    def stop(self, token):
+        """ Put back the numbers of the outer request, returns those of this one """
+        outer, outer_queries, start = token
+        metrics, queries = _local.metrics, _local.queries
+        _local.metrics, _local.queries = outer, outer_queries
+        if outer_queries is not None:
+            outer_queries.extend(queries)
+        return metrics, queries, time.time() - start
+
+    def finish(self, request, response, token):
+        """ Report the numbers of a request started with start on its response """
+        if token is None:
+            return response
+        metrics, queries, total = self.stop(token)
+
+        size = None if response.streaming else len(response.content)
+        line = {
+            'view': metrics['view'],
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': len(queries),
+            'db_ms': round(sum(duration for _, duration in queries) * 1000, 2),
+            'serialization_ms': round(metrics['serialization'] * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+            'size': size,
+        }
+        response['X-Query-Count'] = str(line['queries'])
+        response['X-DB-Time-Ms'] = str(line['db_ms'])
+        response['X-Serialization-Ms'] = str(line['serialization_ms'])
+        response['X-Response-Time-Ms'] = str(line['total_ms'])
+        if size is not None:
+            response['X-Response-Size'] = str(size)
+        logger.info(json.dumps(line, sort_keys=True))
+
+        budget = metrics['budget']
+        if budget is not None and len(queries) > budget and \
+                getattr(settings, 'FACEBOOK_ENFORCE_QUERY_BUDGETS', False):
+            raise QueryBudgetExceeded('%s ran %s queries, its budget is %s:\n%s' % (
+                metrics['view'], len(queries), budget, '\n'.join(sql for sql, _ in queries)))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = getattr(_local, 'metrics', None)
+        if metrics is not None:
+            match = request.resolver_match
+            metrics['view'] = match.url_name if match and match.url_name else view_func.__name__
+            metrics['budget'] = view_budget(view_func, request.method)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered (JSON encoded) after this hook
+        metrics = getattr(_local, 'metrics', None)
+        if metrics is not None:
+            start = time.time()
+
+            def rendered(response):
+                metrics['serialization'] += time.time() - start
+            response.add_post_render_callback(rendered)
+        return response
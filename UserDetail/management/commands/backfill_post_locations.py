@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, CharField, FloatField, Q, Value, When
+
+from UserDetail import sharding
+from UserDetail.models import FacebookPost, chunked
+
+# Posts set by one UPDATE, three CASE branches each stay under the SQLite variable limit
+UPDATE_ROWS = 100
+
+
+class Command(BaseCommand):
+    help = 'Parse place_lat/place_long of existing posts into numeric coordinates and geohashes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of posts updated per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        located = 0
+        total = 0
+        for alias in sharding.aliases():
+            posts = FacebookPost.objects.using(alias) \
+                .filter(Q(place_lat__isnull=False) | Q(place_long__isnull=False)) \
+                .only('pk', 'place_lat', 'place_long').order_by('pk')
+            last_pk = 0
+            while True:
+                batch = list(posts.filter(pk__gt=last_pk)[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                for post in batch:
+                    post.update_location()
+                with transaction.atomic(using=alias):
+                    for rows in chunked(batch, UPDATE_ROWS):
+                        self.update(alias, rows)
+                located += sum(1 for post in batch if post.geohash)
+                total += len(batch)
+                self.stdout.write('Processed %s posts' % total)
+
+        self.stdout.write(self.style.SUCCESS('Location backfill complete, %s of %s posts located' % (located, total)))
+
+    def update(self, alias, posts):
+        """ Write the parsed locations of posts with one UPDATE """
+        columns = {}
+        for field, output_field in (('latitude', FloatField()), ('longitude', FloatField()),
+                                    ('geohash', CharField())):
+            columns[field] = Case(*[When(pk=post.pk, then=Value(getattr(post, field))) for post in posts],
+                                  default=None, output_field=output_field)
+        FacebookPost.objects.using(alias).filter(pk__in=[post.pk for post in posts]).update(**columns)
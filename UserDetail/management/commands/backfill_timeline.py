@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from UserDetail.models import FacebookPost, Friend, TimelineEntry
+
+
+class Command(BaseCommand):
+    help = 'Backfill the materialized timelines from the existing Friend and FacebookPost rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of posts fanned out per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        threshold = getattr(settings, 'FACEBOOK_FAN_OUT_THRESHOLD', 5000)
+
+        # Authors above the threshold stay on the fan-out-on-read path
+        high_degree = set(
+            Friend.objects.values('from_user').annotate(degree=Count('id'))
+            .filter(degree__gt=threshold).values_list('from_user', flat=True)
+        )
+
+        posts = FacebookPost.objects.exclude(owner__in=high_degree).order_by('pk')
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(posts.filter(pk__gt=last_pk).values_list('pk', 'owner_id', 'created_time')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            owners = set(owner_id for _, owner_id, _ in batch)
+            recipients = defaultdict(list)
+            for from_user, to_user in Friend.objects.filter(from_user__in=owners).values_list('from_user', 'to_user'):
+                recipients[from_user].append(to_user)
+
+            post_ids = [pk for pk, _, _ in batch]
+            entries = []
+            for pk, owner_id, created_time in batch:
+                for user_id in recipients[owner_id] + [owner_id]:
+                    entries.append(TimelineEntry(user_id=user_id, post_id=pk, created_time=created_time))
+
+            with transaction.atomic():
+                TimelineEntry.objects.filter(post__in=post_ids).delete()
+                TimelineEntry.objects.bulk_create(entries)
+                FacebookPost.objects.filter(pk__in=post_ids).update(fanned_out=True)
+
+            total += len(batch)
+            self.stdout.write('Fanned out %s posts' % total)
+
+        self.stdout.write(self.style.SUCCESS('Timeline backfill complete, %s posts fanned out' % total))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from UserDetail import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure latency percentiles, query counts and peak memory of every endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Timed requests per endpoint')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='Compare against a JSON report of an earlier run')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+        try:
+            report = benchmark.run(options['iterations'])
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        for name, result in sorted(report['endpoints'].items()):
+            if 'skipped' in result:
+                self.stdout.write('%-32s skipped, %s' % (name, result['skipped']))
+            else:
+                self.stdout.write('%-32s %s p50 %8.2fms p95 %8.2fms p99 %8.2fms %4s queries %8.1fKB' % (
+                    name, result['status'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    result['queries'], result['peak_memory_kb']))
+
+        if options['baseline']:
+            with open(options['baseline']) as handle:
+                baseline = json.load(handle)
+            self.stdout.write('\nAgainst %s' % options['baseline'])
+            for name, ratio, queries in benchmark.compare(report, baseline):
+                self.stdout.write('%-32s p95 x%s %+d queries' % (
+                    name, '%.2f' % ratio if ratio is not None else '-', queries))
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(report, handle, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS('Report written to %s' % options['output']))
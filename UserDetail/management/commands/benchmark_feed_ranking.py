@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from UserDetail import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time the feed ranking stage on synthetic candidates, with and without NumPy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--candidates', type=int, action='append',
+                            help='Candidate set size, repeat for several sizes (default 100, 500, 2000)')
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='Timed scoring passes per size')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        sizes = options['candidates'] or [100, 500, 2000]
+        if options['iterations'] < 1 or min(sizes) < 1:
+            raise CommandError('--iterations and --candidates must be at least 1')
+        reports = [benchmark.ranking_microbenchmark(size, options['iterations']) for size in sizes]
+        for report in reports:
+            line = '%6s candidates  python p50 %8.3fms p95 %8.3fms' % (
+                report['candidates'], report['python_p50_ms'], report['python_p95_ms'])
+            if report['numpy'] is not None:
+                line += '  numpy p50 %8.3fms p95 %8.3fms  x%.1f%s' % (
+                    report['numpy_p50_ms'], report['numpy_p95_ms'], report['speedup'],
+                    '' if report['same_ranking'] else '  RANKINGS DIFFER')
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(reports, handle, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS('Report written to %s' % options['output']))
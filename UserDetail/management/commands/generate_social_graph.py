@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from UserDetail import sharding
+from UserDetail.models import ACTION, PRIVACY, TYPE, FacebookPost, Follow, Friend, FriendshipRequest, PostAction,\
+    chunked
+from UserDetail.relation_filter import follow_filter, friend_filter
+
+USERNAME_PREFIX = 'synthetic_'
+
+
+class Command(BaseCommand):
+    help = 'Generate a reproducible synthetic social graph with power-law friend and follow degrees'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--friend-exponent', type=float, default=2.1,
+                            help='Power-law exponent of the friend degree distribution')
+        parser.add_argument('--follow-exponent', type=float, default=1.8,
+                            help='Power-law exponent of the follower degree distribution')
+        parser.add_argument('--min-friends', type=int, default=2)
+        parser.add_argument('--follows-per-user', type=float, default=5.0)
+        parser.add_argument('--requests-per-user', type=float, default=1.0)
+        parser.add_argument('--posts-per-user', type=float, default=5.0)
+        parser.add_argument('--actions-per-post', type=float, default=3.0)
+        parser.add_argument('--days', type=int, default=30, help='Posts are spread over this many past days')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help='Keep previously generated synthetic users instead of replacing them')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        count = options['users']
+
+        if not options['keep']:
+            # One suggestion refresh per deleted Friend row would dominate the run
+            with override_settings(FACEBOOK_SUGGESTION_REFRESH=False):
+                User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+        with transaction.atomic():
+            users = self.create_users(count)
+            friend_degrees = self.power_law(count, options['friend_exponent'], options['min_friends'])
+            follower_weights = self.power_law(count, options['follow_exponent'], 1)
+            self.create_friends(users, friend_degrees)
+            self.create_follows(users, follower_weights, options['follows_per_user'])
+            self.create_requests(users, friend_degrees, options['requests_per_user'])
+            posts = self.create_posts(users, options['posts_per_user'], options['days'])
+            self.create_actions(users, posts, follower_weights, options['actions_per_post'])
+
+        # bulk_create skips save() and the signals, derive their data in bulk
+        if not sharding.is_sharded():
+            # Sharded walls are gathered from the shards on read
+            call_command('backfill_timeline', stdout=self.stdout)
+        call_command('repair_post_counters', stdout=self.stdout)
+        call_command('backfill_post_locations', stdout=self.stdout)
+        call_command('reindex_posts', full=True, stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS('Generated %s users' % count))
+
+    def power_law(self, count, exponent, minimum):
+        """ Degrees drawn from a Pareto distribution, capped to the number of users """
+        alpha = max(exponent - 1, 0.1)
+        return [min(int(minimum * self.rng.paretovariate(alpha)), count - 1) for _ in range(count)]
+
+    def pick(self, population, weights, k):
+        return self.rng.choices(population, weights=weights, k=k)
+
+    def create_users(self, count):
+        User.objects.bulk_create([
+            User(username='%s%s' % (USERNAME_PREFIX, index), first_name='User', last_name=str(index))
+            for index in range(count)
+        ])
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('pk')
+                     .values_list('pk', flat=True))
+        self.stdout.write('Created %s users' % len(users))
+        return users
+
+    def create_friends(self, users, degrees):
+        """ Chung-Lu style pairing, high-degree users attract proportionally more friends """
+        pairs = set()
+        for user, degree in zip(users, degrees):
+            for friend in self.pick(users, degrees, degree // 2 + 1):
+                if friend != user:
+                    pairs.add((min(user, friend), max(user, friend)))
+        now = timezone.now()
+        rows = []
+        for first, second in pairs:
+            rows.append(Friend(from_user_id=first, to_user_id=second, created=now))
+            rows.append(Friend(from_user_id=second, to_user_id=first, created=now))
+        Friend.objects.bulk_create(rows)
+        # bulk_create sends no post_save, rebuild the negative cache
+        friend_filter.clear()
+        self.stdout.write('Created %s friendships' % len(pairs))
+        self.friends = pairs
+
+    def create_follows(self, users, weights, per_user):
+        edges = set()
+        for user in users:
+            for followee in self.pick(users, weights, int(self.rng.expovariate(1.0 / per_user)) if per_user else 0):
+                if followee != user:
+                    edges.add((user, followee))
+        Follow.objects.bulk_create([Follow(follower_id=follower, followee_id=followee)
+                                    for follower, followee in edges])
+        follow_filter.clear()
+        self.stdout.write('Created %s follows' % len(edges))
+
+    def create_requests(self, users, weights, per_user):
+        edges = set()
+        for user in users:
+            for target in self.pick(users, weights, int(self.rng.expovariate(1.0 / per_user)) if per_user else 0):
+                pair = (min(user, target), max(user, target))
+                if target != user and pair not in self.friends and (target, user) not in edges:
+                    edges.add((user, target))
+        FriendshipRequest.objects.bulk_create([FriendshipRequest(from_user_id=sender, to_user_id=receiver)
+                                               for sender, receiver in edges])
+        self.stdout.write('Created %s friendship requests' % len(edges))
+
+    def create_posts(self, users, per_user, days):
+        now = timezone.now()
+        types = [code for code, _ in TYPE]
+        privacies = [code for code, _ in PRIVACY]
+        rows = []
+        for user in users:
+            for index in range(int(self.rng.expovariate(1.0 / per_user)) if per_user else 0):
+                located = self.rng.random() < 0.3
+                rows.append(FacebookPost(
+                    owner_id=user,
+                    message='Synthetic post %s of user %s' % (index, user),
+                    created_time=now - timedelta(seconds=self.rng.randint(0, days * 86400)),
+                    post_type=self.rng.choice(types),
+                    caption='', description='', story='',
+                    privacy=self.rng.choice(privacies),
+                    place_lat='%.5f' % self.rng.uniform(-60, 60) if located else None,
+                    place_long='%.5f' % self.rng.uniform(-180, 180) if located else None,
+                ))
+        if sharding.is_sharded():
+            # The ids have to name the bucket of the owner, one block of ids per bucket
+            buckets = defaultdict(list)
+            for row in rows:
+                buckets[row.owner_id % len(sharding.shard_map())].append(row)
+            for bucket_rows in buckets.values():
+                for row, pk in zip(bucket_rows, sharding.allocate_post_ids(bucket_rows[0].owner_id,
+                                                                            len(bucket_rows))):
+                    row.pk = pk
+        for alias, shard_rows in sharding.group_by_shard(rows, sharding.shard_of).items():
+            FacebookPost.objects.using(alias).bulk_create(shard_rows)
+
+        posts = []
+        for alias in sharding.aliases():
+            for owners in chunked(users, 900):
+                posts.extend(FacebookPost.objects.using(alias).filter(owner__in=owners).values_list('pk', 'owner_id'))
+        self.stdout.write('Created %s posts' % len(posts))
+        return posts
+
+    def create_actions(self, users, posts, weights, per_post):
+        """ Popular authors get proportionally more likes, shares and comments """
+        weight_of = dict(zip(users, weights))
+        mean_weight = float(sum(weights)) / len(weights) if weights else 1
+        actions = [code for code, _ in ACTION]
+        rows = []
+        for post_id, owner_id in posts:
+            expected = per_post * weight_of.get(owner_id, 1) / mean_weight
+            for _ in range(int(self.rng.expovariate(1.0 / expected)) if expected else 0):
+                action = self.rng.choice(actions)
+                rows.append(PostAction(action_type=action, user_id=self.rng.choice(users), post_id=post_id,
+                                       comments='Nice' if action == 'C' else None))
+        for alias, shard_rows in sharding.group_by_shard(rows, sharding.shard_of).items():
+            PostAction.objects.using(alias).bulk_create(shard_rows)
+        self.stdout.write('Created %s post actions' % len(rows))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from UserDetail.models import FriendSuggestion
+
+
+class Command(BaseCommand):
+    help = 'Precompute the "people you may know" suggestions of every active user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of users scored per batch')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Number of suggestions stored per user')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        total = 0
+        while True:
+            user_ids = list(User.objects.filter(pk__gt=last_pk, is_active=True).order_by('pk')
+                            .values_list('pk', flat=True)[:batch_size])
+            if not user_ids:
+                break
+            last_pk = user_ids[-1]
+            FriendSuggestion.objects.refresh(user_ids, options['limit'])
+            total += len(user_ids)
+            self.stdout.write('Scored %s users' % total)
+
+        self.stdout.write(self.style.SUCCESS('Friend suggestions computed for %s users' % total))
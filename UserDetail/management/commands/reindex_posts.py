@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from UserDetail import search, sharding
+from UserDetail.models import FacebookPost
+
+
+class Command(BaseCommand):
+    help = 'Index the text of FacebookPost rows into the FTS5 search table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Drop the index and rebuild it from scratch')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of posts indexed per transaction')
+
+    def handle(self, *args, **options):
+        if not search.create_index():
+            raise CommandError('Full-text search needs the SQLite backend with FTS5')
+
+        last_pk = 0
+        with connection.cursor() as cursor:
+            if options['full']:
+                cursor.execute('DELETE FROM "%s"' % search.FTS_TABLE)
+            else:
+                # Incremental: only posts newer than the last indexed one
+                cursor.execute('SELECT MAX(rowid) FROM "%s"' % search.FTS_TABLE)
+                last_pk = cursor.fetchone()[0] or 0
+
+        fields = ('pk',) + search.FTS_FIELDS
+        total = 0
+        # The index on the default database covers the posts of every shard
+        for alias in sharding.aliases():
+            shard_last_pk = last_pk
+            while True:
+                batch = list(FacebookPost.objects.using(alias).filter(pk__gt=shard_last_pk).order_by('pk')
+                             .only(*fields)[:options['batch_size']])
+                if not batch:
+                    break
+                shard_last_pk = batch[-1].pk
+                with transaction.atomic():
+                    for post in batch:
+                        search.index_post(post)
+                total += len(batch)
+                self.stdout.write('Indexed %s posts' % total)
+
+        self.stdout.write(self.style.SUCCESS('Search index up to date, %s posts indexed' % total))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from UserDetail import sharding
+from UserDetail.models import ACTION_COUNTERS, FacebookPost, PostAction
+
+
+class Command(BaseCommand):
+    help = 'Recompute the like/share/comment counters of FacebookPost from the PostAction rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of posts recounted per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        repaired = 0
+        # Actions live on the shard of their post
+        for alias in sharding.aliases():
+            last_pk = 0
+            while True:
+                post_ids = list(FacebookPost.objects.using(alias).filter(pk__gt=last_pk).order_by('pk')
+                                .values_list('pk', flat=True)[:batch_size])
+                if not post_ids:
+                    break
+                last_pk = post_ids[-1]
+
+                counts = defaultdict(dict)
+                rows = PostAction.objects.using(alias).filter(post__in=post_ids).values('post', 'action_type') \
+                    .annotate(total=Count('id')).order_by()
+                for row in rows:
+                    field = ACTION_COUNTERS.get(row['action_type'])
+                    if field:
+                        counts[row['post']][field] = row['total']
+
+                # Posts sharing the same counts are repaired with a single UPDATE
+                groups = defaultdict(list)
+                for post_id in post_ids:
+                    values = tuple((field, counts[post_id].get(field, 0))
+                                   for field in sorted(ACTION_COUNTERS.values()))
+                    groups[values].append(post_id)
+
+                with transaction.atomic(using=alias):
+                    for values, ids in groups.items():
+                        repaired += FacebookPost.objects.using(alias).filter(pk__in=ids).exclude(**dict(values)) \
+                            .update(**dict(values))
+
+        self.stdout.write(self.style.SUCCESS('Post counters repaired, %s posts updated' % repaired))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from UserDetail.routers import replicas
+
+
+class Command(BaseCommand):
+    help = 'Copy the SQLite primary database over the SQLite replicas, for local development'
+
+    def handle(self, *args, **options):
+        aliases = replicas()
+        if not aliases:
+            raise CommandError('FACEBOOK_REPLICAS is empty')
+        for alias in [DEFAULT_DB_ALIAS] + list(aliases):
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('Only SQLite replicas can be synced, %s is %s' % (
+                    alias, connections[alias].vendor))
+        if sqlite3.sqlite_version_info < (3, 27):
+            raise CommandError('VACUUM INTO needs SQLite 3.27+, this is %s' % sqlite3.sqlite_version)
+
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            for alias in aliases:
+                path = settings.DATABASES[alias]['NAME']
+                snapshot = '%s.sync' % path
+                if os.path.exists(snapshot):
+                    os.remove(snapshot)
+                # A consistent copy, even while the primary is being written to
+                cursor.execute('VACUUM INTO %s', [snapshot])
+                connections[alias].close()
+                os.rename(snapshot, path)
+                self.stdout.write('Synced %s' % alias)
+
+        self.stdout.write(self.style.SUCCESS('Replicas up to date'))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+COPY_BLOCK_SIZE = 64 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """ Raised when a chunk does not continue the upload """
+
+
+def temp_dir():
+    path = getattr(settings, 'FACEBOOK_UPLOAD_TEMP_DIR', os.path.join(tempfile.gettempdir(), 'facebook_uploads'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def upload_path(upload):
+    return os.path.join(temp_dir(), '%s.part' % upload.pk)
+
+
+@contextmanager
+def upload_lock(upload):
+    """
+    Hold the file of an upload while a chunk is written to it.
+
+    The lock is an flock on a file next to it, shared by every worker
+    process of the host. Raises UploadError when another chunk holds it.
+    """
+    with open(upload_path(upload) + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            raise UploadError('Another chunk of this upload is being written')
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_chunk(upload, stream, start, length):
+    """
+    Append length bytes of stream at offset start of the upload file.
+
+    The body is copied in fixed size blocks, the whole file is never in
+    memory. Chunks must continue where the previous one stopped.
+    """
+    if start != upload.received:
+        raise UploadError('Expected a chunk starting at byte %s' % upload.received)
+    if start + length > upload.total_size:
+        raise UploadError('Chunk ends past the declared size of %s bytes' % upload.total_size)
+
+    path = upload_path(upload)
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as target:
+        target.seek(start)
+        target.truncate()
+        remaining = length
+        while remaining:
+            block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            target.write(block)
+            remaining -= len(block)
+    if remaining:
+        raise UploadError('Chunk body shorter than its Content-Range')
+    return start + length
+
+
+def resize(source_path, out_dir, variants):
+    """ Thumbnail and resized copies of an image, largest side bounded per variant """
+    results = []
+    with Image.open(source_path) as image:
+        image.load()
+        for name, size in sorted(variants.items()):
+            variant = image.copy()
+            variant.thumbnail((size, size))
+            if variant.mode not in ('RGB', 'L'):
+                variant = variant.convert('RGB')
+            path = os.path.join(out_dir, '%s.jpg' % name)
+            variant.save(path, 'JPEG', quality=85)
+            results.append((name, path, variant.size[0], variant.size[1]))
+    return results
+
+
+def video_poster(source_path, out_dir):
+    """ First frame of a video as an image, needs the ffmpeg binary """
+    path = os.path.join(out_dir, 'poster.jpg')
+    try:
+        subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-i', source_path,
+                               '-frames:v', '1', path])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return path
+
+
+def generate_derivatives(source_path, field, variants):
+    """
+    Build the derivatives of an uploaded file, runs in a worker process.
+
+    Returns (temporary directory, [(name, path, width, height)]). Images
+    without Pillow, and videos without ffmpeg, get no derivatives.
+    """
+    out_dir = tempfile.mkdtemp(dir=os.path.dirname(source_path))
+    if Image is None:
+        return out_dir, []
+    if field == 'video':
+        poster = video_poster(source_path, out_dir)
+        if poster is None:
+            return out_dir, []
+        source_path = poster
+    try:
+        return out_dir, resize(source_path, out_dir, variants)
+    except (IOError, OSError):
+        # Not an image Pillow can read
+        return out_dir, []
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'FACEBOOK_MEDIA_WORKERS', 2))
+            atexit.register(_executor.shutdown, True)
+    return _executor
+
+
+def process_upload(upload):
+    """ Hand a complete upload to the worker pool, or process it inline when there are no workers """
+    args = (upload_path(upload), upload.field, getattr(settings, 'FACEBOOK_MEDIA_VARIANTS', {}))
+    if not getattr(settings, 'FACEBOOK_MEDIA_WORKERS', 2):
+        try:
+            store_derivatives(upload.pk, *generate_derivatives(*args))
+        except Exception:
+            # Reported through the upload status like a failed worker
+            logger.exception('Processing upload %s failed', upload.pk)
+            fail_upload(upload.pk)
+        return
+    future = executor().submit(generate_derivatives, *args)
+    future.add_done_callback(lambda done: finish_in_thread(upload.pk, done))
+
+
+def finish_in_thread(upload_id, future):
+    """ Worker completion callback, runs on an executor thread with its own connection """
+    close_old_connections()
+    try:
+        try:
+            store_derivatives(upload_id, *future.result())
+        except Exception:
+            fail_upload(upload_id)
+            raise
+    finally:
+        close_old_connections()
+
+
+def fail_upload(upload_id):
+    from UserDetail.models import MediaUpload
+    MediaUpload.objects.filter(pk=upload_id).update(status='failed')
+
+
+def store_derivatives(upload_id, out_dir, results):
+    """ Save the original and its derivatives through the storage and mark the post ready """
+    from UserDetail.models import FacebookPost, MediaUpload, MediaVariant
+
+    upload = MediaUpload.objects.get(pk=upload_id)
+    post = FacebookPost.objects.get_post(upload.post_id)
+    source_path = upload_path(upload)
+    try:
+        with open(source_path, 'rb') as source:
+            name = default_storage.save(os.path.join('uploads', upload.filename), File(source))
+        variants = []
+        for variant_name, path, width, height in results:
+            with open(path, 'rb') as content:
+                stored = default_storage.save(
+                    os.path.join('variants', '%s_%s.jpg' % (post.pk, variant_name)), File(content))
+            variants.append(MediaVariant(post=post, name=variant_name, file=stored, width=width, height=height))
+
+        with transaction.atomic():
+            MediaVariant.objects.filter(post=post).delete()
+            MediaVariant.objects.bulk_create(variants)
+            FacebookPost.objects.using(post._state.db).filter(pk=post.pk).update(
+                **{upload.field: name, 'media_ready': True})
+            MediaUpload.objects.filter(pk=upload.pk).update(status='ready')
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        for path in (source_path, source_path + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
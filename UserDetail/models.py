@@ -1,15 +1,48 @@
+import heapq
+import uuid
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
-from django.db.models import Q
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Greatest
+
+from UserDetail import geo, ranking, sharding
+from UserDetail.graph_cache import friend_graph
+from UserDetail.relation_filter import follow_filter, friend_filter
+from UserDetail.suggestions import refresh_queue
+from UserDetail.routers import replica_reads
 
 GENDER = (('M', 'MALE'), ('F', 'FEMALE'))
 RELATION = (('S', 'Single'), ('M', 'Married'), ('C', 'Complicated'))
 TYPE = (('PIC', 'Picture'), ('VID', 'Video'), ('URL', 'Url'))
 PRIVACY = (('ME', 'Me'), ('FND', 'Friends'), ('ALL', 'All'))
 ACTION = (('L', 'Like'), ('S', 'Share'), ('C', 'Comments'))
+MEDIA_FIELD = (('picture', 'Picture'), ('video', 'Video'))
+UPLOAD_STATUS = (('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed'))
+# Posts without a privacy setting are treated as friends only
+PUBLIC = 'ALL'
+FRIENDS_VISIBLE = ('FND', 'ALL')
+# FacebookPost counter column kept in sync for each action type
+ACTION_COUNTERS = {'L': 'like_count', 'S': 'share_count', 'C': 'comment_count'}
+
+
+def chunked(items, size):
+    """ Split a list into lists of at most size items """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def older_than(position):
+    """ Filter selecting the posts after a (created_time, id) position, newest first """
+    created_time, pk = position
+    return Q(created_time__lt=created_time) | Q(created_time=created_time, id__lt=pk)
 
 
 class FriendshipRequest(models.Model):
@@ -27,6 +60,10 @@ class FriendshipRequest(models.Model):
         verbose_name = 'Friendship Request'
         verbose_name_plural = 'Friendship Requests'
         unique_together = ('from_user', 'to_user')
+        indexes = [
+            models.Index(fields=['to_user', '-created'], name='request_to_created_idx'),
+            models.Index(fields=['from_user', '-created'], name='request_from_created_idx'),
+        ]
 
     def __unicode__(self):
         return "User #%s friendship requested #%s" % (self.from_user_id, self.to_user_id)
@@ -71,36 +108,51 @@ class FriendshipRequest(models.Model):
 class FriendshipManager(models.Manager):
     """ Friendship manager """
 
+    def friends_queryset(self, user):
+        """ Return the friendship rows of user """
+        return Friend.objects.select_related('from_user', 'to_user').filter(to_user=user)
+
+    def friend_ids(self, user):
+        """ Return the sorted array of friend ids, served from the friend graph cache """
+        return friend_graph.friend_ids(getattr(user, 'pk', user))
+
+    @replica_reads
     def friends(self, user):
         """ Return a list of all friends """
-        qs = Friend.objects.select_related('from_user', 'to_user').filter(to_user=user).all()
-        friends = [u.from_user for u in qs]
+        friends = list(User.objects.filter(pk__in=list(self.friend_ids(user))).order_by('pk'))
         return friends
 
+    def requests_queryset(self, user):
+        """ Return the friendship requests received by user """
+        return FriendshipRequest.objects.select_related('from_user', 'to_user').filter(to_user=user)
+
+    @replica_reads
     def requests(self, user):
         """ Return a list of friendship requests """
-
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-            to_user=user).all()
-        requests = list(qs)
+        requests = list(self.requests_queryset(user))
         return requests
 
+    def sent_requests_queryset(self, user):
+        """ Return the friendship requests sent by user """
+        return FriendshipRequest.objects.select_related('from_user', 'to_user').filter(from_user=user)
+
+    @replica_reads
     def sent_requests(self, user):
         """ Return a list of friendship requests from user """
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-             from_user=user).all()
-        requests = list(qs)
+        requests = list(self.sent_requests_queryset(user))
         return requests
 
+    def unread_requests_queryset(self, user):
+        """ Return the unread friendship requests """
+        return self.requests_queryset(user).filter(viewed__isnull=True)
+
+    @replica_reads
     def unread_requests(self, user):
         """ Return a list of unread friendship requests """
-
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-            to_user=user,
-            viewed__isnull=True).all()
-        unread_requests = list(qs)
+        unread_requests = list(self.unread_requests_queryset(user))
         return unread_requests
 
+    @replica_reads
     def unread_request_count(self, user):
         """ Return a count of unread friendship requests """
 
@@ -109,31 +161,37 @@ class FriendshipManager(models.Manager):
                 viewed__isnull=True).count()
         return count
 
+    def read_requests_queryset(self, user):
+        """ Return the read friendship requests """
+        return self.requests_queryset(user).filter(viewed__isnull=False)
+
+    @replica_reads
     def read_requests(self, user):
         """ Return a list of read friendship requests """
-
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-            to_user=user,
-            viewed__isnull=False).all()
-        read_requests = list(qs)
+        read_requests = list(self.read_requests_queryset(user))
         return read_requests
 
+    def rejected_requests_queryset(self, user):
+        """ Return the rejected friendship requests """
+        return self.requests_queryset(user).filter(rejected__isnull=False)
+
+    @replica_reads
     def rejected_requests(self, user):
         """ Return a list of rejected friendship requests """
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-            to_user=user,
-            rejected__isnull=False).all()
-        rejected_requests = list(qs)
+        rejected_requests = list(self.rejected_requests_queryset(user))
         return rejected_requests
 
+    def unrejected_requests_queryset(self, user):
+        """ Return the requests that haven't been rejected """
+        return self.requests_queryset(user).filter(rejected__isnull=True)
+
+    @replica_reads
     def unrejected_requests(self, user):
         """ All requests that haven't been rejected """
-        qs = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
-            to_user=user,
-            rejected__isnull=True).all()
-        unrejected_requests = list(qs)
+        unrejected_requests = list(self.unrejected_requests_queryset(user))
         return unrejected_requests
 
+    @replica_reads
     def unrejected_request_count(self, user):
         """ Return a count of unrejected friendship requests """
         count = FriendshipRequest.objects.select_related('from_user', 'to_user').filter(
@@ -141,6 +199,90 @@ class FriendshipManager(models.Manager):
                 rejected__isnull=True).count()
         return count
 
+    def relationships(self, viewer, user_ids):
+        """
+        Resolve the relationship of viewer with each user in a constant number of queries.
+
+        Returns a dict mapping each user id to its friend, following,
+        incoming_request and outgoing_request flags, rejected requests
+        are not pending.
+        """
+        user_ids = set(user_ids)
+        friends = set(self.friend_ids(viewer)).intersection(user_ids)
+        following = set()
+        incoming = set()
+        outgoing = set()
+        # SQLite caps the number of bound parameters, keep the IN lists short
+        for chunk in chunked(sorted(user_ids), 900):
+            following.update(Follow.objects.filter(follower=viewer, followee__in=chunk)
+                             .values_list('followee', flat=True))
+            incoming.update(FriendshipRequest.objects.filter(to_user=viewer, from_user__in=chunk,
+                                                             rejected__isnull=True)
+                            .values_list('from_user', flat=True))
+            outgoing.update(FriendshipRequest.objects.filter(from_user=viewer, to_user__in=chunk,
+                                                             rejected__isnull=True)
+                            .values_list('to_user', flat=True))
+        return dict((user_id, {
+            'friend': user_id in friends,
+            'following': user_id in following,
+            'incoming_request': user_id in incoming,
+            'outgoing_request': user_id in outgoing,
+        }) for user_id in user_ids)
+
+    def bulk_accept(self, user, request_ids):
+        """
+        Accept many friendship requests received by user in one transaction.
+
+        Returns a dict mapping each request id to 'accepted' or 'not_found'.
+        """
+        request_ids = set(request_ids)
+        with transaction.atomic():
+            found = dict(FriendshipRequest.objects.filter(pk__in=request_ids, to_user=user)
+                         .values_list('pk', 'from_user'))
+            senders = set(found.values())
+            existing = set(Friend.objects.filter(to_user=user, from_user__in=senders)
+                           .values_list('from_user', flat=True))
+            now = timezone.now()
+            relations = []
+            for sender in senders - existing:
+                relations.append(Friend(from_user_id=sender, to_user=user, created=now))
+                relations.append(Friend(from_user=user, to_user_id=sender, created=now))
+            Friend.objects.bulk_create(relations)
+
+            # Accepted requests and any reverse requests go in one DELETE
+            FriendshipRequest.objects.filter(
+                Q(pk__in=found.keys()) | Q(from_user=user, to_user__in=senders)
+            ).delete()
+
+            # bulk_create skips the Friend signals, keep their side effects
+            pairs = [(relation.to_user_id, relation.from_user_id) for relation in relations]
+            for user_id, friend_id in pairs:
+                friend_filter.add(user_id, friend_id)
+            TimelineEntry.objects.fan_in_many(pairs)
+
+        user_id = getattr(user, 'pk', user)
+        friend_graph.invalidate(user_id, *senders)
+        if senders and getattr(settings, 'FACEBOOK_SUGGESTION_REFRESH', True):
+            changed = [user_id] + list(senders)
+            transaction.on_commit(lambda: refresh_queue.add(*changed))
+        return dict((pk, 'accepted' if pk in found else 'not_found') for pk in request_ids)
+
+    def bulk_reject(self, user, request_ids):
+        """ Reject many friendship requests received by user with a single UPDATE """
+        return self._bulk_stamp(user, request_ids, 'rejected')
+
+    def bulk_mark_viewed(self, user, request_ids):
+        """ Mark many friendship requests received by user as viewed with a single UPDATE """
+        return self._bulk_stamp(user, request_ids, 'viewed')
+
+    def _bulk_stamp(self, user, request_ids, field):
+        request_ids = set(request_ids)
+        with transaction.atomic():
+            qs = FriendshipRequest.objects.filter(pk__in=request_ids, to_user=user)
+            found = set(qs.values_list('pk', flat=True))
+            qs.update(**{field: timezone.now()})
+        return dict((pk, field if pk in found else 'not_found') for pk in request_ids)
+
     def add_friend(self, from_user, to_user, message=None):
         """ Create a friendship request """
         if from_user == to_user:
@@ -183,11 +325,14 @@ class FriendshipManager(models.Manager):
 
     def are_friends(self, user1, user2):
         """ Are these two users friends? """
-        try:
-            Friend.objects.get(to_user=user1, from_user=user2)
-            return True
-        except Friend.DoesNotExist:
+        user1, user2 = getattr(user1, 'pk', user1), getattr(user2, 'pk', user2)
+        if not friend_filter.might_contain(user1, user2):
             return False
+        return friend_graph.contains(user1, user2)
+
+    def mutual_friend_count(self, user1, user2):
+        """ Return the number of friends both users have """
+        return len(set(self.friend_ids(user1)).intersection(self.friend_ids(user2)))
 
 
 class Friend(models.Model):
@@ -202,6 +347,9 @@ class Friend(models.Model):
         verbose_name = 'Friend'
         verbose_name_plural = 'Friends'
         unique_together = ('from_user', 'to_user')
+        indexes = [
+            models.Index(fields=['to_user', '-created'], name='friend_to_created_idx'),
+        ]
 
     def __unicode__(self):
         return "User #%s is friends with #%s" % (self.to_user_id, self.from_user_id)
@@ -216,16 +364,24 @@ class Friend(models.Model):
 class FollowingManager(models.Manager):
     """ Following manager """
 
+    def followers_queryset(self, user):
+        """ Return the follow rows pointing at user """
+        return Follow.objects.select_related('follower', 'followee').filter(followee=user)
+
+    @replica_reads
     def followers(self, user):
         """ Return a list of all followers """
-        qs = Follow.objects.filter(followee=user).all()
-        followers = [u.follower for u in qs]
+        followers = [u.follower for u in self.followers_queryset(user)]
         return followers
 
+    def following_queryset(self, user):
+        """ Return the follow rows of user """
+        return Follow.objects.select_related('follower', 'followee').filter(follower=user)
+
+    @replica_reads
     def following(self, user):
         """ Return a list of all users the given user follows """
-        qs = Follow.objects.filter(follower=user).all()
-        following = [u.followee for u in qs]
+        following = [u.followee for u in self.following_queryset(user)]
         return following
 
     def add_follower(self, follower, followee):
@@ -233,6 +389,18 @@ class FollowingManager(models.Manager):
         if follower == followee:
             raise ValidationError("Users cannot follow themselves")
 
+        follower_id, followee_id = getattr(follower, 'pk', follower), getattr(followee, 'pk', followee)
+        if not follow_filter.might_contain(follower_id, followee_id):
+            # Not following yet, the unique constraint still catches a concurrent insert
+            try:
+                with transaction.atomic():
+                    return Follow.objects.create(follower=follower, followee=followee)
+            except IntegrityError:
+                if not Follow.objects.filter(follower=follower_id, followee=followee_id).exists():
+                    raise
+                follow_filter.add(follower_id, followee_id)
+                raise IntegrityError("User '%s' already follows '%s'" % (follower, followee))
+
         relation, created = Follow.objects.get_or_create(follower=follower, followee=followee)
 
         if created is False:
@@ -250,6 +418,8 @@ class FollowingManager(models.Manager):
 
     def follows(self, follower, followee):
         """ Does follower follow followee? Smartly uses caches if exists """
+        if not follow_filter.might_contain(getattr(follower, 'pk', follower), getattr(followee, 'pk', followee)):
+            return False
 
         try:
             Follow.objects.get(follower=follower, followee=followee)
@@ -270,6 +440,10 @@ class Follow(models.Model):
         verbose_name = 'Following Relationship'
         verbose_name_plural = 'Following Relationships'
         unique_together = ('follower', 'followee')
+        indexes = [
+            models.Index(fields=['followee', '-created'], name='follow_followee_created_idx'),
+            models.Index(fields=['follower', '-created'], name='follow_follower_created_idx'),
+        ]
 
     def __unicode__(self):
         return "User #%s follows #%s" % (self.follower_id, self.followee_id)
@@ -280,21 +454,314 @@ class Follow(models.Model):
             raise ValidationError("Users cannot follow themselves.")
         super(Follow, self).save(*args, **kwargs)
 
+class FriendSuggestionManager(models.Manager):
+    """ People you may know """
+
+    def suggestions(self, user):
+        """ Return the precomputed suggestions of user, best first """
+        return FriendSuggestion.objects.select_related('suggested').filter(user=user) \
+            .order_by('-mutual_count', 'suggested')
+
+    def compute(self, user_ids, limit=None):
+        """
+        Rank the friend-of-friend candidates of each user by mutual friend count.
+
+        Runs a constant number of queries for the whole batch of users, the
+        scoring itself is set and counter arithmetic in memory.
+        """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_SUGGESTION_LIMIT', 50)
+        user_ids = list(user_ids)
+
+        friends = defaultdict(set)
+        for user_id, friend_id in Friend.objects.filter(to_user__in=user_ids).values_list('to_user', 'from_user'):
+            friends[user_id].add(friend_id)
+
+        second_degree = defaultdict(list)
+        all_friends = set().union(*friends.values()) if friends else set()
+        for user_id, friend_id in Friend.objects.filter(to_user__in=all_friends).values_list('to_user', 'from_user'):
+            second_degree[user_id].append(friend_id)
+
+        # Rejected requests leave the pair free to be suggested again
+        pending = defaultdict(set)
+        requests = FriendshipRequest.objects.filter(Q(from_user__in=user_ids) | Q(to_user__in=user_ids),
+                                                    rejected__isnull=True) \
+            .values_list('from_user', 'to_user')
+        for from_user, to_user in requests:
+            pending[from_user].add(to_user)
+            pending[to_user].add(from_user)
+
+        results = {}
+        for user_id in user_ids:
+            candidates = Counter()
+            for friend_id in friends[user_id]:
+                candidates.update(second_degree[friend_id])
+            excluded = friends[user_id] | pending[user_id]
+            excluded.add(user_id)
+            ranked = sorted(((count, candidate) for candidate, count in candidates.items()
+                             if candidate not in excluded), key=lambda item: (-item[0], item[1]))
+            results[user_id] = [(candidate, count) for count, candidate in ranked[:limit]]
+        return results
+
+    def refresh(self, user_ids, limit=None):
+        """ Recompute and store the suggestions of the given users """
+        user_ids = list(user_ids)
+        results = self.compute(user_ids, limit)
+        now = timezone.now()
+        with transaction.atomic():
+            FriendSuggestion.objects.filter(user__in=user_ids).delete()
+            FriendSuggestion.objects.bulk_create([
+                FriendSuggestion(user_id=user_id, suggested_id=candidate, mutual_count=count, created=now)
+                for user_id, ranked in results.items()
+                for candidate, count in ranked
+            ])
+        return results
+
+
+class FriendSuggestion(models.Model):
+    """ Model to represent a precomputed friend suggestion """
+    user = models.ForeignKey(User, related_name='friend_suggestions')
+    suggested = models.ForeignKey(User, related_name='+')
+    mutual_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+
+    objects = FriendSuggestionManager()
+
+    class Meta:
+        verbose_name = 'Friend suggestion'
+        verbose_name_plural = 'Friend suggestions'
+        unique_together = ('user', 'suggested')
+        indexes = [
+            models.Index(fields=['user', '-mutual_count'], name='suggestion_user_mutual_idx'),
+        ]
+
+    def __unicode__(self):
+        return "User #%s may know #%s" % (self.user_id, self.suggested_id)
+
+
 class PostManager(models.Manager):
 
-    def wall_post(self, user):
-        qs = Friend.objects.select_related('from_user', 'to_user').filter(to_user=user).all()
-        friends = [u.from_user for u in qs]
-        friends.append(user)
-        return FacebookPost.objects.filter(owner__in=friends)
+    def wall_post(self, user, limit=None, fields=None, before=None):
+        """
+        Posts on the wall of user, newest first, as a list.
+
+        Unsharded, the user's timeline is read as one range of its
+        (user, created_time) index, and the posts of high-degree authors,
+        never fanned out, are pulled and merged in. Sharded, each shard is
+        queried for the posts of the user and friends it holds, and the
+        ordered results are heap merged. With fields, the posts are loaded
+        with those fields only, they must include created_time. With before,
+        a (created_time, id) position, only the posts older than it are read.
+        """
+        if sharding.is_sharded():
+            return self.sharded_wall_post(user, limit, fields, before)
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_PAGE_SIZE', 50)
+        user_id = getattr(user, 'pk', user)
+        # Unfriending deletes the timeline entries of the former friend, the
+        # owner check still keeps out entries left behind by a missed cleanup
+        friends = Friend.objects.filter(to_user=user_id).values('from_user')
+        entries = TimelineEntry.objects.filter(user=user_id).filter(
+            Q(post__owner=user_id) |
+            Q(post__owner__in=friends) & (Q(post__privacy__in=FRIENDS_VISIBLE) | Q(post__privacy__isnull=True))
+        ).select_related('post').order_by('-created_time', '-post')
+        pulled = FacebookPost.objects.filter(fanned_out=False).filter(
+            Q(owner=user_id) |
+            Q(owner__in=friends) & (Q(privacy__in=FRIENDS_VISIBLE) | Q(privacy__isnull=True))
+        ).order_by('-created_time', '-id')
+        if before is not None:
+            # Entries copy the created_time of their post
+            created_time, pk = before
+            entries = entries.filter(Q(created_time__lt=created_time) | Q(created_time=created_time, post__lt=pk))
+            pulled = pulled.filter(older_than(before))
+        if fields:
+            entries = entries.only('post', *['post__%s' % field for field in fields])
+            pulled = pulled.only(*fields)
+        entries, pulled = entries[:limit], pulled[:limit]
+        merged = heapq.merge([entry.post for entry in entries], pulled,
+                             key=lambda post: (post.created_time, post.pk), reverse=True)
+        return list(islice(merged, limit))
+
+    def ranked_wall_post(self, user, limit=None, before=None):
+        """
+        The best posts of the wall of user, ranked out of its FACEBOOK_FEED_CANDIDATES newest.
+
+        Candidates are read with the feature columns only, the whole posts
+        are loaded for the ranked few. With before, the candidates are the
+        newest posts older than that (created_time, id) position.
+        """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_PAGE_SIZE', 50)
+        candidates = self.wall_post(user, limit=getattr(settings, 'FACEBOOK_FEED_CANDIDATES', 500),
+                                    fields=ranking.COLUMNS, before=before)
+        ranked = ranking.rank(getattr(user, 'pk', user), candidates, limit)
+        posts = self.get_posts([candidate.pk for candidate in ranked])
+        result = []
+        for candidate in ranked:
+            # Skip posts deleted since the candidates were read
+            post = posts.get(candidate.pk)
+            if post is not None:
+                post.score = candidate.score
+                result.append(post)
+        return result
+
+    def sharded_wall_post(self, user, limit=None, fields=None, before=None):
+        """ Scatter the wall query to the shards of the owners, gather with a heap merge """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_PAGE_SIZE', 50)
+        user_id = getattr(user, 'pk', user)
+        owners = [user_id] + list(Friend.objects.friend_ids(user_id))
+        visible = Q(owner=user_id) | Q(privacy__in=FRIENDS_VISIBLE) | Q(privacy__isnull=True)
+        streams = []
+        for alias, owner_ids in sharding.group_by_shard(owners, sharding.shard_for_owner).items():
+            for chunk in chunked(owner_ids, 900):
+                stream = self.using(alias).filter(visible, owner__in=chunk).order_by('-created_time', '-id')
+                if before is not None:
+                    stream = stream.filter(older_than(before))
+                if fields:
+                    stream = stream.only(*fields)
+                streams.append(stream[:limit])
+        merged = heapq.merge(*streams, key=lambda post: (post.created_time, post.pk), reverse=True)
+        return list(islice(merged, limit))
+
+    def profile_post(self, user, viewer=None):
+        """ Posts of user that viewer is allowed to see, read from the shard of user """
+        qs = self.using(sharding.shard_for_owner(getattr(user, 'pk', user))).filter(owner=user)
+        if viewer is None or getattr(viewer, 'pk', viewer) == getattr(user, 'pk', user):
+            return qs
+        if Friend.objects.are_friends(user, viewer):
+            return qs.filter(Q(privacy__in=FRIENDS_VISIBLE) | Q(privacy__isnull=True))
+        # Equality on (owner, privacy) keeps the scan inside the public rows
+        return qs.filter(privacy=PUBLIC)
+
+    def get_post(self, pk):
+        """ A post by id, from its shard """
+        return self.using(sharding.shard_for_post(pk)).get(pk=pk)
+
+    def get_posts(self, pks, **filters):
+        """ {pk: post} of the given ids matching filters, one query per shard """
+        posts = {}
+        for alias, ids in sharding.group_by_shard(pks, sharding.shard_for_post).items():
+            for chunk in chunked(ids, 900):
+                posts.update((post.pk, post) for post in self.using(alias).filter(pk__in=chunk, **filters))
+        return posts
+
+    def on_shard(self, alias):
+        """ Posts of one shard, unsharded the routers pick the database """
+        return self.using(alias) if sharding.is_sharded() else self.all()
+
+    def visible_to(self, viewer, using=None):
+        """
+        Posts viewer is allowed to see, from any owner, on one database.
+
+        Sharded, using names the shard to read and is required. Friendships
+        live on the default database, the ids of the friends whose posts
+        the shard holds are inlined instead of a subquery.
+        """
+        if not sharding.is_sharded():
+            friends = Friend.objects.filter(to_user=viewer).values('from_user')
+        elif using is None:
+            raise ValueError('Posts are sharded, visible_to needs the shard to read')
+        elif viewer is None:
+            friends = []
+        else:
+            friends = [friend_id for friend_id in Friend.objects.friend_ids(viewer)
+                       if sharding.shard_for_owner(friend_id) == using]
+        return self.on_shard(using).filter(
+            Q(privacy=PUBLIC) |
+            Q(owner=viewer) |
+            Q(owner__in=friends) & (Q(privacy__in=FRIENDS_VISIBLE) | Q(privacy__isnull=True))
+        )
 
-    def profile_post(self, user):
-        return FacebookPost.objects.filter(owner=user)
+    def covering_filter(self, latitude, longitude, radius_km):
+        """ Posts in the geohash cells covering a circle, as ranges of the geohash index """
+        cells = Q()
+        for cell in geo.covering_cells(latitude, longitude, radius_km):
+            # A prefix LIKE cannot use the index on SQLite, '~' sorts after every geohash character
+            cells |= Q(geohash__gte=cell, geohash__lt=cell + '~')
+        return cells
+
+    def nearby(self, viewer, latitude, longitude, radius_km, limit=None, fields=None):
+        """
+        Visible posts within radius_km of a point, nearest first.
+
+        Candidates are narrowed with the geohash cells covering the circle
+        and the latitude band of the radius, and only their coordinates are
+        read, at most FACEBOOK_NEARBY_CANDIDATES of the newest per shard.
+        Exact distances are computed in one pass and the nearest posts
+        loaded with the given fields only.
+        """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_NEARBY_LIMIT', 100)
+        cells = self.covering_filter(latitude, longitude, radius_km)
+        dlat, _ = geo.radius_degrees(latitude, radius_km)
+        candidates = []
+        for alias in sharding.aliases():
+            candidates.extend(
+                self.visible_to(viewer, alias).filter(cells, latitude__range=(latitude - dlat, latitude + dlat))
+                .order_by('-created_time', '-id')
+                .values_list('pk', 'latitude', 'longitude')[:getattr(settings, 'FACEBOOK_NEARBY_CANDIDATES', 5000)]
+            )
+        if not candidates:
+            return []
+        distances = geo.distances(latitude, longitude,
+                                  [lat for _, lat, _ in candidates],
+                                  [lon for _, _, lon in candidates])
+        nearest = sorted((distance, pk) for (pk, _, _), distance in zip(candidates, distances)
+                         if distance <= radius_km)[:limit]
+        if not nearest:
+            return []
+        posts = {}
+        for alias, pks in sharding.group_by_shard([pk for _, pk in nearest], sharding.shard_for_post).items():
+            shard_posts = self.on_shard(alias).filter(pk__in=pks)
+            if fields:
+                shard_posts = shard_posts.only(*fields)
+            posts.update((post.pk, post) for post in shard_posts)
+        result = []
+        for distance, pk in nearest:
+            # Skip posts deleted since the candidates were read
+            if pk in posts:
+                posts[pk].distance = distance
+                result.append(posts[pk])
+        return result
+
+    def in_bounding_box(self, viewer, min_lat, min_long, max_lat, max_long, limit=None):
+        """ Visible posts inside a bounding box, newest first, heap merged across the shards """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_NEARBY_LIMIT', 100)
+        streams = [self.visible_to(viewer, alias).filter(
+            latitude__range=(min_lat, max_lat),
+            longitude__range=(min_long, max_long),
+        ).order_by('-created_time', '-id')[:limit] for alias in sharding.aliases()]
+        merged = heapq.merge(*streams, key=lambda post: (post.created_time, post.pk), reverse=True)
+        return list(islice(merged, limit))
 
     def post_detail(self, post):
-        return PostAction.objects.select_related('user', 'post').filter(post=post)
+        actions = PostAction.objects.using(sharding.shard_for_post(post)).filter(post=post)
+        if sharding.is_sharded():
+            # Users live on the default database, no join to them
+            return actions.select_related('post')
+        return actions.select_related('user', 'post')
+
+    def remove_actions(self, post, user, action_type):
+        """ Delete the actions of a type by user on post, the signals keep the counters right """
+        actions = list(PostAction.objects.using(sharding.shard_for_post(post)).filter(
+            post=post, user=user, action_type=action_type))
+        for action in actions:
+            action.delete()
+        return len(actions)
+
+    def adjust_counter(self, post_id, action_type, delta):
+        """ Atomically move the counter of an action type on a post by delta """
+        field = ACTION_COUNTERS.get(action_type)
+        if field is None:
+            return 0
+        value = F(field) + delta
+        if delta < 0:
+            # A counter drifted below its rows must not break the delete
+            value = Greatest(value, Value(0))
+        return self.using(sharding.shard_for_post(post_id)).filter(pk=post_id).update(**{field: value})
 
-    
 
 class FacebookPost(models.Model):
     # Contains in data an array of objects, each with the name and Facebook id of the user
@@ -320,14 +787,206 @@ class FacebookPost(models.Model):
     place_long = models.CharField(max_length=10, null=True, help_text='Location associated with a Post, if any lattitude')
 
     place_lat = models.CharField(max_length=10, null=True, help_text='Location associated with a Post, if any longitude')
+    latitude = models.FloatField(null=True, blank=True, help_text='Parsed place_lat')
+    longitude = models.FloatField(null=True, blank=True, help_text='Parsed place_long')
+    geohash = models.CharField(max_length=12, null=True, blank=True, db_index=True,
+                               help_text='Geohash cell of the post location')
+    fanned_out = models.BooleanField(default=False, db_index=True,
+                                     help_text='Whether the post has been pushed to the friends timelines')
+    like_count = models.PositiveIntegerField(default=0, help_text='Number of likes on the post')
+    share_count = models.PositiveIntegerField(default=0, help_text='Number of shares of the post')
+    comment_count = models.PositiveIntegerField(default=0, help_text='Number of comments on the post')
+    media_ready = models.BooleanField(default=True, help_text='False while an uploaded picture or video is processed')
     objects = PostManager()
     class Meta:
         verbose_name = 'Facebook post'
         verbose_name_plural = 'Facebook posts'
+        indexes = [
+            models.Index(fields=['owner', '-created_time'], name='post_owner_created_idx'),
+            models.Index(fields=['owner', 'privacy', '-created_time'], name='post_owner_privacy_idx'),
+            models.Index(fields=['latitude', 'longitude'], name='post_lat_long_idx'),
+        ]
 
     def __unicode__(self):
         return self.message or self.story
 
+    def update_location(self):
+        """ Derive the numeric coordinates and geohash from place_lat/place_long """
+        self.latitude = geo.parse_coordinate(self.place_lat, 90)
+        self.longitude = geo.parse_coordinate(self.place_long, 180)
+        if self.latitude is None or self.longitude is None:
+            self.latitude = self.longitude = self.geohash = None
+        else:
+            self.geohash = geo.encode(self.latitude, self.longitude)
+
+    def save(self, *args, **kwargs):
+        self.update_location()
+        if self.pk is None and sharding.is_sharded():
+            # The id has to name the shard of the owner
+            self.pk = sharding.allocate_post_ids(self.owner_id)[0]
+            kwargs['force_insert'] = True
+        if sharding.is_sharded():
+            # Manager.create passes the default alias, the shard wins
+            kwargs['using'] = sharding.shard_of(self)
+        super(FacebookPost, self).save(*args, **kwargs)
+
+
+class TimelineManager(models.Manager):
+    """ Timeline manager """
+
+    def fan_out(self, post):
+        """ Push a post to the timelines of its owner and the owner's friends """
+        if sharding.is_sharded():
+            # Sharded walls are gathered from the shards on read
+            return False
+        threshold = getattr(settings, 'FACEBOOK_FAN_OUT_THRESHOLD', 5000)
+        recipients = list(Friend.objects.filter(from_user=post.owner_id).values_list('to_user', flat=True))
+        if len(recipients) > threshold:
+            # High-degree author, friends pull the post in wall_post instead
+            return False
+
+        recipients.append(post.owner_id)
+        with transaction.atomic():
+            TimelineEntry.objects.bulk_create([
+                TimelineEntry(user_id=user_id, post_id=post.pk, created_time=post.created_time)
+                for user_id in recipients
+            ])
+            FacebookPost.objects.filter(pk=post.pk).update(fanned_out=True)
+        post.fanned_out = True
+        return True
+
+
+    def fan_in(self, user_id, friend_id, limit=None):
+        """ Push the recent posts of a new friend to the timeline of user_id """
+        return self.fan_in_many([(user_id, friend_id)], limit)
+
+    def fan_in_many(self, pairs, limit=None):
+        """
+        Push the recent posts of new friends to timelines, pairs are (user_id, friend_id).
+
+        The newest posts of every friend are read with one query per chunk
+        of friends, the entries already present with one query per chunk of
+        posts, and the missing ones are inserted together.
+        """
+        if sharding.is_sharded() or not pairs:
+            return 0
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_FAN_IN_LIMIT', 200)
+        recipients = defaultdict(set)
+        for user_id, friend_id in pairs:
+            recipients[friend_id].add(user_id)
+
+        # Posts of high-degree authors were never fanned out, wall_post pulls them
+        newest = FacebookPost.objects.filter(owner=OuterRef('owner'), fanned_out=True) \
+            .order_by('-created_time', '-id').values('pk')[:limit]
+        posts = []
+        for owners in chunked(list(recipients), 900):
+            posts.extend(FacebookPost.objects.filter(owner__in=owners, fanned_out=True, pk__in=Subquery(newest))
+                         .values_list('pk', 'owner', 'created_time'))
+
+        users = set(user_id for user_id, _ in pairs)
+        present = set()
+        for chunk in chunked([pk for pk, _, _ in posts], 900):
+            present.update(TimelineEntry.objects.filter(user__in=users, post__in=chunk)
+                           .values_list('user', 'post'))
+        entries = [TimelineEntry(user_id=user_id, post_id=pk, created_time=created_time)
+                   for pk, owner_id, created_time in posts
+                   for user_id in recipients[owner_id] if (user_id, pk) not in present]
+        TimelineEntry.objects.bulk_create(entries)
+        return len(entries)
+
+    def unfriend(self, user_id, friend_id):
+        """ Take the posts of an ex-friend off the timeline of user_id """
+        return TimelineEntry.objects.filter(user=user_id, post__owner=friend_id).delete()[0]
+
+
+class TimelineEntry(models.Model):
+    """ Model to represent a post materialized on a user's timeline """
+    user = models.ForeignKey(User, related_name='timeline_entries')
+    post = models.ForeignKey(FacebookPost, related_name='timeline_entries')
+    created_time = models.DateTimeField()
+
+    objects = TimelineManager()
+
+    class Meta:
+        verbose_name = 'Timeline entry'
+        verbose_name_plural = 'Timeline entries'
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-created_time'], name='timeline_user_created_idx'),
+        ]
+
+    def __unicode__(self):
+        return "Post #%s on timeline of #%s" % (self.post_id, self.user_id)
+
+
+class IdSequence(models.Model):
+    """ Model to represent a global id sequence of a sharded table, on the default database """
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Id sequence'
+        verbose_name_plural = 'Id sequences'
+
+    def __unicode__(self):
+        return "%s at %s" % (self.name, self.value)
+
+
+class TrendingManager(models.Manager):
+    """ Trending manager """
+
+    def store(self, source, scores, limit=None):
+        """ Replace the snapshot of source with the public posts among [(post_id, score), ...] """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_TRENDING_SIZE', 50)
+        public = FacebookPost.objects.get_posts([post_id for post_id, _ in scores], privacy=PUBLIC)
+        now = timezone.now()
+        rows = [TrendingPost(source=source, post_id=post_id, score=score, created=now)
+                for post_id, score in scores if post_id in public][:limit]
+        window = getattr(settings, 'FACEBOOK_TRENDING_WINDOW_SECONDS', 3600)
+        with transaction.atomic():
+            # Snapshots of processes gone for a whole window go too
+            TrendingPost.objects.filter(Q(source=source) |
+                                        Q(created__lt=now - timedelta(seconds=window))).delete()
+            TrendingPost.objects.bulk_create(rows)
+        return len(rows)
+
+    def trending(self, limit=None):
+        """ Public posts by score summed over the recent snapshots, highest first """
+        if limit is None:
+            limit = getattr(settings, 'FACEBOOK_TRENDING_SIZE', 50)
+        since = timezone.now() - timedelta(seconds=getattr(settings, 'FACEBOOK_TRENDING_WINDOW_SECONDS', 3600))
+        scores = list(TrendingPost.objects.filter(created__gte=since).values_list('post').annotate(
+            total=Sum('score')).order_by('-total', 'post')[:limit])
+        posts = FacebookPost.objects.get_posts([post_id for post_id, _ in scores], privacy=PUBLIC)
+        results = []
+        for post_id, score in scores:
+            # Deleted, or no longer public, since the snapshot
+            if post_id in posts:
+                posts[post_id].score = score
+                results.append(posts[post_id])
+        return results
+
+
+class TrendingPost(models.Model):
+    """ Model to represent a post in the trending snapshot of one process """
+    source = models.CharField(max_length=100)
+    # The post may live on another shard
+    post = models.ForeignKey(FacebookPost, related_name='+', db_constraint=False)
+    score = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = TrendingManager()
+
+    class Meta:
+        verbose_name = 'Trending post'
+        verbose_name_plural = 'Trending posts'
+        unique_together = ('source', 'post')
+
+    def __unicode__(self):
+        return "Post #%s scored %s by %s" % (self.post_id, self.score, self.source)
+
 
 class PostAction(models.Model):
     action_type = models.CharField(max_length=10, db_index=True, choices=ACTION)
@@ -342,6 +1001,50 @@ class PostAction(models.Model):
     def __unicode__(self):
         return self.user
 
+    def save(self, *args, **kwargs):
+        if sharding.is_sharded():
+            kwargs['using'] = sharding.shard_of(self)
+        super(PostAction, self).save(*args, **kwargs)
+
+
+class MediaUpload(models.Model):
+    """ Model to represent a resumable chunked upload of a post picture or video """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, related_name='media_uploads')
+    # The post may live on another shard
+    post = models.ForeignKey(FacebookPost, related_name='media_uploads', db_constraint=False)
+    field = models.CharField(max_length=10, choices=MEDIA_FIELD)
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=UPLOAD_STATUS, default='pending')
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Media upload'
+        verbose_name_plural = 'Media uploads'
+
+    def __unicode__(self):
+        return "Upload %s of post #%s" % (self.pk, self.post_id)
+
+
+class MediaVariant(models.Model):
+    """ Model to represent a thumbnail or resized copy of a post picture or video """
+    # The post may live on another shard
+    post = models.ForeignKey(FacebookPost, related_name='media_variants', db_constraint=False)
+    name = models.CharField(max_length=20)
+    file = models.FileField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = 'Media variant'
+        verbose_name_plural = 'Media variants'
+        unique_together = ('post', 'name')
+
+    def __unicode__(self):
+        return "%s of post #%s" % (self.name, self.post_id)
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User)
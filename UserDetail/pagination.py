@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from UserDetail import fastpath
+from UserDetail.instrumentation import serializing
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque cursor pagination over (ordering_field, id), newest first.
+
+    Every page is a range scan starting right after the last row of the
+    previous page, so deep pages cost the same as the first one.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, ordering_field=None):
+        self.ordering_field = ordering_field
+        self.page_size = getattr(settings, 'FACEBOOK_PAGE_SIZE', 50)
+        self.max_page_size = getattr(settings, 'FACEBOOK_MAX_PAGE_SIZE', 500)
+
+    @classmethod
+    def requested(cls, request):
+        """ Pagination is opt-in, clients ask for it with a cursor or a page size """
+        return cls.cursor_query_param in request.query_params or \
+            cls.page_size_query_param in request.query_params
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        if self.ordering_field:
+            queryset = queryset.order_by('-%s' % self.ordering_field, '-id')
+        else:
+            queryset = queryset.order_by('-id')
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.last = rows[-1] if rows else None
+        return rows
+
+    def paginate_ranked(self, rank, request, page_size=None):
+        """
+        A page of the rows rank(position, page_size) picks out of the rows after the cursor.
+
+        Ranked rows are not in cursor order, the next cursor points past the
+        oldest row of the page and the rows older than it are ranked again
+        for the next one.
+        """
+        self.request = request
+        if page_size is None:
+            page_size = self.get_page_size(request)
+        rows = rank(self.decode_cursor(request), page_size)
+        self.has_next = len(rows) == page_size
+        self.last = min(rows, key=lambda row: (getattr(row, self.ordering_field), row.pk)) if rows else None
+        return rows
+
+    def after(self, position):
+        """ Filter selecting the rows strictly after the cursor position """
+        value, pk = position
+        if not self.ordering_field:
+            return Q(id__lt=pk)
+        return Q(**{'%s__lt' % self.ordering_field: value}) | \
+            Q(**{self.ordering_field: value, 'id__lt': pk})
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            value, pk = raw.rsplit('|', 1)
+            pk = int(pk)
+            if self.ordering_field:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError(raw)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def encode_cursor(self, row):
+        if isinstance(row, dict):
+            value, pk = row.get(self.ordering_field), row['id']
+        else:
+            value, pk = getattr(row, self.ordering_field, None), row.pk
+        value = value.isoformat() if self.ordering_field else ''
+        raw = '%s|%s' % (value, pk)
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+def paginated_response(request, queryset, serializer_class, ordering_field=None):
+    """ Serialize a list queryset, paginated when the client asks for it """
+    fast = fastpath.enabled() and fastpath.supports(serializer_class)
+    if fast:
+        keys = set(fastpath.columns(serializer_class))
+        keys.update(['id', ordering_field] if ordering_field else ['id'])
+        queryset = queryset.values(*keys)
+
+    def render(rows):
+        with serializing():
+            if fast:
+                return fastpath.render_rows(rows, serializer_class)
+            return serializer_class(rows, many=True).data
+
+    if not KeysetPagination.requested(request):
+        return Response(render(queryset))
+
+    paginator = KeysetPagination(ordering_field)
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(render(page))
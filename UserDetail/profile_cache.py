@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+VERSION_KEY = 'userdetail:profile-version:%s'
+PAYLOAD_KEY = 'userdetail:profile:%s:%s%s'
+
+
+def timeout():
+    return getattr(settings, 'FACEBOOK_PROFILE_CACHE_TIMEOUT', 3600)
+
+
+def current_version(pk, create=True):
+    """ (version, last modified timestamp) of a profile, started on first use unless create is False """
+    state = cache.get(VERSION_KEY % pk)
+    if state is None and create:
+        state = new_version(pk)
+    return state
+
+
+def new_version(pk):
+    now = time.time()
+    previous = cache.get(VERSION_KEY % pk)
+    # Last-Modified has whole seconds, a second write within one second moves
+    # it a second on so clients holding the first one don't get a 304
+    modified = int(now) if previous is None else max(int(now), previous[1] + 1)
+    state = ('%x' % int(now * 1000000), modified)
+    cache.set(VERSION_KEY % pk, state, timeout())
+    return state
+
+
+def forget(pk):
+    """ Drop the version of a profile, the next request loads it from the database """
+    cache.delete(VERSION_KEY % pk)
+
+
+def invalidate(*pks):
+    """ Move profiles to a new version, orphaning their cached payloads """
+    for pk in pks:
+        new_version(pk)
+
+
+def variant_key(sparse):
+    """ Short stable key of a sparse fieldset, payloads and etags differ per variant """
+    fields, nested, expand = sparse
+    raw = '%s|%s|%s' % (','.join(fields), ','.join('%s.%s' % (relation, ','.join(sorted(subs)))
+                                                   for relation, subs in sorted(nested.items())), ','.join(expand))
+    return ':' + hashlib.md5(raw.encode('utf-8')).hexdigest()[:12]
+
+
+def etag(pk, version, variant=''):
+    return quote_etag('%s-%s%s' % (pk, version, variant.replace(':', '-')))
+
+
+def not_modified(request, pk, variant=''):
+    """
+    Whether the client copy of the profile is current, answered from the cache.
+
+    Profiles without a version are loaded first, so a missing profile gets
+    its 404 instead of a 304. If-None-Match: * checks the profile exists.
+    """
+    state = current_version(pk, create=False)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            from UserDetail.models import UserProfile
+            return UserProfile.objects.filter(pk=pk).exists()
+        return state is not None and etag(pk, state[0], variant) in parse_etags(if_none_match)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return state is not None and if_modified_since is not None and state[1] <= if_modified_since
+
+
+def cached_payload(pk, loader, variant=''):
+    """ Serialized profile of the current version, built with loader on a miss """
+    version, modified = current_version(pk)
+    key = PAYLOAD_KEY % (pk, version, variant)
+    payload = cache.get(key)
+    if payload is None:
+        try:
+            payload = loader()
+        except Exception:
+            # Keep no version for a profile that can't be loaded
+            forget(pk)
+            raise
+        cache.set(key, payload, timeout())
+    return payload, version, modified
+
+
+def set_validators(response, pk, version, modified, variant=''):
+    response['ETag'] = etag(pk, version, variant)
+    response['Last-Modified'] = http_date(modified)
+    return response
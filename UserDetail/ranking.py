@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import math
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AFFINITY_KEY = 'userdetail:affinity:%s'
+
+# Columns of the feature matrix, in order
+FEATURES = ('recency', 'affinity', 'engagement', 'picture', 'video', 'link')
+TYPE_FEATURES = (('picture', 'PIC'), ('video', 'VID'), ('link', 'URL'))
+# Post fields the features are computed from
+COLUMNS = ('created_time', 'owner', 'like_count', 'comment_count', 'share_count', 'post_type')
+DEFAULT_WEIGHTS = {'recency': 1.0, 'affinity': 1.0, 'engagement': 0.5, 'picture': 0.1, 'video': 0.1, 'link': 0.0}
+
+
+def weights():
+    configured = getattr(settings, 'FACEBOOK_FEED_WEIGHTS', DEFAULT_WEIGHTS)
+    return [float(configured.get(name, 0.0)) for name in FEATURES]
+
+
+def half_life():
+    return getattr(settings, 'FACEBOOK_FEED_HALF_LIFE_HOURS', 24) * 3600.0
+
+
+def load_affinity(user_id):
+    """ (sorted author ids, affinities in [0, 1]) from the actions of user_id on their posts """
+    from UserDetail import sharding
+    from UserDetail.models import PostAction
+
+    counts = Counter()
+    for alias in sharding.aliases():
+        # An action lives on the shard of its post, so the join stays on one shard
+        counts.update(dict(PostAction.objects.using(alias).filter(user=user_id).exclude(post__owner=user_id)
+                           .values_list('post__owner').annotate(total=Count('id')).order_by()))
+    if not counts:
+        return [], []
+    scale = math.log1p(max(counts.values()))
+    authors = sorted(counts)
+    return authors, [math.log1p(counts[author]) / scale for author in authors]
+
+
+def affinity(user_id):
+    """ Affinity vector of user_id, cached for FACEBOOK_FEED_AFFINITY_TIMEOUT seconds """
+    vector = cache.get(AFFINITY_KEY % user_id)
+    if vector is None:
+        vector = load_affinity(user_id)
+        cache.set(AFFINITY_KEY % user_id, vector, getattr(settings, 'FACEBOOK_FEED_AFFINITY_TIMEOUT', 600))
+    return vector
+
+
+def invalidate_affinity(*user_ids):
+    """ Drop the cached vectors of users whose post actions changed """
+    cache.delete_many([AFFINITY_KEY % user_id for user_id in user_ids])
+
+
+def columns(posts, now=None):
+    """ Raw feature columns of the candidate posts """
+    now = now or timezone.now()
+    return {
+        'age': [(now - post.created_time).total_seconds() for post in posts],
+        'owner': [post.owner_id for post in posts],
+        'engagement': [post.like_count + post.comment_count + post.share_count for post in posts],
+        'post_type': [post.post_type for post in posts],
+    }
+
+
+def scores(data, vector):
+    """
+    Score every candidate in one pass, the dot product of its features and the weights.
+
+    Recency halves every FACEBOOK_FEED_HALF_LIFE_HOURS, affinity comes from
+    vector, engagement is log scaled against the most engaged candidate and
+    the post type is one-hot.
+    """
+    authors, affinities = vector
+    if numpy is None:
+        return python_scores(data, authors, affinities)
+    if not data['owner']:
+        return numpy.zeros(0)
+    recency = numpy.exp2(-numpy.maximum(numpy.asarray(data['age'], dtype=float), 0.0) / half_life())
+    owners = numpy.asarray(data['owner'], dtype=numpy.int64)
+    affinity = numpy.zeros(len(owners))
+    if authors:
+        authors = numpy.asarray(authors, dtype=numpy.int64)
+        index = numpy.minimum(numpy.searchsorted(authors, owners), len(authors) - 1)
+        known = authors[index] == owners
+        affinity[known] = numpy.asarray(affinities, dtype=float)[index[known]]
+    engagement = numpy.log1p(numpy.asarray(data['engagement'], dtype=float))
+    if engagement.max() > 0:
+        engagement /= engagement.max()
+    post_types = numpy.asarray(data['post_type'], dtype=object)
+    matrix = numpy.column_stack([recency, affinity, engagement] +
+                                [(post_types == post_type).astype(float) for _, post_type in TYPE_FEATURES])
+    return matrix.dot(numpy.asarray(weights()))
+
+
+def python_scores(data, authors, affinities):
+    """ scores() without numpy, one candidate at a time """
+    weight = dict(zip(FEATURES, weights()))
+    lookup = dict(zip(authors, affinities))
+    top = max([math.log1p(value) for value in data['engagement']] or [0.0])
+    results = []
+    for age, owner, engagement, post_type in zip(data['age'], data['owner'], data['engagement'], data['post_type']):
+        score = weight['recency'] * 2 ** (-max(age, 0.0) / half_life())
+        score += weight['affinity'] * lookup.get(owner, 0.0)
+        score += weight['engagement'] * (math.log1p(engagement) / top if top > 0 else 0.0)
+        score += sum(weight[name] for name, value in TYPE_FEATURES if value == post_type)
+        results.append(score)
+    return results
+
+
+def top(values, limit):
+    """ Positions of the limit best scores, best first, ties in candidate order """
+    if numpy is None or not isinstance(values, numpy.ndarray):
+        return sorted(range(len(values)), key=lambda index: (-values[index], index))[:limit]
+    if limit < len(values):
+        chosen = numpy.argpartition(-values, limit - 1)[:limit]
+    else:
+        chosen = numpy.arange(len(values))
+    return chosen[numpy.lexsort((chosen, -values[chosen]))].tolist()
+
+
+def rank(user_id, posts, limit, now=None):
+    """ The limit best candidate posts for user_id, each with its score """
+    posts = list(posts)
+    values = scores(columns(posts, now), affinity(user_id))
+    ranked = []
+    for index in top(values, limit):
+        posts[index].score = float(values[index])
+        ranked.append(posts[index])
+    return ranked
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import math
+import threading
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Mersenne prime and multipliers of the two base hashes
+PRIME = (1 << 61) - 1
+HASH_A = 0x5bd1e9955bd1e995 % PRIME
+HASH_B = 0x9e3779b97f4a7c15 % PRIME
+
+# Smallest filter of a user, in bits
+MIN_BITS = 64
+
+# Shared by the workers: the generation counter of a relation, the
+# generation of its last bulk change and of the last edge of each user
+GENERATION_KEY = 'userdetail:relation:%s:generation'
+RESET_KEY = 'userdetail:relation:%s:reset'
+CHANGED_KEY = 'userdetail:relation:%s:changed:%s'
+
+
+def load_follow_edges():
+    """ (follower, followee) of every follow, grouped by follower """
+    from UserDetail.models import Follow
+    return Follow.objects.order_by('follower').values_list('follower', 'followee').iterator()
+
+
+def load_friend_edges():
+    """ (user, friend) of every friendship, grouped by user """
+    from UserDetail.models import Friend
+    return Friend.objects.order_by('to_user').values_list('to_user', 'from_user').iterator()
+
+
+def filter_shape(count, error_rate):
+    """ (bits, hashes) of a bloom filter holding count keys at error_rate """
+    bits = int(math.ceil(-count * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(-math.log(error_rate, 2))))
+    return max(MIN_BITS, bits), hashes
+
+
+class EdgeFilter(object):
+    """
+    Per-user bloom filters over the edges of a relation, used as a negative cache.
+
+    might_contain(user, other) is False only when user has no edge to other,
+    True means the table has to be asked. The filters of a process are built
+    from the tables, started by build_in_thread when the application loads,
+    and rebuilt every FACEBOOK_RELATION_FILTER_REBUILD_SECONDS. Until the
+    first build, and while a rebuild is due, every check answers True.
+
+    Every saved edge bumps a generation counter in the cache shared by the
+    workers and records it as the last change of its user. A user changed
+    at a generation the local filters were not built from, by another
+    worker, is answered True until the next rebuild, so an edge saved
+    anywhere is never a definite negative. Deleted edges stay in the filters
+    until the next rebuild, as false positives.
+    """
+
+    def __init__(self, loader, error_rate=None, interval=None, name='edges'):
+        self.loader = loader
+        self.name = name
+        self.error_rate = error_rate or getattr(settings, 'FACEBOOK_RELATION_FILTER_ERROR_RATE', 0.01)
+        self.interval = interval if interval is not None else \
+            getattr(settings, 'FACEBOOK_RELATION_FILTER_REBUILD_SECONDS', 300)
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        with self.lock:
+            self.reset()
+
+    def reset(self):
+        self.filters = None
+        self.built = 0
+        self.generation = None
+        self.published = {}
+        self.pending = None
+        self.checks = 0
+        self.negatives = 0
+
+    def clear(self):
+        """ Drop the filters of every worker after edges were saved in bulk, checks answer True until rebuilt """
+        with self.lock:
+            self.reset()
+        cache.set(RESET_KEY % self.name, self.bump(), None)
+
+    def bump(self):
+        """ The next generation of the relation """
+        key = GENERATION_KEY % self.name
+        # A counter created again starts past every generation of the lost one
+        start = int(time.time() * 1000)
+        if cache.add(key, start, None):
+            # Filters built from a lost counter are stale
+            cache.set(RESET_KEY % self.name, start, None)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Evicted in between
+            return self.bump()
+
+    def publish(self, user_id):
+        """ Record a new edge of user_id for every worker """
+        generation = self.bump()
+        # Kept while a filter built before it may still answer
+        cache.set(CHANGED_KEY % (self.name, user_id), generation, self.interval * 2)
+        with self.lock:
+            self.published[user_id] = generation
+
+    def current(self, user_id):
+        """ Whether the filters still hold every edge of user_id saved by any worker """
+        if self.generation is None:
+            return False
+        changes = cache.get_many([GENERATION_KEY % self.name, RESET_KEY % self.name,
+                                  CHANGED_KEY % (self.name, user_id)])
+        generation = changes.get(GENERATION_KEY % self.name)
+        if generation is None or generation < self.generation:
+            # The counter was lost, the generation of the filters means nothing
+            return False
+        if changes.get(RESET_KEY % self.name, 0) > self.generation:
+            return False
+        changed = changes.get(CHANGED_KEY % (self.name, user_id))
+        # The last change of the user is either older than the filters or an edge this process inserted
+        return changed is None or changed <= self.generation or changed == self.published.get(user_id)
+
+    @staticmethod
+    def positions(other_id, bits, hashes):
+        first = (HASH_A * other_id) % PRIME
+        step = (HASH_B * other_id) % PRIME | 1
+        return [(first + index * step) % bits for index in range(hashes)]
+
+    def insert(self, filters, user_id, other_id, capacity=1):
+        entry = filters.get(user_id)
+        if entry is None:
+            bits, hashes = filter_shape(capacity, self.error_rate)
+            entry = filters[user_id] = (bytearray((bits + 7) // 8), hashes)
+        data, hashes = entry
+        for position in self.positions(other_id, len(data) * 8, hashes):
+            data[position >> 3] |= 1 << (position & 7)
+
+    def build(self):
+        """ Filters of every user with edges, each sized for its degree """
+        filters = {}
+        for user_id, edges in groupby(self.loader(), key=lambda edge: edge[0]):
+            others = [other_id for _, other_id in edges]
+            for other_id in others:
+                self.insert(filters, user_id, other_id, len(others))
+        return filters
+
+    def rebuild(self):
+        """ Replace the filters with fresh ones, edges added meanwhile are replayed """
+        with self.lock:
+            self.pending = []
+        try:
+            # Read before the edges, any later change is newer than the filters
+            generation = cache.get(GENERATION_KEY % self.name)
+            if generation is None:
+                generation = self.bump()
+            filters = self.build()
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            for user_id, other_id in self.pending:
+                self.insert(filters, user_id, other_id)
+            self.filters, self.pending, self.built = filters, None, time.time()
+            self.generation = generation
+            self.published = dict((user_id, published) for user_id, published in self.published.items()
+                                  if published > generation)
+
+    def rebuild_in_thread(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('Relation filter rebuild failed, keeping the previous filters')
+        finally:
+            self.build_lock.release()
+            connections.close_all()
+
+    def refresh(self):
+        """ Build the filters on a thread, the current ones keep serving meanwhile """
+        if not self.build_lock.acquire(False):
+            # Another thread is building
+            return
+        thread = threading.Thread(target=self.rebuild_in_thread)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, user_id, other_id):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((user_id, other_id))
+            if self.filters is not None:
+                self.insert(self.filters, user_id, other_id)
+        self.publish(user_id)
+        # Again once committed, a filter built in between must not count it as seen
+        transaction.on_commit(lambda: self.publish(user_id))
+
+    def might_contain(self, user_id, other_id):
+        if not getattr(settings, 'FACEBOOK_RELATION_FILTER', True):
+            return True
+        if self.filters is None:
+            # Not built yet, never built inside a request
+            return True
+        if time.time() - self.built >= self.interval:
+            self.refresh()
+            return True
+        if not self.current(user_id):
+            return True
+        with self.lock:
+            if self.filters is None:
+                return True
+            self.checks += 1
+            entry = self.filters.get(user_id)
+            if entry is not None:
+                data, hashes = entry
+                if all(data[position >> 3] & (1 << (position & 7))
+                       for position in self.positions(other_id, len(data) * 8, hashes)):
+                    return True
+            self.negatives += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            filters = self.filters or {}
+            return {
+                'users': len(filters),
+                'bytes': sum(len(data) for data, _ in filters.values()),
+                'checks': self.checks,
+                'negatives': self.negatives,
+                'age': time.time() - self.built if self.filters is not None else None,
+            }
+
+
+follow_filter = EdgeFilter(load_follow_edges, name='follow')
+friend_filter = EdgeFilter(load_friend_edges, name='friend')
+
+
+def build_in_thread():
+    """ Start building the filters of this process, run when the application loads """
+    if getattr(settings, 'FACEBOOK_RELATION_FILTER', True):
+        follow_filter.refresh()
+        friend_filter.refresh()
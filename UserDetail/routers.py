@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import functools
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from UserDetail import sharding
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+STICKY_COOKIE = 'replica_pin'
+
+# A session written by a login must be readable by the very next request
+PRIMARY_APPS = ('sessions',)
+
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'FACEBOOK_REPLICAS', [])
+
+
+@contextmanager
+def read_only():
+    """ Reads of the enclosed block may be served by a replica """
+    previous = getattr(_state, 'read_only', False)
+    _state.read_only = True
+    try:
+        yield
+    finally:
+        _state.read_only = previous
+
+
+def request_state(state=None):
+    """ Routing state of the request running on this thread, saved into state for its work on other threads """
+    state = {} if state is None else state
+    state['read_only'], state['wrote'] = getattr(_state, 'read_only', False), getattr(_state, 'wrote', False)
+    return state
+
+
+@contextmanager
+def bound_request_state(state):
+    """ Route the enclosed block like the request state was taken from, keep its writes in state """
+    previous = request_state()
+    _state.read_only, _state.wrote = state.get('read_only', False), state.get('wrote', False)
+    wrote = state.get('wrote', False)
+    try:
+        yield
+    finally:
+        request_state(state)
+        # Concurrent calls of one request share state, none undoes a write
+        state['wrote'] = state['wrote'] or wrote
+        _state.read_only, _state.wrote = previous['read_only'], previous['wrote']
+
+
+def replica_reads(method):
+    """ Decorate a manager method that only reads """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with read_only():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter(object):
+    """
+    Send reads to the FACEBOOK_REPLICAS aliases and writes to the primary.
+
+    Only reads made under read_only(), in a safe request or a @replica_reads
+    manager method, leave the primary. Once the thread writes, or inside a
+    transaction, its reads stay on the primary so they see its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or not getattr(_state, 'read_only', False) or getattr(_state, 'wrote', False):
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label in PRIMARY_APPS:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = set(replicas())
+        aliases.add(DEFAULT_DB_ALIAS)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary, never migrated on their own
+        if db in replicas():
+            return False
+        return None
+
+
+class ShardRouter(object):
+    """
+    Route FacebookPost and PostAction instances to the shard of the post owner.
+
+    Querysets carry no instance, the PostManager methods pick their shard
+    with using(). Everything else is left to the next router.
+    """
+    sharded_models = ('userdetail.facebookpost', 'userdetail.postaction')
+
+    def db_for_read(self, model, **hints):
+        if not sharding.is_sharded() or model._meta.label_lower not in self.sharded_models:
+            return None
+        instance = hints.get('instance')
+        return sharding.shard_of(instance) if instance is not None else None
+
+    def db_for_write(self, model, **hints):
+        alias = self.db_for_read(model, **hints)
+        if alias is not None:
+            _state.wrote = True
+        return alias
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Posts reference users on the default database
+        if not sharding.is_sharded():
+            return None
+        known = set(sharding.aliases())
+        known.add(DEFAULT_DB_ALIAS)
+        if obj1._state.db in known and obj2._state.db in known:
+            return True
+        return None
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+    Let the reads of safe requests go to the replicas.
+
+    A request that writes sets a cookie pinning the client's reads to the
+    primary for FACEBOOK_REPLICA_STICKY_SECONDS, so a client always reads its
+    own writes even while the replicas lag behind.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            if token is not None:
+                self.stop(token)
+            raise
+        return self.finish(request, response, token)
+
+    def start(self, request):
+        """ Set the routing state of a request, returns what finish needs """
+        if not replicas():
+            return None
+        # Requests dispatched from inside another request keep their own state
+        outer = (getattr(_state, 'read_only', False), getattr(_state, 'wrote', False))
+        _state.read_only = request.method in SAFE_METHODS and STICKY_COOKIE not in request.COOKIES
+        _state.wrote = False
+        return outer
+
+    def stop(self, token):
+        """ Put back the state of the outer request, returns whether this one wrote """
+        wrote = _state.wrote
+        _state.read_only, _state.wrote = token
+        return wrote
+
+    def finish(self, request, response, token):
+        if token is None:
+            return response
+        wrote = self.stop(token)
+        if wrote or request.method not in SAFE_METHODS:
+            response.set_cookie(STICKY_COOKIE, '1', httponly=True,
+                                max_age=getattr(settings, 'FACEBOOK_REPLICA_STICKY_SECONDS', 5))
+        return response
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import heapq
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import Q
+
+from UserDetail import sharding
+
+FTS_TABLE = 'UserDetail_facebookpost_fts'
+FTS_FIELDS = ('message', 'caption', 'description', 'story')
+
+_fts_supported = {}
+
+
+def fts_available(using=None):
+    """ Whether the posts index can live in an FTS5 table on this connection """
+    conn = connections[using or DEFAULT_DB_ALIAS]
+    if conn.vendor != 'sqlite':
+        return False
+    if conn.alias not in _fts_supported:
+        with conn.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            _fts_supported[conn.alias] = ('ENABLE_FTS5',) in cursor.fetchall()
+    return _fts_supported[conn.alias]
+
+
+def create_index(using=None):
+    """ Create the FTS5 table, run after migrate """
+    if not fts_available(using):
+        return False
+    with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "%s" USING fts5(%s)'
+                       % (FTS_TABLE, ', '.join(FTS_FIELDS)))
+    return True
+
+
+def index_post(post):
+    """ Replace the indexed text of a post """
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM "%s" WHERE rowid = %%s' % FTS_TABLE, [post.pk])
+        cursor.execute('INSERT INTO "%s" (rowid, %s) VALUES (%%s, %s)'
+                       % (FTS_TABLE, ', '.join(FTS_FIELDS), ', '.join(['%s'] * len(FTS_FIELDS))),
+                       [post.pk] + [getattr(post, field) or '' for field in FTS_FIELDS])
+
+
+def remove_post(post_id):
+    """ Drop a post from the index """
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM "%s" WHERE rowid = %%s' % FTS_TABLE, [post_id])
+
+
+def match_expression(query):
+    """ FTS5 query matching every term of the user query, terms quoted as literals """
+    terms = [term.replace('"', '""') for term in query.split()]
+    return ' '.join('"%s"' % term for term in terms if term)
+
+
+def ranked_matches(query, offset, limit):
+    """ (post id, bm25 rank, snippet) of the best matches, best first """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT rowid, bm25("%s"), snippet("%s", -1, %%s, %%s, %%s, %%s) FROM "%s" '
+            'WHERE "%s" MATCH %%s ORDER BY bm25("%s") LIMIT %%s OFFSET %%s'
+            % (FTS_TABLE, FTS_TABLE, FTS_TABLE, FTS_TABLE, FTS_TABLE),
+            ['<b>', '</b>', '...', getattr(settings, 'FACEBOOK_SEARCH_SNIPPET_TOKENS', 12),
+             match_expression(query), limit, offset])
+        return cursor.fetchall()
+
+
+def search_posts(viewer, query, limit=None):
+    """
+    Posts visible to viewer matching query, best first.
+
+    Each post carries a rank (bm25, lower is better) and a highlighted
+    snippet. Without FTS5 this falls back to an unranked icontains scan.
+    """
+    from UserDetail.models import FacebookPost
+
+    if limit is None:
+        limit = getattr(settings, 'FACEBOOK_SEARCH_LIMIT', 50)
+    viewer = None if viewer.is_anonymous else viewer
+    if not match_expression(query):
+        return []
+
+    if not fts_available():
+        text = Q()
+        for field in FTS_FIELDS:
+            text |= Q(**{'%s__icontains' % field: query})
+        streams = [FacebookPost.objects.visible_to(viewer, alias).filter(text)
+                   .order_by('-created_time', '-id')[:limit] for alias in sharding.aliases()]
+        merged = heapq.merge(*streams, key=lambda post: (post.created_time, post.pk), reverse=True)
+        posts = list(islice(merged, limit))
+        for post in posts:
+            post.rank = None
+            post.snippet = None
+        return posts
+
+    # Privacy is applied after ranking, fetch matches in pages until the
+    # result is full, the matches run out or FACEBOOK_SEARCH_MAX_CANDIDATES
+    # were checked, a viewer who can see few of the matches then gets what
+    # was found. The index on the default database covers the posts of
+    # every shard.
+    posts = []
+    offset = 0
+    candidates = getattr(settings, 'FACEBOOK_SEARCH_MAX_CANDIDATES', 1000)
+    while len(posts) < limit and offset < candidates:
+        page = min(limit * 4, candidates - offset)
+        matches = ranked_matches(query, offset, page)
+        if not matches:
+            break
+        offset += page
+        allowed = {}
+        for alias, ids in sharding.group_by_shard([post_id for post_id, _, _ in matches],
+                                                  sharding.shard_for_post).items():
+            allowed.update(FacebookPost.objects.visible_to(viewer, alias).in_bulk(ids))
+        for post_id, rank, snippet in matches:
+            post = allowed.get(post_id)
+            if post is not None:
+                post.rank = rank
+                post.snippet = snippet
+                posts.append(post)
+    return posts[:limit]
@@ -1,6 +1,32 @@
+from django.conf import settings
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from UserDetail.models import UserProfile, FriendshipRequest, PostAction, FacebookPost, Follow, Friend
+from UserDetail.models import UserProfile, FriendshipRequest, PostAction, FacebookPost, Follow, Friend,\
+    FriendSuggestion, MediaUpload
+
+
+class ShardedPostField(serializers.PrimaryKeyRelatedField):
+    """ A post id, looked up on the shard the id belongs to """
+
+    def to_internal_value(self, data):
+        try:
+            return FacebookPost.objects.get_post(data)
+        except FacebookPost.DoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class SparseFieldsMixin(object):
+    """ Lets the caller keep only some fields with a fields=[...] argument """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
 
 class UserDetailSerializer(serializers.ModelSerializer):
     class Meta:
@@ -23,7 +49,54 @@ class FriendshipRequestSerializer(serializers.ModelSerializer):
                   'message')
 
 
+class BulkFriendshipRequestSerializer(serializers.Serializer):
+    action = serializers.ChoiceField(choices=('accept', 'reject', 'mark_viewed'))
+    ids = serializers.ListField(child=serializers.IntegerField())
+
+    def validate_ids(self, value):
+        limit = getattr(settings, 'FACEBOOK_BULK_REQUEST_LIMIT', 500)
+        if not value:
+            raise serializers.ValidationError("At least one request id is required")
+        if len(value) > limit:
+            raise serializers.ValidationError("At most %s request ids are allowed" % limit)
+        return value
+
+
+class RelationshipLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField())
+
+    def validate_ids(self, value):
+        limit = getattr(settings, 'FACEBOOK_RELATIONSHIP_LOOKUP_LIMIT', 5000)
+        if len(value) > limit:
+            raise serializers.ValidationError("At most %s user ids are allowed" % limit)
+        return value
+
+
+class SubRequestSerializer(serializers.Serializer):
+    id = serializers.CharField(required=False)
+    method = serializers.ChoiceField(choices=('GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE'),
+                                     default='GET')
+    path = serializers.RegexField(r'^/')
+    body = serializers.JSONField(required=False)
+    headers = serializers.DictField(child=serializers.CharField(), required=False)
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    requests = SubRequestSerializer(many=True)
+    parallel = serializers.BooleanField(default=False)
+
+    def validate_requests(self, value):
+        limit = getattr(settings, 'FACEBOOK_BATCH_LIMIT', 20)
+        if not value:
+            raise serializers.ValidationError("At least one sub-request is required")
+        if len(value) > limit:
+            raise serializers.ValidationError("At most %s sub-requests are allowed" % limit)
+        return value
+
+
 class PostActionSerializer(serializers.ModelSerializer):
+    post = ShardedPostField(queryset=FacebookPost.objects.all())
+
     class Meta:
         model = PostAction
         fields = ('action_type',
@@ -32,7 +105,7 @@ class PostActionSerializer(serializers.ModelSerializer):
                   'comments')
 
 
-class FacebookPostSerializer(serializers.ModelSerializer):
+class FacebookPostSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = FacebookPost
         fields = ('owner',
@@ -46,7 +119,104 @@ class FacebookPostSerializer(serializers.ModelSerializer):
                   'story',
                   'privacy',
                   'place_long',
-                  'place_lat')
+                  'place_lat',
+                  'like_count',
+                  'share_count',
+                  'comment_count')
+        read_only_fields = ('like_count',
+                            'share_count',
+                            'comment_count')
+
+
+class NearbyPostSerializer(FacebookPostSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta(FacebookPostSerializer.Meta):
+        fields = FacebookPostSerializer.Meta.fields + ('distance',)
+
+
+class SearchPostSerializer(FacebookPostSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta(FacebookPostSerializer.Meta):
+        fields = FacebookPostSerializer.Meta.fields + ('rank', 'snippet')
+
+
+class TrendingPostSerializer(FacebookPostSerializer):
+    score = serializers.IntegerField(read_only=True)
+
+    class Meta(FacebookPostSerializer.Meta):
+        fields = ('id',) + FacebookPostSerializer.Meta.fields + ('score',)
+
+
+class RankedPostSerializer(FacebookPostSerializer):
+    score = serializers.FloatField(read_only=True)
+
+    class Meta(FacebookPostSerializer.Meta):
+        fields = ('id',) + FacebookPostSerializer.Meta.fields + ('score',)
+
+
+class FeedQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(required=False, min_value=1,
+                                     max_value=getattr(settings, 'FACEBOOK_MAX_PAGE_SIZE', 500))
+
+
+class TrendingQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(required=False, min_value=1,
+                                     max_value=getattr(settings, 'FACEBOOK_TRENDING_SIZE', 50))
+
+
+class NearbyQuerySerializer(serializers.Serializer):
+    lat = serializers.FloatField(required=False, min_value=-90, max_value=90)
+    long = serializers.FloatField(required=False, min_value=-180, max_value=180)
+    radius = serializers.FloatField(required=False, min_value=0)
+    bbox = serializers.CharField(required=False)
+
+    def validate_bbox(self, value):
+        try:
+            min_lat, min_long, max_lat, max_long = [float(part) for part in value.split(',')]
+        except ValueError:
+            raise serializers.ValidationError("bbox must be min_lat,min_long,max_lat,max_long")
+        if min_lat > max_lat or min_long > max_long:
+            raise serializers.ValidationError("bbox minimums must not exceed its maximums")
+        return min_lat, min_long, max_lat, max_long
+
+    def validate(self, data):
+        if 'bbox' not in data and ('lat' not in data or 'long' not in data):
+            raise serializers.ValidationError("Either lat and long or bbox is required")
+        max_radius = getattr(settings, 'FACEBOOK_NEARBY_MAX_RADIUS', 50.0)
+        data['radius'] = min(data.get('radius', max_radius), max_radius)
+        return data
+
+
+class MediaUploadSerializer(serializers.ModelSerializer):
+    post = ShardedPostField(queryset=FacebookPost.objects.all())
+
+    class Meta:
+        model = MediaUpload
+        fields = ('id',
+                  'post',
+                  'field',
+                  'filename',
+                  'total_size',
+                  'received',
+                  'status')
+        read_only_fields = ('id',
+                            'received',
+                            'status')
+
+    def validate_filename(self, value):
+        value = value.replace('\\', '/').rsplit('/', 1)[-1]
+        if not value:
+            raise serializers.ValidationError("A file name is required")
+        return value
+
+    def validate_total_size(self, value):
+        limit = getattr(settings, 'FACEBOOK_UPLOAD_MAX_SIZE', 2 * 1024 ** 3)
+        if value <= 0 or value > limit:
+            raise serializers.ValidationError("Uploads must be between 1 and %s bytes" % limit)
+        return value
 
 
 class FollowSerializer(serializers.ModelSerializer):
@@ -62,3 +232,88 @@ class FriendSerializer(serializers.ModelSerializer):
         fields = ('from_user',
                   'to_user',
                   'created')
+
+
+class FriendSuggestionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FriendSuggestion
+        fields = ('suggested',
+                  'mutual_count',
+                  'created')
+
+
+class UserSummarySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ('id',
+                  'username',
+                  'first_name',
+                  'last_name')
+
+
+class SparseUserDetailSerializer(serializers.ModelSerializer):
+    """
+    UserDetailSerializer driven by ?fields= and ?expand=.
+
+    Relations render as ids unless expanded, a dotted field such as
+    user.first_name expands its relation and keeps only that field.
+    """
+    expansions = {
+        'user': UserSummarySerializer,
+        'cover_pic': FacebookPostSerializer,
+        'profile_pic': FacebookPostSerializer,
+    }
+
+    class Meta:
+        model = UserProfile
+        fields = UserDetailSerializer.Meta.fields
+
+    def __init__(self, *args, **kwargs):
+        fields, nested, expand = kwargs.pop('sparse')
+        super(SparseUserDetailSerializer, self).__init__(*args, **kwargs)
+        for name in expand:
+            self.fields[name] = self.expansions[name](read_only=True, fields=nested.get(name))
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def parse(cls, query_params):
+        """ (fields, nested fields, expanded relations) of a request, ValidationError on unknown names """
+        fields = []
+        nested = {}
+        expand = set(name for name in query_params.get('expand', '').split(',') if name)
+        for name in query_params.get('fields', '').split(','):
+            if not name:
+                continue
+            relation, _, sub = name.partition('.')
+            fields.append(relation)
+            if sub:
+                expand.add(relation)
+                nested.setdefault(relation, []).append(sub)
+
+        unknown = set(fields) - set(cls.Meta.fields)
+        unknown.update(expand - set(cls.expansions))
+        for relation, subs in nested.items():
+            if relation in cls.expansions:
+                unknown.update('%s.%s' % (relation, sub) for sub in set(subs) - set(cls.expansions[relation].Meta.fields))
+        if unknown:
+            raise serializers.ValidationError({'fields': ['Unknown fields: %s' % ', '.join(sorted(unknown))]})
+        return fields, nested, sorted(expand)
+
+    @classmethod
+    def queryset(cls, sparse):
+        """ UserProfile queryset loading only the columns the output needs """
+        fields, nested, expand = sparse
+        columns = list(fields or cls.Meta.fields)
+        for relation in expand:
+            if relation not in columns:
+                continue
+            related = nested.get(relation) or cls.expansions[relation].Meta.fields
+            columns.extend('%s__%s' % (relation, name) for name in related)
+        expand = [relation for relation in expand if relation in (fields or cls.Meta.fields)]
+        queryset = UserProfile.objects.only(*columns)
+        if expand:
+            # select_related() without arguments would follow every relation
+            queryset = queryset.select_related(*expand)
+        return queryset
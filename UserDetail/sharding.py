@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Max
+
+# Sequence name of the FacebookPost ids
+POST_SEQUENCE = 'facebookpost'
+
+
+def shard_map():
+    """ Database alias of each bucket, an alias may own several buckets """
+    return getattr(settings, 'FACEBOOK_SHARD_MAP', [DEFAULT_DB_ALIAS])
+
+
+def is_sharded():
+    return len(shard_map()) > 1
+
+
+def aliases():
+    return list(OrderedDict.fromkeys(shard_map()))
+
+
+def shard_for_owner(owner_id):
+    """ Shard holding the posts of owner_id, and the actions on them """
+    shards = shard_map()
+    return shards[int(getattr(owner_id, 'pk', owner_id)) % len(shards)]
+
+
+def shard_for_post(post_id):
+    """ Post ids are allocated in their owner's bucket, so they name their shard too """
+    shards = shard_map()
+    return shards[int(getattr(post_id, 'pk', post_id)) % len(shards)]
+
+
+def group_by_shard(keys, shard_for):
+    """ Split keys into {alias: [key, ...]} """
+    groups = OrderedDict()
+    for key in keys:
+        groups.setdefault(shard_for(key), []).append(key)
+    return groups
+
+
+def allocate_post_ids(owner_id, count=1):
+    """
+    Reserve count globally unique post ids in the bucket of owner_id.
+
+    A sequence row on the default database hands out blocks of numbers, id
+    = number * buckets + bucket, so every id maps back to its bucket.
+    """
+    from UserDetail.models import FacebookPost, IdSequence
+
+    buckets = len(shard_map())
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        updated = IdSequence.objects.using(DEFAULT_DB_ALIAS).filter(name=POST_SEQUENCE) \
+            .update(value=F('value') + count)
+        if not updated:
+            # Start past every post id in use, on any shard
+            highest = max([FacebookPost.objects.using(alias).aggregate(highest=Max('pk'))['highest'] or 0
+                           for alias in aliases()])
+            IdSequence.objects.using(DEFAULT_DB_ALIAS).create(name=POST_SEQUENCE,
+                                                              value=highest // buckets + 1 + count)
+        value = IdSequence.objects.using(DEFAULT_DB_ALIAS).get(name=POST_SEQUENCE).value
+    bucket = int(owner_id) % buckets
+    return [number * buckets + bucket for number in range(value - count + 1, value + 1)]
+
+
+def shard_of(instance):
+    """ Shard of a FacebookPost or PostAction instance, None for other models """
+    from UserDetail.models import FacebookPost, PostAction
+
+    if isinstance(instance, FacebookPost):
+        if instance.pk is not None:
+            return shard_for_post(instance.pk)
+        if instance.owner_id is not None:
+            return shard_for_owner(instance.owner_id)
+    elif isinstance(instance, PostAction) and instance.post_id is not None:
+        return shard_for_post(instance.post_id)
+    return None
+
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from UserDetail import action_buffer, profile_cache, ranking, search, sharding
+from UserDetail.trending import trending_posts
+from UserDetail.graph_cache import friend_graph
+from UserDetail.relation_filter import follow_filter, friend_filter
+from UserDetail.suggestions import refresh_queue
+from UserDetail.models import FacebookPost, Follow, Friend, FriendshipRequest, FriendSuggestion, MediaUpload, \
+    MediaVariant, PostAction, TimelineEntry, UserProfile
+
+
+@receiver(pre_save, sender=PostAction)
+def post_action_changing(sender, instance, raw=False, using=None, **kwargs):
+    """ Remember what an updated action counted for before """
+    if instance.pk is not None and not raw:
+        instance._counted = PostAction.objects.using(using).filter(pk=instance.pk) \
+            .values_list('post', 'action_type').first()
+
+
+@receiver(post_save, sender=PostAction)
+def post_action_created(sender, instance, created, **kwargs):
+    """ Count a new action on its post, move the count of a changed one """
+    if created:
+        FacebookPost.objects.adjust_counter(instance.post_id, instance.action_type, 1)
+        trending_posts.record(instance.post_id, instance.action_type)
+        return
+    counted = getattr(instance, '_counted', None)
+    if counted is not None and counted != (instance.post_id, instance.action_type):
+        FacebookPost.objects.adjust_counter(counted[0], counted[1], -1)
+        FacebookPost.objects.adjust_counter(instance.post_id, instance.action_type, 1)
+
+
+@receiver(post_delete, sender=PostAction)
+def post_action_deleted(sender, instance, **kwargs):
+    """ Discount a deleted action from its post, a buffer flush discounts its deletes in bulk """
+    if not action_buffer.collect_delete(instance):
+        FacebookPost.objects.adjust_counter(instance.post_id, instance.action_type, -1)
+
+
+@receiver(post_save, sender=PostAction)
+@receiver(post_delete, sender=PostAction)
+def post_action_affinity_changed(sender, instance, **kwargs):
+    """ The feed affinity of a user comes from their post actions """
+    ranking.invalidate_affinity(instance.user_id)
+
+
+@receiver(post_save, sender=Friend)
+@receiver(post_delete, sender=Friend)
+def friendship_changed(sender, instance, **kwargs):
+    """ Drop both adjacency lists from the friend graph cache """
+    friend_graph.invalidate(instance.to_user_id, instance.from_user_id)
+
+
+@receiver(post_save, sender=Friend)
+def friendship_created(sender, instance, created, **kwargs):
+    """ A new edge must never be answered as a definite negative """
+    if created:
+        friend_filter.add(instance.to_user_id, instance.from_user_id)
+
+
+@receiver(post_save, sender=Friend)
+def timeline_friend_added(sender, instance, created, **kwargs):
+    """ The wall of a new friend shows the posts made before the friendship """
+    if created:
+        TimelineEntry.objects.fan_in(instance.to_user_id, instance.from_user_id)
+
+
+@receiver(post_delete, sender=Friend)
+def timeline_friend_removed(sender, instance, **kwargs):
+    TimelineEntry.objects.unfriend(instance.to_user_id, instance.from_user_id)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        follow_filter.add(instance.follower_id, instance.followee_id)
+
+
+@receiver(post_save, sender=Friend)
+@receiver(post_delete, sender=Friend)
+def refresh_friend_suggestions(sender, instance, **kwargs):
+    """ Queue the user whose friend list changed, with their friends, for new suggestions """
+    if getattr(settings, 'FACEBOOK_SUGGESTION_REFRESH', True):
+        user_id = instance.to_user_id
+        transaction.on_commit(lambda: refresh_queue.add(user_id))
+
+
+@receiver(post_save, sender=FriendshipRequest)
+def drop_requested_suggestion(sender, instance, created, **kwargs):
+    """ A pending request excludes the pair from suggestions """
+    if created:
+        FriendSuggestion.objects.filter(
+            Q(user=instance.from_user_id, suggested=instance.to_user_id) |
+            Q(user=instance.to_user_id, suggested=instance.from_user_id)
+        ).delete()
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    """ The FTS5 table has no model, create it along with the app tables """
+    if sender.name == 'UserDetail':
+        search.create_index(using)
+
+
+@receiver(post_save, sender=FacebookPost)
+def index_post_text(sender, instance, **kwargs):
+    """ Keep the full-text index in sync with the post text """
+    search.index_post(instance)
+
+
+@receiver(post_delete, sender=FacebookPost)
+def unindex_post_text(sender, instance, **kwargs):
+    search.remove_post(instance.pk)
+
+
+@receiver(post_delete, sender=FacebookPost)
+def drop_post_media(sender, instance, **kwargs):
+    """ Sharded, the delete cascades on the shard of the post, its uploads and variants live on the default one """
+    if sharding.is_sharded():
+        MediaVariant.objects.filter(post=instance.pk).delete()
+        MediaUpload.objects.filter(post=instance.pk).delete()
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_changed(sender, instance, **kwargs):
+    """ Orphan the cached payload of the profile """
+    profile_cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=UserProfile)
+def profile_deleted(sender, instance, **kwargs):
+    """ A deleted profile has no version, requests for it reach the database """
+    profile_cache.forget(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_user_content(sender, instance, using=None, **kwargs):
+    """ Deleting a user cascades on its own database, their posts and actions on the other shards go here """
+    if sharding.is_sharded():
+        for alias in sharding.aliases():
+            if alias != using:
+                PostAction.objects.using(alias).filter(user=instance.pk).delete()
+                FacebookPost.objects.using(alias).filter(owner=instance.pk).delete()
+
+
+@receiver(post_save, sender=User)
+def profile_user_changed(sender, instance, **kwargs):
+    """ The profile payload inlines its user """
+    profile_cache.invalidate(*UserProfile.objects.filter(user=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=FacebookPost)
+@receiver(post_delete, sender=FacebookPost)
+def profile_picture_changed(sender, instance, **kwargs):
+    """ The profile payload inlines its cover and profile pictures """
+    profile_cache.invalidate(*UserProfile.objects.filter(
+        Q(cover_pic=instance.pk) | Q(profile_pic=instance.pk)).values_list('pk', flat=True))
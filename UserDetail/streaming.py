@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def stream_json_rows(queryset, fields, rows_per_chunk=None):
+    """
+    Yield a JSON array of objects with the given fields, a chunk at a time.
+
+    Rows come from a server-side values_list iterator, so only one chunk of
+    rows is ever held in memory. Values are encoded the way the DRF
+    serializers render them.
+    """
+    if rows_per_chunk is None:
+        rows_per_chunk = getattr(settings, 'FACEBOOK_STREAM_ROWS_PER_CHUNK', 1000)
+    encode = JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    keys = [encode(field) for field in fields]
+
+    yield '['
+    buffer = []
+    first = True
+    for row in queryset.values_list(*fields).iterator():
+        item = '{%s}' % ','.join('%s:%s' % (key, encode(value)) for key, value in zip(keys, row))
+        buffer.append(item if first else ',' + item)
+        first = False
+        if len(buffer) >= rows_per_chunk:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+    yield ']'
+
+
+def streaming_json_response(queryset, fields):
+    """ Stream a list queryset as a JSON array with bounded memory """
+    return StreamingHttpResponse(stream_json_rows(queryset, fields), content_type='application/json')
+
+
+def stream_requested(request):
+    """ Clients opt into the streaming export with ?stream=1 """
+    return request.query_params.get('stream') in ('1', 'true')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def neighbourhood(user_ids):
+    """ Users whose friend-of-friend set changes when the friend lists of user_ids do """
+    from UserDetail.models import Friend, chunked
+
+    affected = set(user_ids)
+    for chunk in chunked(sorted(affected), 900):
+        affected.update(Friend.objects.filter(to_user__in=chunk).values_list('from_user', flat=True))
+    return affected
+
+
+class RefreshQueue(object):
+    """
+    Per-process set of users whose friend suggestions are out of date.
+
+    Changed users are queued after commit, their friends are added and the
+    suggestions recomputed FACEBOOK_SUGGESTION_REFRESH_DELAY seconds later
+    on a timer thread, in batches of FACEBOOK_SUGGESTION_REFRESH_BATCH.
+    Until then, and for queues lost with their process, the stored
+    suggestions are stale; precompute_friend_suggestions catches up. A
+    delay of 0 refreshes on the committing thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.user_ids = set()
+        self.timer = None
+
+    def add(self, *user_ids):
+        delay = getattr(settings, 'FACEBOOK_SUGGESTION_REFRESH_DELAY', 5.0)
+        with self.lock:
+            self.user_ids.update(user_ids)
+            if delay and self.timer is None:
+                self.timer = threading.Timer(delay, self.flush_in_thread)
+                self.timer.daemon = True
+                self.timer.start()
+        if not delay:
+            self.flush()
+
+    def pending(self):
+        with self.lock:
+            return set(self.user_ids)
+
+    def flush(self):
+        """ Refresh the queued users and their friends, returns the number of users refreshed """
+        from UserDetail.models import FriendSuggestion, chunked
+
+        with self.flush_lock:
+            with self.lock:
+                user_ids, self.user_ids = self.user_ids, set()
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not user_ids:
+                return 0
+            affected = sorted(neighbourhood(user_ids))
+            for chunk in chunked(affected, getattr(settings, 'FACEBOOK_SUGGESTION_REFRESH_BATCH', 500)):
+                FriendSuggestion.objects.refresh(chunk)
+            return len(affected)
+
+    def flush_in_thread(self):
+        """ Timer callback, the timer thread has its own connections """
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Friend suggestion refresh failed')
+        finally:
+            connections.close_all()
+
+
+refresh_queue = RefreshQueue()
@@ -1,6 +1,1507 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import IntegrityError, connection, connections
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,\
+    override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from UserDetail import action_buffer, benchmark, fastpath, geo, instrumentation, media, ranking, relation_filter,\
+    routers, search, sharding, streaming, suggestions, trending
+from UserDetail.graph_cache import FriendGraphCache, friend_graph
+from UserDetail.instrumentation import InstrumentationMiddleware, query_budget
+from UserDetail.models import FacebookPost, Follow, Friend, FriendshipRequest, FriendSuggestion, MediaUpload,\
+    MediaVariant, PostAction, TimelineEntry, UserProfile
+from UserDetail.serializers import FacebookPostSerializer,\
+    FollowSerializer,\
+    FriendSerializer,\
+    FriendshipRequestSerializer,\
+    PostActionSerializer
+
+
+def create_post(owner, minutes_ago=0, **fields):
+    """ A post of owner with the blank fields filled in """
+    values = {'message': '', 'post_type': 'PIC', 'caption': '', 'description': '', 'story': '',
+              'privacy': 'ALL', 'created_time': timezone.now() - timedelta(minutes=minutes_ago)}
+    values.update(fields)
+    return FacebookPost.objects.create(owner=owner, **values)
+
+
+class FastPathTest(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+        Friend.objects.create(from_user=self.bob, to_user=self.alice)
+        Friend.objects.create(from_user=self.alice, to_user=self.bob)
+        Follow.objects.create(follower=self.carol, followee=self.alice)
+        FriendshipRequest.objects.create(from_user=self.carol, to_user=self.alice, message='hi')
+        self.post = FacebookPost.objects.create(
+            owner=self.alice, message='hello', created_time=timezone.now(), picture='uploads/a.png',
+            link='http://example.com', post_type='PIC', caption='', description='', story='',
+            privacy='ALL', place_lat='57.64911', place_long='10.40744')
+        FacebookPost.objects.create(
+            owner=self.bob, message='', created_time=timezone.now(), post_type='URL',
+            caption='c', description='d', story='s')
+        PostAction.objects.create(action_type='L', user=self.bob, post=self.post)
+        PostAction.objects.create(action_type='C', user=self.carol, post=self.post, comments='nice')
+
+    def assertSameJSON(self, queryset, serializer_class):
+        rows = queryset.values(*fastpath.columns(serializer_class))
+        expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+        self.assertEqual(JSONRenderer().render(fastpath.render_rows(rows, serializer_class)), expected)
+
+    def test_post_serializer(self):
+        self.assertSameJSON(FacebookPost.objects.order_by('pk'), FacebookPostSerializer)
+
+    def test_relationship_serializers(self):
+        self.assertSameJSON(Friend.objects.order_by('pk'), FriendSerializer)
+        self.assertSameJSON(Follow.objects.order_by('pk'), FollowSerializer)
+        self.assertSameJSON(FriendshipRequest.objects.order_by('pk'), FriendshipRequestSerializer)
+
+    def test_post_action_serializer(self):
+        self.assertSameJSON(PostAction.objects.order_by('pk'), PostActionSerializer)
+
+    def test_list_view_output_unchanged(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        for url in ('/facebook/friends_list/', '/facebook/followers/',
+                    '/facebook/friendship_request_receive/', '/facebook/friends_list/?page_size=1'):
+            with override_settings(FACEBOOK_FAST_SERIALIZATION=False):
+                expected = client.get(url).content
+            with override_settings(FACEBOOK_FAST_SERIALIZATION=True):
+                self.assertEqual(client.get(url).content, expected)
+
+
+@skipIf(media.Image is None, 'Pillow is not installed')
+class ChunkedUploadTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.user = User.objects.create_user('alice')
+        self.post = FacebookPost.objects.create(
+            owner=self.user, message='', created_time=timezone.now(), post_type='PIC',
+            caption='', description='', story='')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def put_chunk(self, upload_id, data, start, total):
+        return self.client.put('/facebook/uploads/%s/' % upload_id, data,
+                               content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE='bytes %s-%s/%s' % (start, start + len(data) - 1, total))
+
+    def test_resumable_upload_builds_variants(self):
+        image = io.BytesIO()
+        media.Image.new('RGB', (800, 400)).save(image, 'PNG')
+        data = image.getvalue()
+        half = len(data) // 2
+
+        with self.settings(MEDIA_ROOT=self.media_root, FACEBOOK_UPLOAD_TEMP_DIR=self.media_root,
+                           FACEBOOK_MEDIA_WORKERS=0, FACEBOOK_MEDIA_VARIANTS={'thumbnail': 100}):
+            response = self.client.post('/facebook/uploads/', {
+                'post': self.post.pk, 'field': 'picture', 'filename': 'photo.png', 'total_size': len(data),
+            }, format='json')
+            self.assertEqual(response.status_code, 201)
+            upload_id = response.data['id']
+            self.assertFalse(FacebookPost.objects.get(pk=self.post.pk).media_ready)
+
+            self.assertEqual(self.put_chunk(upload_id, data[:half], 0, len(data)).data['received'], half)
+            # A chunk that does not continue the upload is refused
+            self.assertEqual(self.put_chunk(upload_id, data[:half], 0, len(data)).status_code, 409)
+            response = self.put_chunk(upload_id, data[half:], half, len(data))
+            self.assertEqual(response.data['status'], 'ready')
+
+        post = FacebookPost.objects.get(pk=self.post.pk)
+        self.assertTrue(post.media_ready)
+        self.assertTrue(post.picture.name.startswith('uploads/photo'))
+        variant = MediaVariant.objects.get(post=post)
+        self.assertEqual((variant.name, variant.width, variant.height), ('thumbnail', 100, 50))
+
+    def test_concurrent_chunks_are_refused(self):
+        with self.settings(FACEBOOK_UPLOAD_TEMP_DIR=self.media_root):
+            upload_id = self.client.post('/facebook/uploads/', {
+                'post': self.post.pk, 'field': 'picture', 'filename': 'photo.png', 'total_size': 4,
+            }, format='json').data['id']
+            upload = MediaUpload.objects.get(pk=upload_id)
+            # Another worker is writing a chunk
+            with media.upload_lock(upload):
+                response = self.put_chunk(upload_id, b'ab', 0, 4)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(MediaUpload.objects.get(pk=upload_id).received, 0)
+            self.assertEqual(self.put_chunk(upload_id, b'ab', 0, 4).data['received'], 2)
+
+
+@override_settings(FACEBOOK_ENFORCE_QUERY_BUDGETS=True)
+class QueryBudgetTest(TestCase):
+    """ Views running more queries than their @query_budget fail here, whatever the row count """
+
+    def setUp(self):
+        friend_graph.clear()
+        self.user = User.objects.create_user('alice')
+        others = [User.objects.create_user('user%s' % i) for i in range(6)]
+        for other in others[:3]:
+            FriendshipRequest.objects.create(from_user=other, to_user=self.user).accept()
+            Follow.objects.create(follower=other, followee=self.user)
+            Follow.objects.create(follower=self.user, followee=other)
+        for other in others[3:]:
+            FriendshipRequest.objects.create(from_user=other, to_user=self.user)
+        for owner in [self.user] + others[:3]:
+            self.post = FacebookPost.objects.create(
+                owner=owner, message='hello', created_time=timezone.now(), post_type='PIC',
+                caption='', description='', story='', privacy='ALL', place_lat='1.0', place_long='1.0')
+            PostAction.objects.create(action_type='L', user=self.user, post=self.post)
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_read_views_stay_within_budget(self):
+        urls = [
+            '/facebook/%s/' % self.profile.pk,
+            '/facebook/post_list/None/',
+            '/facebook/post_action/%s/' % self.post.pk,
+            '/facebook/friends_list/',
+            '/facebook/friendship_request_sent/',
+            '/facebook/friendship_request_receive/',
+            '/facebook/friendship_request_viewed/',
+            '/facebook/friendship_request_rejected/',
+            '/facebook/friendship_request_unrejected/',
+            '/facebook/friendship_request_unread/',
+            '/facebook/following/',
+            '/facebook/followers/',
+            '/facebook/friend_suggestions/',
+            '/facebook/posts_near/?lat=1&long=1&radius=5',
+            '/facebook/search/?q=hello',
+            '/facebook/trending/',
+            '/facebook/feed/',
+        ]
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertIn('X-Query-Count', response)
+
+    def test_relationships_within_budget(self):
+        ids = list(User.objects.values_list('pk', flat=True))
+        response = self.client.post('/facebook/relationships/', {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        other = User.objects.create_user('bob')
+        FriendshipRequest.objects.create(from_user=other, to_user=self.user).accept()
+        FriendshipRequest.objects.create(from_user=User.objects.create_user('carol'), to_user=self.user)
+        Follow.objects.create(follower=other, followee=self.user)
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_sub_responses_match_separate_requests(self):
+        paths = ['/facebook/friends_list/', '/facebook/friendship_request_unread/', '/facebook/followers/',
+                 '/facebook/post_list/None/', '/facebook/%s/?fields=id' % self.profile.pk,
+                 '/facebook/friends_list/?page_size=1']
+        response = self.client.post('/facebook/batch/', {
+            'requests': [{'id': str(index), 'path': path} for index, path in enumerate(paths)],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        for index, (path, result) in enumerate(zip(paths, response.data['responses'])):
+            expected = self.client.get(path)
+            self.assertEqual(result['id'], str(index))
+            self.assertEqual(result['status'], expected.status_code, path)
+            self.assertEqual(result['body'], expected.data, path)
+
+    def test_writes_and_errors(self):
+        response = self.client.post('/facebook/batch/', {'requests': [
+            {'method': 'POST', 'path': '/facebook/relationships/', 'body': {'ids': [self.user.pk]}},
+            {'path': '/facebook/missing/'},
+            {'method': 'POST', 'path': '/facebook/batch/', 'body': {'requests': []}},
+        ]}, format='json')
+        statuses = [result['status'] for result in response.data['responses']]
+        self.assertEqual(statuses, [200, 404, 404])
+        self.assertEqual(response.data['responses'][0]['body']['results'][0]['id'], self.user.pk)
+
+
+# The session login adds the session and user reads the budgets leave out
+@override_settings(FACEBOOK_ENFORCE_QUERY_BUDGETS=False)
+class AsgiTest(TransactionTestCase):
+    """ The database threads need committed rows, hence TransactionTestCase """
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        for index in range(3):
+            FriendshipRequest.objects.create(from_user=User.objects.create_user('user%s' % index),
+                                             to_user=self.user).accept()
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def asgi_get(self, path, query=''):
+        import asyncio
+        from UserDetail.asgi import ASGIHandler
+
+        cookie = '; '.join('%s=%s' % (name, morsel.value) for name, morsel in self.client.cookies.items())
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode('ascii'),
+                 'headers': [(b'cookie', cookie.encode('ascii')), (b'host', b'testserver')]}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.get_event_loop().run_until_complete(ASGIHandler()(scope, receive, send))
+        self.sent = sent
+        return sent[0]['status'], dict(sent[0]['headers']), b''.join(message['body'] for message in sent[1:])
+
+    def test_async_views_match_sync_views(self):
+        for path, query in (('/facebook/friends_list/', ''), ('/facebook/friends_list/', 'page_size=2'),
+                            ('/facebook/friendship_request_unread/', ''), ('/facebook/followers/', ''),
+                            ('/facebook/post_list/None/', ''), ('/facebook/%s/' % self.profile.pk, ''),
+                            ('/facebook/friends_list/', 'stream=1'), ('/facebook/relationships/', '')):
+            expected = self.client.get('%s?%s' % (path, query))
+            status, headers, body = self.asgi_get(path, query)
+            self.assertEqual(status, expected.status_code, path)
+            content = b''.join(expected.streaming_content) if expected.streaming else expected.content
+            self.assertEqual(body, content, path)
+        self.assertEqual(self.asgi_get('/facebook/friends_list/', 'page_size=2')[1][b'X-Total-Count'], b'3')
+
+    def test_coroutine_views_run_the_middleware_and_signals(self):
+        events = []
+
+        def started(**kwargs):
+            events.append('started')
+
+        def finished(**kwargs):
+            events.append('finished')
+        request_started.connect(started)
+        request_finished.connect(finished)
+        self.addCleanup(request_started.disconnect, started)
+        self.addCleanup(request_finished.disconnect, finished)
+
+        expected = self.client.get('/facebook/friends_list/')
+        events = []
+        status, headers, body = self.asgi_get('/facebook/friends_list/')
+        self.assertEqual(events, ['started', 'finished'])
+        self.assertEqual(headers[b'X-Frame-Options'], expected['X-Frame-Options'].encode('ascii'))
+        # Queries on the database threads count for the request
+        self.assertEqual(headers[b'X-Query-Count'], expected['X-Query-Count'].encode('ascii'))
+        self.assertEqual(self.asgi_get('/facebook/nowhere/')[0], 404)
+
+    def test_coroutine_views_take_no_request_thread(self):
+        from UserDetail import asgi
+
+        class RefusingExecutor(object):
+            def submit(self, *args, **kwargs):
+                raise AssertionError('A coroutine view ran on a request thread')
+        previous, asgi._executor = asgi._executor, RefusingExecutor()
+        self.addCleanup(setattr, asgi, '_executor', previous)
+        self.assertEqual(self.asgi_get('/facebook/friends_list/')[0], 200)
+
+    def test_streamed_exports_are_sent_chunk_by_chunk(self):
+        with self.settings(FACEBOOK_STREAM_ROWS_PER_CHUNK=1):
+            status, headers, body = self.asgi_get('/facebook/friends_list/', 'stream=1')
+        self.assertEqual(len(json.loads(body.decode('utf-8'))), 3)
+        self.assertGreater(len([message for message in self.sent if message.get('more_body')]), 1)
+
+    def test_request_body_is_read_as_the_view_asks(self):
+        import asyncio
+        from UserDetail.asgi import RequestBody
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        messages = [{'type': 'http.request', 'body': b'ab', 'more_body': True},
+                    {'type': 'http.request', 'body': b'cd'}]
+        received = []
+
+        async def receive():
+            received.append(messages[len(received)])
+            return received[-1]
+        body = RequestBody(receive, loop)
+
+        def read():
+            return body.read(1), len(received), body.read()
+        self.assertEqual(loop.run_until_complete(loop.run_in_executor(None, read)), (b'a', 1, b'bcd'))
+
+
+@override_settings(FACEBOOK_REPLICAS=['replica'])
+class ReplicaRouterTest(SimpleTestCase):
+
+    def setUp(self):
+        routers._state.wrote = False
+        self.router = routers.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, request, write=False):
+        """ Where the view of request would read from, and the response """
+        seen = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(Friend)
+            seen.append(self.router.db_for_read(Friend))
+            seen.append(self.router.db_for_read(Session))
+            return HttpResponse()
+        response = routers.ReplicaRoutingMiddleware(view)(request)
+        return seen, response.cookies.get(routers.STICKY_COOKIE)
+
+    def test_safe_requests_read_from_replicas(self):
+        self.assertEqual(self.route(self.factory.get('/')), (['replica', 'default'], None))
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        reads, cookie = self.route(self.factory.post('/'))
+        self.assertEqual(reads, ['default', 'default'])
+        self.assertIsNotNone(cookie)
+        reads, cookie = self.route(self.factory.get('/'), write=True)
+        self.assertEqual(reads, ['default', 'default'])
+        self.assertIsNotNone(cookie)
+
+        request = self.factory.get('/')
+        request.COOKIES[routers.STICKY_COOKIE] = '1'
+        self.assertEqual(self.route(request)[0], ['default', 'default'])
+
+    def test_read_only_manager_methods(self):
+        self.assertEqual(self.router.db_for_read(Friend), 'default')
+        with routers.read_only():
+            self.assertEqual(self.router.db_for_read(Friend), 'replica')
+        self.assertEqual(self.router.db_for_write(Friend), 'default')
+        with routers.read_only():
+            self.assertEqual(self.router.db_for_read(Friend), 'default')
+
+
+@override_settings(FACEBOOK_POST_ACTION_BUFFER=True, FACEBOOK_POST_ACTION_BUFFER_SYNC=True,
+                   FACEBOOK_POST_ACTION_BUFFER_SIZE=100)
+class PostActionBufferTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user%s' % i) for i in range(3)]
+        self.post = FacebookPost.objects.create(
+            owner=self.users[0], message='', created_time=timezone.now(), post_type='PIC',
+            caption='', description='', story='')
+        PostAction.objects.create(action_type='L', user=self.users[2], post=self.post)
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+        self.url = '/facebook/post_action/%s/' % self.post.pk
+
+    def act(self, method, user, action_type, **extra):
+        data = dict(user=user.pk, post=self.post.pk, action_type=action_type, **extra)
+        return getattr(self.client, method)(self.url, data, format='json')
+
+    def test_buffered_actions_coalesce(self):
+        self.assertEqual(self.act('post', self.users[0], 'L').status_code, 202)
+        self.act('post', self.users[0], 'L')
+        self.act('post', self.users[1], 'L')
+        self.act('delete', self.users[1], 'L')
+        self.act('delete', self.users[2], 'L')
+        self.act('post', self.users[1], 'C', comments='first')
+        self.act('post', self.users[1], 'C', comments='second')
+        self.assertEqual(PostAction.objects.count(), 1)
+
+        with self.assertNumQueries(9):
+            self.assertEqual(action_buffer.post_actions.flush(), (3, 1))
+        post = FacebookPost.objects.get(pk=self.post.pk)
+        self.assertEqual((post.like_count, post.comment_count), (1, 2))
+        self.assertEqual(sorted(PostAction.objects.values_list('user__username', 'action_type')),
+                         [('user0', 'L'), ('user1', 'C'), ('user1', 'C')])
+
+    def test_size_threshold_flushes(self):
+        with self.settings(FACEBOOK_POST_ACTION_BUFFER_SIZE=2):
+            self.act('post', self.users[0], 'S')
+            self.assertEqual(action_buffer.post_actions.pending(), 1)
+            self.act('post', self.users[1], 'S')
+        self.assertEqual(action_buffer.post_actions.pending(), 0)
+        self.assertEqual(FacebookPost.objects.get(pk=self.post.pk).share_count, 2)
+
+    def test_actions_of_deleted_users_are_dropped(self):
+        self.act('post', self.users[0], 'L')
+        self.act('post', self.users[1], 'C', comments='gone')
+        self.act('post', self.users[1], 'S')
+        self.users[1].delete()
+        self.assertEqual(action_buffer.post_actions.flush(), (1, 0))
+        post = FacebookPost.objects.get(pk=self.post.pk)
+        self.assertEqual((post.like_count, post.share_count, post.comment_count), (2, 0, 0))
+
+    def test_removals_never_go_below_zero(self):
+        FacebookPost.objects.filter(pk=self.post.pk).update(like_count=0)
+        self.act('delete', self.users[2], 'L')
+        self.assertEqual(action_buffer.post_actions.flush(), (0, 1))
+        self.assertEqual(FacebookPost.objects.get(pk=self.post.pk).like_count, 0)
+        # Outside a flush the signal discounts deletes itself
+        action = PostAction.objects.create(action_type='L', user=self.users[0], post=self.post)
+        action.delete()
+        self.assertEqual(FacebookPost.objects.get(pk=self.post.pk).like_count, 0)
+
+
+@override_settings(FACEBOOK_SHARD_MAP=['default', 'shard1'])
+class ShardingTest(TestCase):
+    """ A second SQLite file stands in for the other shard """
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        connections.databases['shard1'] = {'ENGINE': 'django.db.backends.sqlite3',
+                                           'NAME': os.path.join(cls.directory, 'shard1.sqlite3')}
+        connections.ensure_defaults('shard1')
+        connections.prepare_test_settings('shard1')
+        call_command('migrate', database='shard1', run_syncdb=True, verbosity=0)
+        super(ShardingTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ShardingTest, cls).tearDownClass()
+        connections['shard1'].close()
+        del connections.databases['shard1']
+        delattr(connections._connections, 'shard1')
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob = [User.objects.create_user(name) for name in ('alice', 'bob')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        now = timezone.now()
+        self.posts = []
+        for minutes, owner, privacy in ((4, self.alice, 'ALL'), (3, self.bob, 'FND'), (2, self.alice, 'ME'),
+                                        (1, self.bob, 'ME'), (0, self.bob, 'ALL')):
+            self.posts.append(FacebookPost.objects.create(
+                owner=owner, message='', created_time=now - timedelta(minutes=minutes), post_type='PIC',
+                caption='', description='', story='', privacy=privacy))
+
+    def test_posts_live_on_their_owner_shard(self):
+        for post in self.posts:
+            self.assertEqual(post._state.db, sharding.shard_for_owner(post.owner_id))
+            self.assertEqual(sharding.shard_for_post(post.pk), post._state.db)
+        self.assertNotEqual(sharding.shard_for_owner(self.alice), sharding.shard_for_owner(self.bob))
+        bob_shard = sharding.shard_for_owner(self.bob)
+        self.assertEqual(FacebookPost.objects.using(bob_shard).filter(owner=self.bob).count(), 3)
+        self.assertEqual(FacebookPost.objects.profile_post(self.bob, self.alice).db, bob_shard)
+        self.assertEqual(len(FacebookPost.objects.profile_post(self.bob, self.alice)), 2)
+
+    def test_wall_post_merges_shards(self):
+        wall = FacebookPost.objects.wall_post(self.alice)
+        expected = [self.posts[4], self.posts[2], self.posts[1], self.posts[0]]
+        self.assertEqual([post.pk for post in wall], [post.pk for post in expected])
+        self.assertEqual(len(FacebookPost.objects.wall_post(self.alice, limit=2)), 2)
+
+    def test_actions_follow_their_post(self):
+        post = self.posts[4]
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url = '/facebook/post_action/%s/' % post.pk
+        response = client.post(url, {'action_type': 'L', 'user': self.alice.pk, 'post': post.pk}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(PostAction.objects.using(post._state.db).count(), 1)
+        self.assertEqual(FacebookPost.objects.get_post(post.pk).like_count, 1)
+        self.assertEqual(len(client.get(url).data), 1)
+
+    def test_visible_posts_are_read_from_every_shard(self):
+        for post in self.posts:
+            post.message = 'hiking trip'
+            post.place_lat, post.place_long = '57.64911', '10.40744'
+            post.save()
+        # Public and friends posts of bob, every post of alice
+        expected = [self.posts[4].pk, self.posts[2].pk, self.posts[1].pk, self.posts[0].pk]
+        self.assertEqual([post.pk for post in FacebookPost.objects.in_bounding_box(
+            self.alice, 57.0, 10.0, 58.0, 11.0)], expected)
+        self.assertEqual(sorted(post.pk for post in FacebookPost.objects.nearby(
+            self.alice, 57.64911, 10.40744, 1)), sorted(expected))
+        self.assertEqual(sorted(post.pk for post in search.search_posts(self.alice, 'hiking')), sorted(expected))
+        with self.assertRaises(ValueError):
+            FacebookPost.objects.visible_to(self.alice)
+
+    def test_deleted_user_leaves_nothing_on_the_shards(self):
+        bob_post = self.posts[4]
+        PostAction.objects.create(action_type='L', user=self.alice, post=bob_post)
+        self.assertEqual(FacebookPost.objects.get_post(bob_post.pk).like_count, 1)
+        self.alice.delete()
+        for alias in sharding.aliases():
+            self.assertFalse(FacebookPost.objects.using(alias).filter(owner=self.alice.pk).exists())
+            self.assertFalse(PostAction.objects.using(alias).filter(user=self.alice.pk).exists())
+        self.assertEqual(FacebookPost.objects.get_post(bob_post.pk).like_count, 0)
+        self.bob.delete()
+        for alias in sharding.aliases():
+            self.assertFalse(FacebookPost.objects.using(alias).exists())
+
+    def test_generated_graph_is_routed_to_the_shards(self):
+        call_command('generate_social_graph', users=20, posts_per_user=4, actions_per_post=2,
+                     stdout=io.StringIO())
+        synthetic = User.objects.filter(username__startswith='synthetic_').values_list('pk', flat=True)
+        counted = 0
+        for alias in sharding.aliases():
+            posts = FacebookPost.objects.using(alias).filter(owner__in=list(synthetic))
+            for post in posts:
+                self.assertEqual(sharding.shard_for_owner(post.owner_id), alias)
+                self.assertEqual(sharding.shard_for_post(post.pk), alias)
+                self.assertEqual(post.like_count,
+                                 PostAction.objects.using(alias).filter(post=post, action_type='L').count())
+            counted += len(posts)
+            # Actions live next to their post
+            self.assertFalse(PostAction.objects.using(alias)
+                             .exclude(post__in=FacebookPost.objects.using(alias).values('pk')).exists())
+        self.assertGreater(counted, 0)
+
+    def test_deleted_post_drops_its_media(self):
+        post = [post for post in self.posts if post._state.db == 'shard1'][0]
+        MediaVariant.objects.create(post=post, name='thumbnail', file='variants/thumbnail.jpg', width=1, height=1)
+        post.delete()
+        self.assertFalse(MediaVariant.objects.exists())
+
+
+@override_settings(FACEBOOK_TRENDING_SNAPSHOT_SECONDS=0)
+class TrendingTest(TestCase):
+
+    def setUp(self):
+        trending.trending_posts.clear()
+        self.user = User.objects.create_user('alice')
+        self.posts = [FacebookPost.objects.create(
+            owner=self.user, message='', created_time=timezone.now(), post_type='PIC', caption='',
+            description='', story='', privacy=privacy) for privacy in ('ALL', 'ALL', 'ME')]
+
+    def test_sketch_never_undercounts(self):
+        sketch = trending.CountMinSketch(64, 4)
+        for key in range(500):
+            sketch.add(key, key % 7)
+        self.assertTrue(all(sketch.estimate(key) >= key % 7 for key in range(500)))
+
+    def test_window_expires_old_buckets(self):
+        window = trending.SlidingWindowTopK(window=3600, bucket=60, width=256, depth=4, size=2)
+        window.add(1, 5, now=0)
+        window.add(2, 3, now=1800)
+        for key in range(10, 20):
+            window.add(key, 1, now=1800)
+        self.assertEqual(window.top(now=1900), [(1, 5), (2, 3)])
+        self.assertEqual(window.top(now=3700)[0], (2, 3))
+        self.assertNotIn(1, dict(window.top(now=3700)))
+
+    def test_endpoint_reads_snapshots_only(self):
+        public, other, private = self.posts
+        for action_type in ('L', 'S'):
+            PostAction.objects.create(action_type=action_type, user=self.user, post=public)
+        PostAction.objects.create(action_type='C', user=self.user, post=other, comments='hi')
+        PostAction.objects.create(action_type='S', user=self.user, post=private)
+        self.assertEqual(trending.trending_posts.snapshot(), 2)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/facebook/trending/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(post['id'], post['score']) for post in response.data], [(public.pk, 4), (other.pk, 2)])
+        self.assertFalse([query for query in queries if 'postaction' in query['sql'].lower()])
+        self.assertEqual(len(client.get('/facebook/trending/?limit=1').data), 1)
+
+
+class RelationFilterTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        cache.clear()
+        relation_filter.follow_filter.clear()
+        relation_filter.friend_filter.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        Follow.objects.add_follower(self.alice, self.bob)
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        relation_filter.follow_filter.rebuild()
+        relation_filter.friend_filter.rebuild()
+
+    def test_negatives_skip_queries(self):
+        self.assertTrue(Follow.objects.follows(self.alice, self.bob))
+        self.assertTrue(Friend.objects.are_friends(self.alice, self.bob))
+        with self.assertNumQueries(0):
+            self.assertFalse(Follow.objects.follows(self.alice, self.carol))
+            self.assertFalse(Follow.objects.follows(self.carol, self.alice))
+            self.assertFalse(Friend.objects.are_friends(self.alice, self.carol))
+        with self.assertNumQueries(1):
+            self.assertTrue(Follow.objects.follows(self.alice, self.bob))
+
+    def test_saved_edges_are_never_negative(self):
+        self.assertFalse(Follow.objects.follows(self.alice, self.carol))
+        Follow.objects.add_follower(self.alice, self.carol)
+        self.assertTrue(Follow.objects.follows(self.alice, self.carol))
+        with self.assertRaises(IntegrityError):
+            Follow.objects.add_follower(self.alice, self.carol)
+        FriendshipRequest.objects.create(from_user=self.carol, to_user=self.alice)
+        Friend.objects.bulk_accept(self.alice, FriendshipRequest.objects.values_list('pk', flat=True))
+        self.assertTrue(Friend.objects.are_friends(self.carol, self.alice))
+
+    def test_follow_saved_by_another_worker(self):
+        # Saved by another process, with filters of its own
+        Follow.objects.bulk_create([Follow(follower=self.alice, followee=self.carol)])
+        relation_filter.EdgeFilter(relation_filter.load_follow_edges, name='follow').add(self.alice.pk, self.carol.pk)
+        self.assertTrue(Follow.objects.follows(self.alice, self.carol))
+        with self.assertRaisesRegex(IntegrityError, 'already follows'):
+            Follow.objects.add_follower(self.alice, self.carol)
+        self.assertTrue(Follow.objects.follows(self.alice, self.carol))
+
+    def test_edges_saved_by_another_worker_are_never_negative(self):
+        edges = [(1, 2)]
+        worker, other_worker = [relation_filter.EdgeFilter(lambda: iter(edges), name='test') for _ in range(2)]
+        worker.rebuild()
+        other_worker.rebuild()
+        self.assertFalse(other_worker.might_contain(1, 3))
+        edges.append((1, 3))
+        worker.add(1, 3)
+        self.assertTrue(other_worker.might_contain(1, 3))
+        # The filters of the worker that saved it stay exact
+        self.assertFalse(worker.might_contain(1, 4))
+        self.assertFalse(other_worker.might_contain(5, 6))
+        other_worker.rebuild()
+        self.assertTrue(other_worker.might_contain(1, 3))
+        self.assertFalse(other_worker.might_contain(1, 4))
+        # Edges saved in bulk clear the filters of every worker
+        worker.clear()
+        self.assertTrue(other_worker.might_contain(5, 6))
+
+    def test_unbuilt_filter_answers_maybe(self):
+        def loader():
+            raise AssertionError('Built inside a check')
+        edges = relation_filter.EdgeFilter(loader)
+        self.assertTrue(edges.might_contain(1, 2))
+        self.assertIsNone(edges.filters)
+
+    def test_error_rate(self):
+        edges = relation_filter.EdgeFilter(lambda: [(1, other) for other in range(1000)], error_rate=0.01)
+        edges.rebuild()
+        self.assertTrue(all(edges.might_contain(1, other) for other in range(1000)))
+        positives = sum(edges.might_contain(1, other) for other in range(10000, 20000))
+        self.assertLess(positives, 300)
+
+
+@override_settings(FACEBOOK_FEED_WEIGHTS={'recency': 1.0, 'affinity': 2.0, 'engagement': 0.5, 'video': 0.1})
+class FeedRankingTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        ranking.invalidate_affinity(self.alice.pk)
+        for friend in (self.bob, self.carol):
+            FriendshipRequest.objects.create(from_user=friend, to_user=self.alice).accept()
+        now = timezone.now()
+
+        def post(owner, hours, post_type='PIC'):
+            return FacebookPost.objects.create(
+                owner=owner, message='', created_time=now - timedelta(hours=hours), post_type=post_type,
+                caption='', description='', story='', privacy='FND')
+        # carol posted last, but alice engages with bob
+        self.old_bob = post(self.bob, 30)
+        self.new_carol = post(self.carol, 1)
+        self.bob_video = post(self.bob, 2, 'VID')
+        for target in (self.old_bob, self.bob_video):
+            PostAction.objects.create(action_type='L', user=self.alice, post=target)
+
+    def test_ranks_by_affinity_and_recency(self):
+        ranked = FacebookPost.objects.ranked_wall_post(self.alice)
+        self.assertEqual([post.pk for post in ranked], [self.bob_video.pk, self.old_bob.pk, self.new_carol.pk])
+        self.assertEqual(ranked, sorted(ranked, key=lambda post: -post.score))
+
+        numpy, ranking.numpy = ranking.numpy, None
+        try:
+            unvectorized = FacebookPost.objects.ranked_wall_post(self.alice, limit=2)
+        finally:
+            ranking.numpy = numpy
+        self.assertEqual([post.pk for post in unvectorized], [post.pk for post in ranked[:2]])
+        for slow, fast in zip(unvectorized, ranked):
+            # Recency moved on a little between the two calls
+            self.assertAlmostEqual(slow.score, fast.score, places=5)
+
+    def test_affinity_is_cached(self):
+        FacebookPost.objects.ranked_wall_post(self.alice)
+        # The feature columns of the timeline range and of the pulled posts,
+        # then the ranked posts, no affinity query
+        with CaptureQueriesContext(connection) as queries:
+            ranked = FacebookPost.objects.ranked_wall_post(self.alice)
+        self.assertEqual(len(queries), 3)
+        self.assertNotIn('"message"', queries[0]['sql'])
+        self.assertNotIn('"message"', queries[1]['sql'])
+        self.assertEqual(ranked[0].message, '')
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.get('/facebook/feed/?limit=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['id'] for post in response.data], [self.bob_video.pk])
+
+    def test_feed_pages_with_a_cursor(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url, pages = '/facebook/feed/?page_size=1', []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([post['id'] for post in response.data['results']])
+            url = response.data['next']
+        # Each page ranks the posts older than the previous one
+        self.assertEqual(pages, [[self.bob_video.pk], [self.old_bob.pk], []])
+        self.assertEqual(client.get('/facebook/feed/?cursor=bogus').status_code, 404)
+
+    def test_actions_drop_the_cached_affinity(self):
+        ranking.affinity(self.alice.pk)
+        action = PostAction.objects.create(action_type='L', user=self.alice, post=self.new_carol)
+        self.assertIn(self.carol.pk, ranking.affinity(self.alice.pk)[0])
+        action.delete()
+        self.assertNotIn(self.carol.pk, ranking.affinity(self.alice.pk)[0])
+        with self.settings(FACEBOOK_POST_ACTION_BUFFER_SYNC=True):
+            action_buffer.post_actions.add(self.alice.pk, self.new_carol.pk, 'L')
+            action_buffer.post_actions.flush()
+        self.assertIn(self.carol.pk, ranking.affinity(self.alice.pk)[0])
+
+    @skipIf(ranking.numpy is None, 'needs numpy')
+    def test_microbenchmark_paths_agree(self):
+        report = benchmark.ranking_microbenchmark(candidates=200, iterations=2)
+        self.assertTrue(report['same_ranking'])
+
+
+class TimelineTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+
+    def wall(self, user):
+        return [post.pk for post in FacebookPost.objects.wall_post(user)]
+
+    def test_fan_out_pushes_to_friends(self):
+        post = create_post(self.bob)
+        self.assertTrue(TimelineEntry.objects.fan_out(post))
+        self.assertEqual(set(TimelineEntry.objects.filter(post=post).values_list('user', flat=True)),
+                         {self.alice.pk, self.bob.pk})
+        private = create_post(self.bob, privacy='ME')
+        TimelineEntry.objects.fan_out(private)
+        self.assertEqual(self.wall(self.alice), [post.pk])
+        self.assertEqual(self.wall(self.bob), [private.pk, post.pk])
+        self.assertEqual(self.wall(self.carol), [])
+
+    @override_settings(FACEBOOK_FAN_OUT_THRESHOLD=0)
+    def test_high_degree_authors_are_pulled(self):
+        pushed = create_post(self.alice, minutes_ago=5)
+        with self.settings(FACEBOOK_FAN_OUT_THRESHOLD=10):
+            TimelineEntry.objects.fan_out(pushed)
+        pulled = create_post(self.bob)
+        self.assertFalse(TimelineEntry.objects.fan_out(pulled))
+        self.assertEqual(self.wall(self.alice), [pulled.pk, pushed.pk])
+        self.assertEqual([post.pk for post in FacebookPost.objects.wall_post(self.alice, limit=1)], [pulled.pk])
+
+    def test_unfriending_clears_the_timeline(self):
+        post = create_post(self.bob, privacy='FND')
+        TimelineEntry.objects.fan_out(post)
+        Friend.objects.remove_friend(self.alice, self.bob)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.alice, post=post).exists())
+        self.assertEqual(self.wall(self.alice), [])
+        self.assertEqual(self.wall(self.bob), [post.pk])
+
+    def test_new_friends_fan_in_earlier_posts(self):
+        older = create_post(self.carol, minutes_ago=10)
+        TimelineEntry.objects.fan_out(older)
+        FriendshipRequest.objects.create(from_user=self.carol, to_user=self.alice).accept()
+        self.assertEqual(self.wall(self.alice), [older.pk])
+
+        dave = User.objects.create_user('dave')
+        request = FriendshipRequest.objects.create(from_user=self.carol, to_user=dave)
+        Friend.objects.bulk_accept(dave, [request.pk])
+        self.assertEqual(self.wall(dave), [older.pk])
+
+    @override_settings(FACEBOOK_FAN_IN_LIMIT=2)
+    def test_bulk_accept_fans_in_once_per_batch(self):
+        dave = User.objects.create_user('dave')
+        posts = {}
+        for owner in (self.carol, dave):
+            posts[owner] = [create_post(owner, minutes_ago=minutes) for minutes in (3, 2, 1)]
+            for post in posts[owner]:
+                TimelineEntry.objects.fan_out(post)
+        requests = [FriendshipRequest.objects.create(from_user=sender, to_user=self.alice).pk
+                    for sender in (self.carol, dave)]
+        with CaptureQueriesContext(connection) as queries:
+            Friend.objects.bulk_accept(self.alice, requests)
+        post_reads = [query['sql'] for query in queries
+                      if query['sql'].startswith('SELECT') and 'FROM "UserDetail_facebookpost"' in query['sql']]
+        self.assertEqual(len(post_reads), 1)
+        self.assertEqual(set(self.wall(self.alice)),
+                         set(post.pk for post in posts[self.carol][1:] + posts[dave][1:]))
+
+    def test_backfill_command(self):
+        posts = [create_post(owner, minutes_ago=minutes)
+                 for owner, minutes in ((self.alice, 3), (self.bob, 2), (self.carol, 1))]
+        call_command('backfill_timeline', batch_size=2, stdout=io.StringIO())
+        self.assertFalse(FacebookPost.objects.filter(fanned_out=False).exists())
+        self.assertEqual(TimelineEntry.objects.count(), 5)
+        self.assertEqual(self.wall(self.alice), [posts[1].pk, posts[0].pk])
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        created = timezone.now()
+        for index in range(5):
+            # Equal timestamps, the id breaks the ties
+            Follow.objects.create(follower=User.objects.create_user('fan%s' % index), followee=self.user,
+                                  created=created if index < 3 else created - timedelta(minutes=index))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages_cover_the_list_once(self):
+        unpaginated = self.client.get('/facebook/followers/').data
+        self.assertEqual(len(unpaginated), 5)
+        seen = []
+        url = '/facebook/followers/?page_size=2'
+        while url:
+            page = self.client.get(url).data
+            self.assertLessEqual(len(page['results']), 2)
+            seen.extend(page['results'])
+            url = page['next']
+        followers = [row['follower'] for row in seen]
+        self.assertEqual(sorted(followers), sorted(row['follower'] for row in unpaginated))
+        # Newest first, ties newest id first
+        self.assertEqual(followers, list(Follow.objects.filter(followee=self.user).order_by('-created', '-id')
+                                         .values_list('follower', flat=True)))
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/facebook/followers/?cursor=nonsense').status_code, 404)
+
+
+class PostCounterTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.post = create_post(self.user)
+
+    def counts(self, post=None):
+        return FacebookPost.objects.filter(pk=(post or self.post).pk) \
+            .values_list('like_count', 'share_count', 'comment_count').get()
+
+    def test_actions_move_the_counters(self):
+        like = PostAction.objects.create(action_type='L', user=self.user, post=self.post)
+        PostAction.objects.create(action_type='C', user=self.user, post=self.post, comments='hi')
+        self.assertEqual(self.counts(), (1, 0, 1))
+        like.action_type = 'S'
+        like.save()
+        self.assertEqual(self.counts(), (0, 1, 1))
+        other = create_post(self.user)
+        like.post = other
+        like.save()
+        self.assertEqual((self.counts(), self.counts(other)), ((0, 0, 1), (0, 1, 0)))
+        like.delete()
+        self.assertEqual(self.counts(other), (0, 0, 0))
+
+    def test_delete_never_goes_below_zero(self):
+        action = PostAction.objects.create(action_type='L', user=self.user, post=self.post)
+        FacebookPost.objects.filter(pk=self.post.pk).update(like_count=0)
+        action.delete()
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_repair_command(self):
+        PostAction.objects.create(action_type='L', user=self.user, post=self.post)
+        FacebookPost.objects.filter(pk=self.post.pk).update(like_count=7, comment_count=2)
+        call_command('repair_post_counters', stdout=io.StringIO())
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+
+class FriendGraphCacheTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+
+    def test_friendship_changes_invalidate(self):
+        self.assertFalse(Friend.objects.are_friends(self.alice, self.bob))
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        self.assertTrue(Friend.objects.are_friends(self.alice, self.bob))
+        self.assertEqual(list(Friend.objects.friend_ids(self.bob)), [self.alice.pk])
+        with self.assertNumQueries(0):
+            Friend.objects.friend_ids(self.bob)
+        Friend.objects.remove_friend(self.alice, self.bob)
+        self.assertFalse(Friend.objects.are_friends(self.bob, self.alice))
+
+    def test_invalidation_during_a_load_is_kept(self):
+        loads = []
+
+        def loader(user_id):
+            loads.append(user_id)
+            if len(loads) == 1:
+                # A Friend signal fires while the first load is running
+                cache.invalidate(user_id)
+            return [len(loads)]
+        cache = FriendGraphCache(loader, ttl=300)
+        self.assertEqual(list(cache.friend_ids(1)), [1])
+        self.assertEqual(list(cache.friend_ids(1)), [2])
+        self.assertEqual(list(cache.friend_ids(1)), [2])
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_memory_cap_evicts_least_recently_used(self):
+        cache = FriendGraphCache(lambda user_id: range(10), max_bytes=3 * (80 + 128), ttl=300)
+        for user_id in range(5):
+            cache.friend_ids(user_id)
+        self.assertEqual(list(cache.entries), [2, 3, 4])
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+
+class FriendSuggestionTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.users = dict((name, User.objects.create_user(name))
+                          for name in ('alice', 'bob', 'carol', 'dave', 'erin', 'frank'))
+        for from_user, to_user in (('bob', 'alice'), ('erin', 'alice'), ('carol', 'bob'), ('dave', 'bob'),
+                                   ('carol', 'erin')):
+            self.befriend(from_user, to_user)
+
+    def befriend(self, from_user, to_user):
+        FriendshipRequest.objects.create(from_user=self.users[from_user], to_user=self.users[to_user]).accept()
+
+    def suggested(self, name):
+        return [(suggestion.suggested.username, suggestion.mutual_count)
+                for suggestion in FriendSuggestion.objects.suggestions(self.users[name])]
+
+    def test_ranked_by_mutual_friends(self):
+        FriendshipRequest.objects.create(from_user=self.users['alice'], to_user=self.users['frank'])
+        self.befriend('frank', 'carol')
+        FriendSuggestion.objects.refresh([self.users['alice'].pk, self.users['frank'].pk])
+        # Friends, the user and pending requests are never suggested
+        self.assertEqual(self.suggested('alice'), [('carol', 2), ('dave', 1)])
+        self.assertEqual(self.suggested('frank'), [('bob', 1), ('erin', 1)])
+
+    def test_rejected_requests_are_suggested_again(self):
+        request = FriendshipRequest.objects.create(from_user=self.users['alice'], to_user=self.users['carol'])
+        FriendSuggestion.objects.refresh([self.users['alice'].pk])
+        self.assertEqual(self.suggested('alice'), [('dave', 1)])
+        Friend.objects.bulk_reject(self.users['carol'], [request.pk])
+        FriendSuggestion.objects.refresh([self.users['alice'].pk])
+        self.assertEqual(self.suggested('alice'), [('carol', 2), ('dave', 1)])
+
+    @override_settings(FACEBOOK_SUGGESTION_REFRESH_DELAY=0)
+    def test_refresh_covers_the_friends_of_changed_users(self):
+        FriendSuggestion.objects.refresh([user.pk for user in self.users.values()])
+        self.assertEqual(self.suggested('alice'), [('carol', 2), ('dave', 1)])
+        self.befriend('frank', 'bob')
+        # What the Friend signals queue after commit
+        self.assertEqual(suggestions.refresh_queue.flush(), 0)
+        suggestions.refresh_queue.add(self.users['frank'].pk, self.users['bob'].pk)
+        self.assertEqual(suggestions.refresh_queue.pending(), set())
+        self.assertEqual(self.suggested('alice'), [('carol', 2), ('dave', 1), ('frank', 1)])
+        self.assertEqual(self.suggested('dave'), [('alice', 1), ('carol', 1), ('frank', 1)])
+
+    def test_neighbourhood(self):
+        self.assertEqual(suggestions.neighbourhood([self.users['alice'].pk]),
+                         set(self.users[name].pk for name in ('alice', 'bob', 'erin')))
+
+
+class BulkFriendRequestTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice = User.objects.create_user('alice')
+        self.senders = [User.objects.create_user('fan%s' % index) for index in range(3)]
+        self.requests = [FriendshipRequest.objects.create(from_user=sender, to_user=self.alice)
+                         for sender in self.senders]
+        self.other = FriendshipRequest.objects.create(from_user=self.senders[0], to_user=self.senders[1])
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def post(self, action, ids):
+        return self.client.post('/facebook/bulk_friend_request/', {'action': action, 'ids': ids}, format='json')
+
+    def test_accept(self):
+        # A reverse request from alice goes away with the accepted one
+        FriendshipRequest.objects.create(from_user=self.alice, to_user=self.senders[1])
+        ids = [request.pk for request in self.requests[:2]]
+        response = self.post('accept', ids + [self.other.pk])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], sorted(
+            [{'id': pk, 'status': 'accepted'} for pk in ids] + [{'id': self.other.pk, 'status': 'not_found'}],
+            key=lambda row: row['id']))
+        for sender in self.senders[:2]:
+            self.assertTrue(Friend.objects.are_friends(self.alice, sender))
+            self.assertTrue(Friend.objects.are_friends(sender, self.alice))
+        self.assertFalse(Friend.objects.are_friends(self.alice, self.senders[2]))
+        self.assertEqual(set(FriendshipRequest.objects.values_list('pk', flat=True)),
+                         {self.requests[2].pk, self.other.pk})
+
+    def test_accept_is_idempotent(self):
+        Friend.objects.bulk_accept(self.alice, [self.requests[0].pk])
+        self.assertEqual(Friend.objects.bulk_accept(self.alice, [self.requests[0].pk]),
+                         {self.requests[0].pk: 'not_found'})
+        self.assertEqual(Friend.objects.filter(to_user=self.alice).count(), 1)
+
+    def test_reject_and_mark_viewed(self):
+        ids = [request.pk for request in self.requests[:2]]
+        with self.assertNumQueries(4):
+            self.assertEqual(Friend.objects.bulk_reject(self.alice, ids + [self.other.pk]),
+                             dict([(pk, 'rejected') for pk in ids] + [(self.other.pk, 'not_found')]))
+        self.assertEqual(len(Friend.objects.rejected_requests(self.alice)), 2)
+        self.assertEqual(Friend.objects.unrejected_request_count(self.alice), 1)
+        self.assertIsNone(FriendshipRequest.objects.get(pk=self.other.pk).rejected)
+
+        response = self.post('mark_viewed', [self.requests[2].pk])
+        self.assertEqual(response.data['results'], [{'id': self.requests[2].pk, 'status': 'viewed'}])
+        self.assertEqual([request.pk for request in Friend.objects.read_requests(self.alice)], [self.requests[2].pk])
+
+    def test_validation(self):
+        self.assertEqual(self.post('delete', [self.requests[0].pk]).status_code, 400)
+        self.assertEqual(self.post('accept', []).status_code, 400)
+        with self.settings(FACEBOOK_BULK_REQUEST_LIMIT=2):
+            self.assertEqual(self.post('reject', [request.pk for request in self.requests]).status_code, 400)
+
+
+class RelationshipLookupTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol, self.dave, self.erin = [
+            User.objects.create_user(name) for name in ('alice', 'bob', 'carol', 'dave', 'erin')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        Follow.objects.create(follower=self.alice, followee=self.bob)
+        FriendshipRequest.objects.create(from_user=self.carol, to_user=self.alice)
+        FriendshipRequest.objects.create(from_user=self.alice, to_user=self.dave)
+        FriendshipRequest.objects.create(from_user=self.erin, to_user=self.alice).reject()
+
+    def test_flags(self):
+        with self.assertNumQueries(4):
+            lookup = Friend.objects.relationships(self.alice, [user.pk for user in (
+                self.bob, self.carol, self.dave, self.erin)])
+        flags = ('friend', 'following', 'incoming_request', 'outgoing_request')
+        self.assertEqual([[name for name in flags if lookup[user.pk][name]]
+                          for user in (self.bob, self.carol, self.dave, self.erin)],
+                         [['friend', 'following'], ['incoming_request'], ['outgoing_request'], []])
+
+    def test_rejected_outgoing_request_is_not_pending(self):
+        FriendshipRequest.objects.get(from_user=self.alice, to_user=self.dave).reject()
+        self.assertFalse(Friend.objects.relationships(self.alice, [self.dave.pk])[self.dave.pk]['outgoing_request'])
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.post('/facebook/relationships/', {'ids': [self.carol.pk, self.bob.pk]}, format='json')
+        self.assertEqual([row['id'] for row in response.data['results']], [self.bob.pk, self.carol.pk])
+        self.assertTrue(response.data['results'][1]['incoming_request'])
+
+
+class StreamingExportTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice = User.objects.create_user('alice')
+        for index in range(5):
+            fan = User.objects.create_user('fan%s' % index)
+            Follow.objects.create(follower=fan, followee=self.alice)
+            if index % 2:
+                FriendshipRequest.objects.create(from_user=fan, to_user=self.alice).accept()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def streamed(self, url):
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
+    def test_streams_the_serialized_rows(self):
+        followers = Follow.objects.followers_queryset(self.alice).order_by('-created', '-id')
+        self.assertEqual(self.streamed('/facebook/followers/?stream=1'),
+                         json.loads(JSONRenderer().render(FollowSerializer(followers, many=True).data).decode('utf-8')))
+        friends = Friend.objects.friends_queryset(self.alice).order_by('-created', '-id')
+        self.assertEqual(self.streamed('/facebook/friends_list/?stream=1'),
+                         json.loads(JSONRenderer().render(FriendSerializer(friends, many=True).data).decode('utf-8')))
+        self.assertEqual(self.streamed('/facebook/following/?stream=true'), [])
+
+    def test_chunks(self):
+        queryset = Follow.objects.followers_queryset(self.alice).order_by('-created', '-id')
+        chunks = list(streaming.stream_json_rows(queryset, ('follower',), rows_per_chunk=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(len(json.loads(''.join(chunks))), 5)
+        self.assertEqual(''.join(streaming.stream_json_rows(queryset.none(), ('follower',))), '[]')
+
+
+class PostPrivacyTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        self.posts = dict((privacy, create_post(self.alice, minutes_ago=minutes, privacy=privacy, message=privacy))
+                          for minutes, privacy in enumerate(('ALL', 'FND', 'ME')))
+        for post in self.posts.values():
+            TimelineEntry.objects.fan_out(post)
+
+    def listed(self, viewer, pk=None):
+        client = APIClient()
+        client.force_authenticate(viewer)
+        response = client.get('/facebook/post_list/%s/' % (pk or self.alice.pk))
+        self.assertEqual(response.status_code, 200)
+        return [row['message'] for row in response.data]
+
+    def test_profile_posts_per_viewer(self):
+        self.assertEqual(self.listed(self.alice), ['ALL', 'FND', 'ME'])
+        self.assertEqual(self.listed(self.alice, 'None'), ['ALL', 'FND', 'ME'])
+        self.assertEqual(self.listed(self.bob), ['ALL', 'FND'])
+        self.assertEqual(self.listed(self.carol), ['ALL'])
+        self.assertEqual(self.listed(self.carol, 'None'), [])
+
+    def test_unknown_owner(self):
+        client = APIClient()
+        client.force_authenticate(self.carol)
+        self.assertEqual(client.get('/facebook/post_list/%s/' % (self.carol.pk + 100)).status_code, 404)
+
+    def test_wall_after_unfriending(self):
+        wall = [post.message for post in FacebookPost.objects.wall_post(self.bob)]
+        self.assertEqual(wall, ['ALL', 'FND'])
+        Friend.objects.remove_friend(self.bob, self.alice)
+        self.assertEqual(FacebookPost.objects.wall_post(self.bob), [])
+        # An entry the unfriend cleanup missed stays hidden too
+        TimelineEntry.objects.create(user=self.bob, post=self.posts['FND'], created_time=self.posts['FND'].created_time)
+        self.assertEqual(FacebookPost.objects.wall_post(self.bob), [])
+        self.assertEqual(self.listed(self.bob), ['ALL'])
+
+
+class NearbyPostsTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        # About 0, 1.1, 5.6 and 111 km north of the search point
+        for name, lat, owner, privacy in (('here', '57.0', self.carol, 'ALL'), ('close', '57.01', self.bob, 'FND'),
+                                          ('town', '57.05', self.carol, 'ALL'), ('far', '58.0', self.carol, 'ALL'),
+                                          ('hidden', '57.0', self.carol, 'FND')):
+            create_post(owner, message=name, privacy=privacy, place_lat=lat, place_long='10.0')
+
+    def test_nearest_first(self):
+        with self.assertNumQueries(2):
+            posts = FacebookPost.objects.nearby(self.alice, 57.0, 10.0, 10)
+        self.assertEqual([post.message for post in posts], ['here', 'close', 'town'])
+        self.assertAlmostEqual(posts[1].distance, 1.11, places=2)
+        self.assertEqual([post.message for post in FacebookPost.objects.nearby(self.carol, 57.0, 10.0, 2)],
+                         ['here', 'hidden'])
+        self.assertEqual(FacebookPost.objects.nearby(self.alice, 0.0, 0.0, 10), [])
+
+    def test_candidates_are_bounded(self):
+        with self.settings(FACEBOOK_NEARBY_CANDIDATES=2):
+            posts = FacebookPost.objects.nearby(self.carol, 57.0, 10.0, 10, fields=('message',))
+        # The two newest candidates only
+        self.assertEqual([post.message for post in posts], ['hidden', 'town'])
+        self.assertEqual(posts[0].get_deferred_fields() & {'message', 'caption'}, {'caption'})
+
+    def test_cells_are_read_from_the_geohash_index(self):
+        cells = FacebookPost.objects.filter(FacebookPost.objects.covering_filter(57.0, 10.0, 10))
+        self.assertEqual(cells.count(), 4)
+        sql, params = cells.values_list('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('geohash', plan)
+        self.assertNotIn('SCAN UserDetail_facebookpost', plan)
+
+    def test_backfill_updates_a_batch_at_once(self):
+        FacebookPost.objects.update(latitude=None, longitude=None, geohash=None)
+        FacebookPost.objects.filter(message='far').update(place_lat='north')
+        with CaptureQueriesContext(connection) as queries:
+            call_command('backfill_post_locations', stdout=io.StringIO())
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        here = FacebookPost.objects.get(message='here')
+        self.assertEqual((here.latitude, here.longitude, here.geohash), (57.0, 10.0, geo.encode(57.0, 10.0)))
+        self.assertIsNone(FacebookPost.objects.get(message='far').geohash)
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.get('/facebook/posts_near/?lat=57&long=10&radius=2')
+        self.assertEqual([row['message'] for row in response.data], ['here', 'close'])
+        self.assertIn('distance', response.data[0])
+        response = client.get('/facebook/posts_near/?bbox=56.9,9.9,57.02,10.1')
+        self.assertEqual([row['message'] for row in response.data], ['close', 'here'])
+
+
+class PostSearchTest(TestCase):
+
+    def setUp(self):
+        if not search.fts_available():
+            self.skipTest('SQLite without FTS5')
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        self.once = create_post(self.carol, message='a long day of hiking in the hills')
+        self.twice = create_post(self.carol, message='hiking', caption='more hiking')
+        self.friends = create_post(self.bob, message='hiking with friends', privacy='FND')
+
+    def found(self, viewer, query, **kwargs):
+        return [post.pk for post in search.search_posts(viewer, query, **kwargs)]
+
+    def test_ranked_and_private(self):
+        results = search.search_posts(self.alice, 'hiking')
+        self.assertEqual(set(post.pk for post in results), {self.once.pk, self.twice.pk, self.friends.pk})
+        self.assertEqual([post.rank for post in results], sorted(post.rank for post in results))
+        self.assertIn('<b>hiking</b>', results[0].snippet)
+        self.assertEqual(set(self.found(self.carol, 'hiking')), {self.once.pk, self.twice.pk})
+        self.assertEqual(self.found(self.alice, 'hiking hills'), [self.once.pk])
+        self.assertEqual(self.found(self.alice, '   '), [])
+
+    def test_limit_pages_past_hidden_matches(self):
+        # Better matches carol can't see fill the first page of 4 matches
+        for _ in range(4):
+            create_post(self.bob, message='hiking hiking hiking', privacy='FND')
+        self.assertEqual(self.found(self.carol, 'hiking', limit=1), [self.twice.pk])
+        with self.settings(FACEBOOK_SEARCH_LIMIT=2):
+            self.assertEqual(self.found(self.carol, 'hiking'), [self.twice.pk, self.once.pk])
+
+    def test_candidates_checked_are_capped(self):
+        for _ in range(4):
+            create_post(self.bob, message='hiking hiking hiking', privacy='FND')
+        with self.settings(FACEBOOK_SEARCH_MAX_CANDIDATES=5):
+            with CaptureQueriesContext(connection) as queries:
+                found = self.found(self.carol, 'hiking', limit=2)
+        # One page of 5 matches, the 4 hidden ones and the best visible one
+        self.assertEqual(found, [self.twice.pk])
+        self.assertEqual(len(queries), 2)
+
+    def test_index_follows_edits_and_deletes(self):
+        self.once.message = 'a quiet day at home'
+        self.once.save()
+        self.assertEqual(self.found(self.carol, 'hills'), [])
+        self.assertEqual(self.found(self.carol, 'quiet'), [self.once.pk])
+        pk = self.twice.pk
+        self.twice.delete()
+        self.assertNotIn(pk, self.found(self.carol, 'hiking'))
+
+    def test_reindex_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM "%s"' % search.FTS_TABLE)
+        self.assertEqual(self.found(self.alice, 'hiking'), [])
+        call_command('reindex_posts', stdout=io.StringIO())
+        self.assertEqual(len(self.found(self.alice, 'hiking')), 3)
+
+
+class ProfileCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.url = '/facebook/%s/' % self.profile.pk
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        tag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=tag).status_code, 304)
+        self.assertEqual(self.client.get(self.url + '?fields=gender', HTTP_IF_NONE_MATCH=tag).status_code, 200)
+        self.profile.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], tag)
+
+    def test_writes_within_one_second_move_last_modified(self):
+        modified = self.client.get(self.url)['Last-Modified']
+        self.profile.save()
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], modified)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+                         304)
+
+    def test_missing_profile_is_not_found(self):
+        url = '/facebook/%s/' % (self.profile.pk + 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='*').status_code, 404)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='*').status_code, 304)
+        future = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=future).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=future).status_code, 404)
+        self.profile.delete()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=future).status_code, 404)
+
+
+class SparseProfileTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', first_name='Alice', last_name='Smith')
+        self.picture = create_post(self.user, message='me')
+        self.profile = UserProfile.objects.create(user=self.user, gender='F', profile_pic=self.picture)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, query):
+        return self.client.get('/facebook/%s/?%s' % (self.profile.pk, query))
+
+    def test_fields(self):
+        response = self.get('fields=gender,user')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(response.data), {'gender': 'F', 'user': self.user.pk})
+
+    def test_expand(self):
+        data = self.get('fields=user.first_name,profile_pic.message').data
+        self.assertEqual(dict(data['user']), {'first_name': 'Alice'})
+        self.assertEqual(dict(data['profile_pic']), {'message': 'me'})
+        self.assertEqual(set(data), {'user', 'profile_pic'})
+        data = self.get('expand=user').data
+        self.assertEqual(dict(data['user']), {'id': self.user.pk, 'username': 'alice', 'first_name': 'Alice',
+                                              'last_name': 'Smith'})
+        self.assertEqual(data['profile_pic'], self.picture.pk)
+
+    def test_loads_only_the_needed_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.get('fields=gender,user.username')
+        select = [query['sql'] for query in queries.captured_queries if 'UserDetail_userprofile' in query['sql']]
+        self.assertEqual(len(select), 1)
+        self.assertIn('"auth_user"."username"', select[0])
+        self.assertNotIn('about_you', select[0])
+        self.assertNotIn('"auth_user"."password"', select[0])
+
+    def test_unknown_fields(self):
+        response = self.get('fields=gender,password,user.password&expand=friends')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['fields'], ['Unknown fields: friends, password, user.password'])
+
+
+@skipIf(media.Image is None, 'Pillow is not installed')
+class UploadFailureTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.user = User.objects.create_user('alice')
+        self.post = create_post(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_inline_processing_failure_marks_the_upload(self):
+        # A file where the storage expects a directory makes saving fail
+        media_root = os.path.join(self.temp_dir, 'media')
+        open(media_root, 'w').close()
+        with self.settings(MEDIA_ROOT=media_root, FACEBOOK_UPLOAD_TEMP_DIR=self.temp_dir, FACEBOOK_MEDIA_WORKERS=0):
+            upload_id = self.client.post('/facebook/uploads/', {
+                'post': self.post.pk, 'field': 'picture', 'filename': 'photo.png', 'total_size': 3,
+            }, format='json').data['id']
+            with self.assertLogs('UserDetail.media', 'ERROR'):
+                response = self.client.put('/facebook/uploads/%s/' % upload_id, b'abc',
+                                           content_type='application/octet-stream',
+                                           HTTP_CONTENT_RANGE='bytes 0-2/3')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['status'], 'failed')
+            response = self.client.put('/facebook/uploads/%s/' % upload_id, b'abc',
+                                       content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-2/3')
+            self.assertEqual(response.status_code, 409)
+        self.assertFalse(FacebookPost.objects.get(pk=self.post.pk).media_ready)
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+
+    def middleware(self, view, budget=None):
+        middleware = InstrumentationMiddleware(None)
+
+        @query_budget(budget)
+        def budgeted(request):
+            return view(request)
+
+        def get_response(request):
+            middleware.process_view(request, budgeted if budget is not None else view, (), {})
+            return view(request)
+        middleware.get_response = get_response
+        return middleware
+
+    def count_users(self, request):
+        User.objects.count()
+        User.objects.count()
+        return HttpResponse('ok')
+
+    def test_counts_without_the_debug_log(self):
+        log_size = len(connection.queries_log)
+        response = self.middleware(self.count_users)(RequestFactory().get('/'))
+        self.assertEqual(response['X-Query-Count'], '2')
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertEqual(len(connection.queries_log), log_size)
+
+    def test_counts_with_a_full_debug_log(self):
+        connection.queries_log.extend({'sql': '', 'time': '0'} for _ in range(connection.queries_log.maxlen))
+        with CaptureQueriesContext(connection):
+            response = self.middleware(self.count_users)(RequestFactory().get('/'))
+        self.assertEqual(response['X-Query-Count'], '2')
+
+    def test_nested_requests_count_for_the_outer_one(self):
+        inner = self.middleware(self.count_users)
+
+        def outer(request):
+            User.objects.count()
+            return inner(request)
+        response = self.middleware(outer)(RequestFactory().get('/'))
+        self.assertEqual(response['X-Query-Count'], '3')
+
+    @override_settings(FACEBOOK_ENFORCE_QUERY_BUDGETS=True)
+    def test_budget(self):
+        self.assertEqual(self.middleware(self.count_users, budget=2)(RequestFactory().get('/')).status_code, 200)
+        with self.assertRaises(instrumentation.QueryBudgetExceeded):
+            self.middleware(self.count_users, budget=1)(RequestFactory().get('/'))
+
+
+class BenchmarkHarnessTest(TestCase):
+
+    def setUp(self):
+        friend_graph.clear()
+        self.alice, self.bob, self.carol = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        FriendshipRequest.objects.create(from_user=self.bob, to_user=self.alice).accept()
+        FriendshipRequest.objects.create(from_user=self.carol, to_user=self.alice)
+        create_post(self.alice, message='a post', place_lat='57.0', place_long='10.0')
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(samples, 0.5), 50)
+        self.assertEqual(benchmark.percentile(samples, 0.99), 99)
+        self.assertEqual(benchmark.percentile([3], 0.95), 3)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+
+    def test_every_view_has_a_scenario(self):
+        fixture = benchmark.pick_fixture()
+        missing = set(benchmark.url_views()) - set(benchmark.scenarios(fixture)) - set(benchmark.SKIPPED_VIEWS)
+        self.assertEqual(missing, set())
+
+    def test_command_reports_and_compares(self):
+        counts = (User.objects.count(), FacebookPost.objects.count(), FriendshipRequest.objects.count())
+        output = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output))
+        call_command('benchmark_endpoints', iterations=1, output=output, stdout=io.StringIO())
+        with open(output) as handle:
+            report = json.load(handle)
+        self.assertEqual(report['meta']['users'], 3)
+        feed = report['endpoints']['feed']
+        self.assertEqual(feed['status'], 200)
+        self.assertGreater(feed['queries'], 0)
+        self.assertIn('skipped', report['endpoints']['login'])
+        # The fixture rows and the writes of the scenarios are rolled back
+        self.assertEqual((User.objects.count(), FacebookPost.objects.count(), FriendshipRequest.objects.count()),
+                         counts)
+
+        stdout = io.StringIO()
+        call_command('benchmark_endpoints', iterations=1, baseline=output, stdout=stdout)
+        self.assertIn('Against %s' % output, stdout.getvalue())
+        rows = dict((name, (ratio, queries)) for name, ratio, queries in benchmark.compare(report, report))
+        self.assertEqual(rows['feed'], (1.0, 0))
+        self.assertNotIn('login', rows)
+
+    def test_empty_database(self):
+        User.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('benchmark_endpoints', iterations=1, stdout=io.StringIO())
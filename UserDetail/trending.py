@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import heapq
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from array import array
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Mersenne prime of the multiply-shift row hashes
+PRIME = (1 << 61) - 1
+
+# Candidates kept per slot of the top-K, spare room for keys climbing up
+CANDIDATE_FACTOR = 2
+
+# Name of this process in the snapshot table
+SOURCE = '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def action_weights():
+    return getattr(settings, 'FACEBOOK_TRENDING_WEIGHTS', {'L': 1, 'C': 2, 'S': 3})
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of integer keys in depth rows of width counters.
+
+    An estimate never falls below the true count, it goes over by at most
+    2 / width of the total count with probability 1 - 2 ** -depth.
+    """
+
+    def __init__(self, width, depth, seed=0):
+        self.width = width
+        self.depth = depth
+        generator = random.Random(seed)
+        self.hashes = [(generator.randrange(1, PRIME), generator.randrange(PRIME)) for _ in range(depth)]
+        self.rows = [array('q', [0]) * width for _ in range(depth)]
+
+    def cells(self, key):
+        return [((a * key + b) % PRIME) % self.width for a, b in self.hashes]
+
+    def add(self, key, count=1):
+        for row, cell in zip(self.rows, self.cells(key)):
+            row[cell] += count
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.rows, self.cells(key)))
+
+    def subtract(self, other):
+        """ Remove the counts of a sketch built with the same seed """
+        for row, other_row in zip(self.rows, other.rows):
+            for cell, count in enumerate(other_row):
+                if count:
+                    row[cell] -= count
+
+
+class SlidingWindowTopK(object):
+    """
+    Approximate top-K keys by count over the last window seconds.
+
+    Counts go to the sketch of the current bucket_seconds bucket and to a
+    running sketch of the whole window, buckets leaving the window are
+    subtracted from it. A min-heap keeps the candidates for the top-K, a key
+    replaces the weakest one once its estimate is higher.
+    """
+
+    def __init__(self, window=None, bucket=None, width=None, depth=None, size=None):
+        self.bucket_seconds = bucket or getattr(settings, 'FACEBOOK_TRENDING_BUCKET_SECONDS', 60)
+        self.window_seconds = window or getattr(settings, 'FACEBOOK_TRENDING_WINDOW_SECONDS', 3600)
+        self.width = width or getattr(settings, 'FACEBOOK_TRENDING_SKETCH_WIDTH', 2048)
+        self.depth = depth or getattr(settings, 'FACEBOOK_TRENDING_SKETCH_DEPTH', 4)
+        self.size = size or getattr(settings, 'FACEBOOK_TRENDING_SIZE', 50)
+        self.buckets = max(1, self.window_seconds // self.bucket_seconds)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.window = CountMinSketch(self.width, self.depth)
+        self.ring = deque()
+        self.candidates = {}
+        self.heap = []
+
+    def advance(self, now):
+        """ Open the bucket of now and drop the buckets outside the window """
+        index = int(now // self.bucket_seconds)
+        if not self.ring or self.ring[-1][0] < index:
+            self.ring.append((index, CountMinSketch(self.width, self.depth)))
+        expired = False
+        while self.ring[0][0] <= index - self.buckets:
+            self.window.subtract(self.ring.popleft()[1])
+            expired = True
+        if expired:
+            self.candidates = dict((key, self.window.estimate(key)) for key in self.candidates)
+            self.candidates = dict((key, count) for key, count in self.candidates.items() if count > 0)
+            self.rebuild()
+
+    def rebuild(self):
+        self.heap = [(count, key) for key, count in self.candidates.items()]
+        heapq.heapify(self.heap)
+
+    def offer(self, key, count):
+        capacity = self.size * CANDIDATE_FACTOR
+        if key not in self.candidates and len(self.candidates) >= capacity:
+            # Entries whose count changed since they were pushed are stale
+            while self.heap and self.candidates.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if count <= self.heap[0][0]:
+                return
+            del self.candidates[heapq.heappop(self.heap)[1]]
+        self.candidates[key] = count
+        heapq.heappush(self.heap, (count, key))
+        if len(self.heap) > 4 * capacity:
+            self.rebuild()
+
+    def add(self, key, count=1, now=None):
+        with self.lock:
+            self.advance(time.time() if now is None else now)
+            self.ring[-1][1].add(key, count)
+            self.window.add(key, count)
+            self.offer(key, self.window.estimate(key))
+
+    def top(self, limit=None, now=None):
+        """ [(key, estimated count), ...] of the window, highest first """
+        with self.lock:
+            self.advance(time.time() if now is None else now)
+            return heapq.nlargest(limit or self.size, self.candidates.items(), key=lambda item: (item[1], -item[0]))
+
+
+class TrendingPosts(SlidingWindowTopK):
+    """
+    Weighted post actions of this process, snapshotted to the TrendingPost table.
+
+    The snapshot is written every FACEBOOK_TRENDING_SNAPSHOT_SECONDS by a
+    timer started with the first action, the trending endpoint sums the
+    recent snapshots of every process. An unlike does not take an action
+    back, trending is about activity.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TrendingPosts, self).__init__(*args, **kwargs)
+        self.timer = None
+
+    def record(self, post_id, action_type, now=None):
+        weight = action_weights().get(action_type, 0)
+        if weight:
+            self.add(post_id, weight, now)
+            self.schedule()
+
+    def schedule(self):
+        interval = getattr(settings, 'FACEBOOK_TRENDING_SNAPSHOT_SECONDS', 60)
+        with self.lock:
+            if self.timer is not None or not interval:
+                return
+            self.timer = threading.Timer(interval, self.snapshot_in_thread)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def snapshot(self, now=None):
+        """ Store the top posts of this process, returns the number of rows written """
+        from UserDetail.models import TrendingPost
+        return TrendingPost.objects.store(SOURCE, self.top(now=now))
+
+    def snapshot_in_thread(self):
+        """ Timer callback, the timer thread has its own connections """
+        with self.lock:
+            self.timer = None
+        try:
+            self.snapshot()
+        except Exception:
+            logger.exception('Trending snapshot failed')
+        finally:
+            connections.close_all()
+        self.schedule()
+
+
+trending_posts = TrendingPosts()
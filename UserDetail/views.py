@@ -1,24 +1,51 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+
 from UserDetail.models import UserProfile,\
     FriendshipRequest,\
     PostManager,\
     Friend,\
-    Follow, FacebookPost
+    Follow, FacebookPost,\
+    MediaUpload,\
+    TimelineEntry,\
+    TrendingPost,\
+    FriendSuggestion
 from UserDetail.serializers import UserDetailSerializer,\
+    SparseUserDetailSerializer,\
     FriendshipRequestSerializer,\
+    BulkFriendshipRequestSerializer,\
+    RelationshipLookupSerializer,\
+    BatchRequestSerializer,\
     PostActionSerializer,\
     FacebookPostSerializer,\
+    NearbyPostSerializer,\
+    NearbyQuerySerializer,\
+    SearchPostSerializer,\
+    TrendingPostSerializer,\
+    RankedPostSerializer,\
+    FeedQuerySerializer,\
+    TrendingQuerySerializer,\
+    MediaUploadSerializer,\
     FollowSerializer,\
-    FriendSerializer
+    FriendSerializer,\
+    FriendSuggestionSerializer
+from UserDetail import action_buffer, batch as batch_requests, media, profile_cache
+from UserDetail.instrumentation import query_budget
+from UserDetail.pagination import KeysetPagination, paginated_response
+from UserDetail.search import search_posts
+from UserDetail.streaming import stream_requested, streaming_json_response
+from django.contrib.auth.models import User
 from django.http import Http404
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view
 
 
+@query_budget(4, methods=('GET',))
 class UserProfileDetail(APIView):
     """
     Create, Retrieve, update or delete a user detail instance.
@@ -29,11 +56,33 @@ class UserProfileDetail(APIView):
         except UserProfile.DoesNotExist:
             raise Http404
 
+    def get_sparse_object(self, pk, sparse):
+        try:
+            return SparseUserDetailSerializer.queryset(sparse).get(pk=pk, user__is_active=True)
+        except UserProfile.DoesNotExist:
+            raise Http404
+
     def get(self, request, pk, format=None):
-        """ Get User Details"""
-        user_detail = self.get_object(pk)
-        serializer = UserDetailSerializer(user_detail)
-        return Response(serializer.data)
+        """ Get User Details, pruned with ?fields= and ?expand= """
+        variant = ''
+        if 'fields' in request.query_params or 'expand' in request.query_params:
+            try:
+                sparse = SparseUserDetailSerializer.parse(request.query_params)
+            except ValidationError as exc:
+                return Response(exc.detail, status=status.HTTP_400_BAD_REQUEST)
+            variant = profile_cache.variant_key(sparse)
+
+        if profile_cache.not_modified(request, pk, variant):
+            version, modified = profile_cache.current_version(pk)
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            return profile_cache.set_validators(response, pk, version, modified, variant)
+
+        if variant:
+            loader = lambda: SparseUserDetailSerializer(self.get_sparse_object(pk, sparse), sparse=sparse).data
+        else:
+            loader = lambda: UserDetailSerializer(self.get_object(pk)).data
+        payload, version, modified = profile_cache.cached_payload(pk, loader, variant)
+        return profile_cache.set_validators(Response(payload), pk, version, modified, variant)
 
     def put(self, request, pk, format=None):
         """ Update User Details"""
@@ -86,6 +135,27 @@ class ManageFriendRequest(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class BulkFriendRequest(APIView):
+    """
+    Accept, reject or mark viewed many received Friendship Requests at once.
+    """
+
+    def post(self, request, format=None):
+        """ apply the action to every request id """
+        serializer = BulkFriendshipRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        action = serializer.validated_data['action']
+        ids = serializer.validated_data['ids']
+        if action == 'accept':
+            results = Friend.objects.bulk_accept(request.user, ids)
+        elif action == 'reject':
+            results = Friend.objects.bulk_reject(request.user, ids)
+        else:
+            results = Friend.objects.bulk_mark_viewed(request.user, ids)
+        return Response({'results': [{'id': pk, 'status': results[pk]} for pk in sorted(results)]})
+
+
 class ManageFriends(APIView):
     """
     Give a friend request
@@ -144,6 +214,7 @@ class ManageFollowRequest(APIView):
 
 
 
+@query_budget(3, methods=('GET',))
 class PostList(APIView):
     """
     List all Post, or create, update, delete a new post.
@@ -151,19 +222,27 @@ class PostList(APIView):
 
     def get_object(self, pk):
         try:
-            return FacebookPost.objects.get(pk=pk)
+            return FacebookPost.objects.get_post(pk)
         except FacebookPost.DoesNotExist:
             raise Http404
 
+    def get_owner(self, request, pk):
+        """ The user whose posts are listed, None in the url is the requesting user """
+        if pk == 'None':
+            return request.user
+        if not User.objects.filter(pk=pk).exists():
+            raise Http404
+        return int(pk)
+
     def get(self, request, pk, format=None):
-        posts = FacebookPost.objects.profile_post(request.user)
-        serializer = FacebookPostSerializer(posts, many=True)
-        return Response(serializer.data)
+        posts = FacebookPost.objects.profile_post(self.get_owner(request, pk), request.user)
+        return paginated_response(request, posts, FacebookPostSerializer, 'created_time')
 
     def post(self, request, pk, format=None):
         serializer = FacebookPostSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            post = serializer.save()
+            TimelineEntry.objects.fan_out(post)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -181,6 +260,80 @@ class PostList(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class MediaUploadList(APIView):
+    """
+    Start a resumable chunked upload of a post picture or video.
+    """
+
+    def post(self, request, format=None):
+        serializer = MediaUploadSerializer(data=request.data)
+        if serializer.is_valid():
+            post = serializer.validated_data['post']
+            if post.owner_id != request.user.pk:
+                return Response(status=status.HTTP_403_FORBIDDEN)
+            serializer.save(owner=request.user)
+            FacebookPost.objects.using(post._state.db).filter(pk=post.pk).update(media_ready=False)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class MediaUploadDetail(APIView):
+    """
+    Get the progress of an upload, or send it the next chunk.
+    """
+    content_range = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    def get_object(self, request, pk):
+        try:
+            return MediaUpload.objects.get(pk=pk, owner=request.user)
+        except MediaUpload.DoesNotExist:
+            raise Http404
+
+    def get(self, request, pk, format=None):
+        """ received is the offset to resume from """
+        upload = self.get_object(request, pk)
+        serializer = MediaUploadSerializer(upload)
+        return Response(serializer.data)
+
+    def put(self, request, pk, format=None):
+        """ append the raw body, described by a Content-Range header """
+        match = self.content_range.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if match is None:
+            return Response({'detail': 'A "Content-Range: bytes start-end/total" header is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        start, end, total = [int(value) for value in match.groups()]
+        length = end - start + 1
+
+        upload = self.get_object(request, pk)
+        if total != upload.total_size or length <= 0 or length != int(request.META.get('CONTENT_LENGTH') or 0):
+            return Response({'detail': 'Content-Range does not match the upload'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # The body is read from the client with no transaction open. The
+        # file lock keeps concurrent chunks of the upload apart, the offset
+        # only moves from the one this chunk was written at
+        try:
+            with media.upload_lock(upload):
+                upload.refresh_from_db(fields=['received', 'status'])
+                if upload.status != 'pending':
+                    return Response({'detail': 'Upload is already complete'}, status=status.HTTP_409_CONFLICT)
+                received = media.write_chunk(upload, request.stream, start, length)
+                new_status = 'processing' if received == upload.total_size else 'pending'
+                moved = MediaUpload.objects.filter(pk=upload.pk, received=start, status='pending') \
+                    .update(received=received, status=new_status)
+        except media.UploadError as exc:
+            return Response({'detail': str(exc), 'received': upload.received}, status=status.HTTP_409_CONFLICT)
+        upload.refresh_from_db()
+        if not moved:
+            return Response({'detail': 'Another chunk moved the upload', 'received': upload.received},
+                            status=status.HTTP_409_CONFLICT)
+        if upload.status == 'processing':
+            media.process_upload(upload)
+            upload.refresh_from_db()
+        serializer = MediaUploadSerializer(upload)
+        return Response(serializer.data)
+
+
+@query_budget(3, methods=('GET',))
 class PostAction(APIView):
     """
     Get all action for a certain post, do action on the post
@@ -188,76 +341,193 @@ class PostAction(APIView):
 
     def get(self, request, pk, format=None):
         snippets = FacebookPost.objects.post_detail(pk)
-        serializer = PostActionSerializer(snippets, many=True)
-        return Response(serializer.data)
+        return paginated_response(request, snippets, PostActionSerializer)
 
     def post(self, request, pk, format=None):
         serializer = PostActionSerializer(data=request.data)
         if serializer.is_valid():
+            if action_buffer.enabled():
+                data = serializer.validated_data
+                action_buffer.post_actions.add(data['user'].pk, data['post'].pk, data['action_type'],
+                                               data.get('comments'))
+                return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def delete(self, request, pk, format=None):
+        """ Undo the actions of a type, e.g. unlike """
+        serializer = PostActionSerializer(data={
+            'post': pk, 'user': request.data.get('user'), 'action_type': request.data.get('action_type'),
+        })
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        if action_buffer.enabled():
+            action_buffer.post_actions.remove(data['user'].pk, data['post'].pk, data['action_type'])
+            return Response(status=status.HTTP_202_ACCEPTED)
+        FacebookPost.objects.remove_actions(data['post'], data['user'], data['action_type'])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friends_list(request):
-    total_friends = Friend.objects.friends(request.user)
-    serializer = FriendSerializer(total_friends, many=True)
-    return Response(serializer.data)
+    total_friends = Friend.objects.friends_queryset(request.user)
+    if stream_requested(request):
+        return streaming_json_response(total_friends.order_by('-created', '-id'), FriendSerializer.Meta.fields)
+    return paginated_response(request, total_friends, FriendSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_sent(request):
-    friend_request_sent = Friend.objects.sent_requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_sent, many=True)
-    return Response(serializer.data)
+    friend_request_sent = Friend.objects.sent_requests_queryset(request.user)
+    return paginated_response(request, friend_request_sent, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_receive(request):
-    friend_request_receive = Friend.objects.requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_receive, many=True)
-    return Response(serializer.data)
+    friend_request_receive = Friend.objects.requests_queryset(request.user)
+    return paginated_response(request, friend_request_receive, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_viewed(request):
-    friend_request_viewed = Friend.objects.read_requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_viewed, many=True)
-    return Response(serializer.data)
+    friend_request_viewed = Friend.objects.read_requests_queryset(request.user)
+    return paginated_response(request, friend_request_viewed, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_rejected(request):
-    friend_request_rejected = Friend.objects.rejected_requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_rejected, many=True)
-    return Response(serializer.data)
+    friend_request_rejected = Friend.objects.rejected_requests_queryset(request.user)
+    return paginated_response(request, friend_request_rejected, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_unrejected(request):
-    friend_request_unrejected = Friend.objects.unrejected_requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_unrejected, many=True)
-    return Response(serializer.data)
+    friend_request_unrejected = Friend.objects.unrejected_requests_queryset(request.user)
+    return paginated_response(request, friend_request_unrejected, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def friendship_request_unread(request):
-    friend_request_unread = Friend.objects.unread_requests(request.user)
-    serializer = FriendshipRequestSerializer(friend_request_unread, many=True)
-    return Response(serializer.data)
+    friend_request_unread = Friend.objects.unread_requests_queryset(request.user)
+    return paginated_response(request, friend_request_unread, FriendshipRequestSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def following(request):
-    follow_list = Follow.objects.following(request.user)
-    serializer = FollowSerializer(follow_list, many=True)
-    return Response(serializer.data)
+    follow_list = Follow.objects.following_queryset(request.user)
+    if stream_requested(request):
+        return streaming_json_response(follow_list.order_by('-created', '-id'), FollowSerializer.Meta.fields)
+    return paginated_response(request, follow_list, FollowSerializer, 'created')
 
 
+@query_budget(2)
 @api_view(['GET'])
 def followers(request):
-    follow_list = Follow.objects.followers(request.user)
-    serializer = FollowSerializer(follow_list, many=True)
+    follow_list = Follow.objects.followers_queryset(request.user)
+    if stream_requested(request):
+        return streaming_json_response(follow_list.order_by('-created', '-id'), FollowSerializer.Meta.fields)
+    return paginated_response(request, follow_list, FollowSerializer, 'created')
+
+
+@query_budget(2)
+@api_view(['GET'])
+def friend_suggestions(request):
+    suggestions = FriendSuggestion.objects.suggestions(request.user)
+    serializer = FriendSuggestionSerializer(suggestions, many=True)
+    return Response(serializer.data)
+
+
+@query_budget(5)
+@api_view(['POST'])
+def relationships(request):
+    serializer = RelationshipLookupSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    lookup = Friend.objects.relationships(request.user, serializer.validated_data['ids'])
+    results = []
+    for user_id in sorted(lookup):
+        row = {'id': user_id}
+        row.update(lookup[user_id])
+        results.append(row)
+    return Response({'results': results})
+
+
+@query_budget(2)
+@api_view(['GET'])
+def posts_near(request):
+    query = NearbyQuerySerializer(data=request.query_params)
+    if not query.is_valid():
+        return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+    params = query.validated_data
+    if 'bbox' in params:
+        posts = FacebookPost.objects.in_bounding_box(request.user, *params['bbox'])
+        serializer = FacebookPostSerializer(posts, many=True)
+    else:
+        posts = FacebookPost.objects.nearby(request.user, params['lat'], params['long'], params['radius'],
+                                            fields=FacebookPostSerializer.Meta.fields)
+        serializer = NearbyPostSerializer(posts, many=True)
     return Response(serializer.data)
+
+
+@query_budget(4)
+@api_view(['GET'])
+def post_search(request):
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({'q': ['This parameter is required.']}, status=status.HTTP_400_BAD_REQUEST)
+    posts = search_posts(request.user, query)
+    serializer = SearchPostSerializer(posts, many=True)
+    return Response(serializer.data)
+
+
+@query_budget(4)
+@api_view(['GET'])
+def feed(request):
+    """ The wall of the user, ranked, paged with a cursor when the client asks for it """
+    query = FeedQuerySerializer(data=request.query_params)
+    if not query.is_valid():
+        return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+    limit = query.validated_data.get('limit')
+    if not KeysetPagination.requested(request):
+        posts = FacebookPost.objects.ranked_wall_post(request.user, limit)
+        return Response(RankedPostSerializer(posts, many=True).data)
+
+    paginator = KeysetPagination('created_time')
+    posts = paginator.paginate_ranked(
+        lambda position, page_size: FacebookPost.objects.ranked_wall_post(request.user, page_size, before=position),
+        request, limit)
+    return paginator.get_paginated_response(RankedPostSerializer(posts, many=True).data)
+
+
+@query_budget(2)
+@api_view(['GET'])
+def trending(request):
+    """ Most active public posts of the trending window, from the snapshots only """
+    query = TrendingQuerySerializer(data=request.query_params)
+    if not query.is_valid():
+        return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+    serializer = TrendingPostSerializer(TrendingPost.objects.trending(query.validated_data.get('limit')),
+                                        many=True)
+    return Response(serializer.data)
+
+
+@api_view(['POST'])
+def batch(request):
+    """ Run several sub-requests in process and return their responses together """
+    serializer = BatchRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    results = batch_requests.run(request, serializer.validated_data['requests'],
+                                 serializer.validated_data['parallel'])
+    return Response({'responses': results})
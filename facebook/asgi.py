@@ -0,0 +1,22 @@
+"""
+ASGI config for facebook project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+serve it with any ASGI 3 server, e.g. ``uvicorn facebook.asgi:application``.
+Read-heavy GET views run as coroutines, see UserDetail.async_views.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "facebook.settings")
+
+django.setup(set_prefix=False)
+
+from UserDetail import relation_filter  # noqa: E402
+from UserDetail.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
+
+relation_filter.build_in_thread()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -42,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'UserDetail.instrumentation.InstrumentationMiddleware',
+    'UserDetail.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +85,33 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['UserDetail.routers.ShardRouter', 'UserDetail.routers.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# The profile cache, the feed affinities and the relation filter generations
+# must be shared by all workers. FACEBOOK_MEMCACHED_LOCATION (host:port,
+# comma separated for several servers) points them at memcached; without it
+# each process keeps a local memory cache, which only suits a single worker.
+# The test suite always runs on its own local memory cache.
+
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
+if os.environ.get('FACEBOOK_MEMCACHED_LOCATION') and not TESTING:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['FACEBOOK_MEMCACHED_LOCATION'].split(','),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'facebook-tests' if TESTING else 'facebook',
+        }
+    }
 
 
 # Password validation
@@ -121,3 +151,277 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Timeline
+# Authors with more friends than this are not fanned out on write, their
+# posts are pulled into the friends feeds on read instead. A new friend's
+# most recent FACEBOOK_FAN_IN_LIMIT posts are pushed to the user's timeline.
+
+FACEBOOK_FAN_OUT_THRESHOLD = 5000
+
+FACEBOOK_FAN_IN_LIMIT = 200
+
+
+# Pagination
+# List endpoints paginate with an opaque keyset cursor when the client sends
+# ?cursor= or ?page_size=.
+
+FACEBOOK_PAGE_SIZE = 50
+
+FACEBOOK_MAX_PAGE_SIZE = 500
+
+
+# Friend graph cache
+# Memory cap (bytes) of the per-worker adjacency cache, and the age (seconds)
+# after which an entry is reloaded to pick up changes made by other workers.
+
+FACEBOOK_FRIEND_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+FACEBOOK_FRIEND_CACHE_TTL = 300
+
+
+# Friend suggestions
+# Number of suggestions stored per user, and whether they are recomputed
+# when the friend list of a user changes. Changed users and their friends
+# are refreshed in the background FACEBOOK_SUGGESTION_REFRESH_DELAY seconds
+# after the commit (0 refreshes on the committing request), suggestions are
+# stale until then.
+
+FACEBOOK_SUGGESTION_LIMIT = 50
+
+FACEBOOK_SUGGESTION_REFRESH = True
+
+FACEBOOK_SUGGESTION_REFRESH_DELAY = 5.0
+
+FACEBOOK_SUGGESTION_REFRESH_BATCH = 500
+
+
+# Bulk friendship requests
+# Maximum number of request ids accepted by the bulk endpoint.
+
+FACEBOOK_BULK_REQUEST_LIMIT = 500
+
+
+# Relationship lookup
+# Maximum number of user ids resolved by one relationships request.
+
+FACEBOOK_RELATIONSHIP_LOOKUP_LIMIT = 5000
+
+
+# Streaming exports
+# Number of rows encoded per chunk by the ?stream=1 list exports.
+
+FACEBOOK_STREAM_ROWS_PER_CHUNK = 1000
+
+
+# Posts near me
+# Largest radius (km) a client may search and number of posts returned.
+# At most FACEBOOK_NEARBY_CANDIDATES of the newest posts in the covering
+# cells are ranked by distance, older ones in denser areas are not found.
+
+FACEBOOK_NEARBY_MAX_RADIUS = 50.0
+
+FACEBOOK_NEARBY_LIMIT = 100
+
+FACEBOOK_NEARBY_CANDIDATES = 5000
+
+
+# Post search
+# Number of results and snippet length (tokens) of the full-text search, and
+# the number of ranked matches checked against privacy before a search
+# returns the results found so far.
+
+FACEBOOK_SEARCH_LIMIT = 50
+
+FACEBOOK_SEARCH_MAX_CANDIDATES = 1000
+
+FACEBOOK_SEARCH_SNIPPET_TOKENS = 12
+
+
+# Profile cache
+# Lifetime (seconds) of the cached profile payloads and their versions.
+# Versions and payloads live in the default cache, which every worker must
+# share or a worker keeps serving a profile another one changed.
+
+FACEBOOK_PROFILE_CACHE_TIMEOUT = 3600
+
+
+# Fast serialization
+# Render the read-only list endpoints from values() rows with precompiled
+# field extractors instead of DRF serializer instances.
+
+FACEBOOK_FAST_SERIALIZATION = False
+
+
+# Media uploads
+# Chunked uploads are assembled in FACEBOOK_UPLOAD_TEMP_DIR, then a pool of
+# FACEBOOK_MEDIA_WORKERS processes builds the FACEBOOK_MEDIA_VARIANTS
+# (name: largest side in pixels). 0 workers processes uploads inline.
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+MEDIA_URL = '/media/'
+
+FACEBOOK_UPLOAD_TEMP_DIR = os.path.join(BASE_DIR, 'media', 'tmp')
+
+FACEBOOK_UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+
+FACEBOOK_MEDIA_WORKERS = 2
+
+FACEBOOK_MEDIA_VARIANTS = {
+    'thumbnail': 150,
+    'small': 320,
+    'medium': 720,
+}
+
+
+# Instrumentation
+# Per-request query, database time, serialization time and size metrics.
+# Queries are timed by a cursor wrapper, the DEBUG query log stays off.
+# With FACEBOOK_ENFORCE_QUERY_BUDGETS a view running more queries than its
+# @query_budget raises, it is on for the test suite.
+
+FACEBOOK_INSTRUMENTATION = True
+
+FACEBOOK_ENFORCE_QUERY_BUDGETS = TESTING
+
+
+# Batch endpoint
+# Most sub-requests per /facebook/batch/ call, and threads running the
+# read-only ones of a batch sent with "parallel": true.
+
+FACEBOOK_BATCH_LIMIT = 20
+
+FACEBOOK_BATCH_WORKERS = 4
+
+
+# ASGI
+# facebook/asgi.py serves the GET requests of the views in
+# UserDetail.async_views on the event loop: the MIDDLEWARE hooks, the
+# request signals and the queries run on FACEBOOK_ASYNC_DB_THREADS threads,
+# at most FACEBOOK_ASYNC_QUERY_CONCURRENCY at once for a single request, and
+# no thread waits while the view awaits. Other requests run the regular
+# handler on one of FACEBOOK_ASYNC_REQUEST_THREADS threads. Set CONN_MAX_AGE
+# so the threads keep their connections between requests.
+
+FACEBOOK_ASYNC_REQUEST_THREADS = 20
+
+FACEBOOK_ASYNC_DB_THREADS = 10
+
+FACEBOOK_ASYNC_QUERY_CONCURRENCY = 4
+
+
+# Read replicas
+# DATABASES aliases serving the reads of safe requests and of the read-only
+# manager methods. A client that wrote reads from the primary for
+# FACEBOOK_REPLICA_STICKY_SECONDS. Locally, SQLite copies of the primary made
+# by `manage.py sync_replicas` stand in for replicas, e.g.
+#
+# DATABASES['replica1'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'db.replica1.sqlite3'),
+#     'TEST': {'MIRROR': 'default'},
+# }
+# FACEBOOK_REPLICAS = ['replica1']
+
+FACEBOOK_REPLICAS = []
+
+FACEBOOK_REPLICA_STICKY_SECONDS = 5
+
+
+# Post action buffer
+# Queue likes, shares and comments in a per-process buffer written with one
+# bulk insert per flush. A flush happens at FACEBOOK_POST_ACTION_BUFFER_SIZE
+# operations, FACEBOOK_POST_ACTION_BUFFER_DELAY seconds after the first one
+# and at exit. FACEBOOK_POST_ACTION_BUFFER_SYNC drops the timer, for tests.
+
+FACEBOOK_POST_ACTION_BUFFER = False
+
+FACEBOOK_POST_ACTION_BUFFER_SIZE = 500
+
+FACEBOOK_POST_ACTION_BUFFER_DELAY = 1.0
+
+FACEBOOK_POST_ACTION_BUFFER_SYNC = False
+
+
+# Post sharding
+# Posts and their actions live on the shard of the post owner, bucket =
+# owner_id % len(FACEBOOK_SHARD_MAP). Each entry is a database alias, an
+# alias may be listed several times so buckets can later move to new shards.
+# Post ids are allocated per bucket, a post id names its shard as well.
+# Users, friends and follows stay on 'default'. Switching an existing
+# database to several shards needs its posts copied to their new buckets.
+# Example with a second SQLite file:
+# DATABASES['shard1'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, 'db.shard1.sqlite3'),
+# }
+# FACEBOOK_SHARD_MAP = ['default', 'shard1']
+
+FACEBOOK_SHARD_MAP = ['default']
+
+
+# Trending posts
+# Each process counts post actions, weighted by FACEBOOK_TRENDING_WEIGHTS,
+# over the last FACEBOOK_TRENDING_WINDOW_SECONDS in count-min sketches of
+# FACEBOOK_TRENDING_BUCKET_SECONDS buckets. Every
+# FACEBOOK_TRENDING_SNAPSHOT_SECONDS its top FACEBOOK_TRENDING_SIZE posts
+# are written to the TrendingPost table, which /facebook/trending/ reads.
+# A snapshot interval of 0 disables the timer.
+
+FACEBOOK_TRENDING_WEIGHTS = {'L': 1, 'C': 2, 'S': 3}
+
+FACEBOOK_TRENDING_WINDOW_SECONDS = 3600
+
+FACEBOOK_TRENDING_BUCKET_SECONDS = 60
+
+FACEBOOK_TRENDING_SKETCH_WIDTH = 2048
+
+FACEBOOK_TRENDING_SKETCH_DEPTH = 4
+
+FACEBOOK_TRENDING_SIZE = 50
+
+FACEBOOK_TRENDING_SNAPSHOT_SECONDS = 60
+
+
+# Relation filters
+# Per-user bloom filters over the Follow and Friend edges answer most
+# follows() and are_friends() misses without a query. Filters are sized for
+# FACEBOOK_RELATION_FILTER_ERROR_RATE false positives and rebuilt from the
+# tables every FACEBOOK_RELATION_FILTER_REBUILD_SECONDS: each worker process
+# then reloads every Follow and Friend edge, on a thread. The first build
+# starts when facebook/wsgi.py or asgi.py loads, every check goes to the
+# tables until it is done. Saved edges bump a generation in the default
+# cache, a user whose edges changed in another worker since the last build
+# goes to the tables too. The cache has to be shared by the workers.
+
+FACEBOOK_RELATION_FILTER = True
+
+FACEBOOK_RELATION_FILTER_ERROR_RATE = 0.01
+
+FACEBOOK_RELATION_FILTER_REBUILD_SECONDS = 300
+
+
+# Feed ranking
+# /facebook/feed/ ranks the FACEBOOK_FEED_CANDIDATES newest wall posts by
+# the weighted sum of their features: recency (halving every
+# FACEBOOK_FEED_HALF_LIFE_HOURS), the viewer's affinity to the author from
+# their past post actions, engagement and post type. Affinity vectors are
+# cached for FACEBOOK_FEED_AFFINITY_TIMEOUT seconds, and dropped when the
+# viewer's post actions change.
+
+FACEBOOK_FEED_CANDIDATES = 500
+
+FACEBOOK_FEED_HALF_LIFE_HOURS = 24
+
+FACEBOOK_FEED_AFFINITY_TIMEOUT = 600
+
+FACEBOOK_FEED_WEIGHTS = {
+    'recency': 1.0,
+    'affinity': 1.0,
+    'engagement': 0.5,
+    'picture': 0.1,
+    'video': 0.1,
+    'link': 0.0,
+}
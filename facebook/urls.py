@@ -19,9 +19,12 @@ from django.contrib import admin
 from django.contrib.auth import views as auth_views
 from UserDetail.views import UserProfileDetail,\
     ManageFriendRequest,\
+    BulkFriendRequest,\
     ManageFriends,\
     ManageFollowRequest,\
     PostList,\
+    MediaUploadList,\
+    MediaUploadDetail,\
     PostAction, \
     friends_list,\
     friendship_request_sent,\
@@ -31,7 +34,14 @@ from UserDetail.views import UserProfileDetail,\
     friendship_request_unrejected,\
     friendship_request_unread,\
     following,\
-    followers
+    followers,\
+    friend_suggestions,\
+    relationships,\
+    posts_near,\
+    post_search,\
+    trending,\
+    feed,\
+    batch
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
@@ -41,6 +51,9 @@ urlpatterns = [
     url(r'^facebook/manage_friend_request/(?P<pk>\d+|None)/$',
         ManageFriendRequest.as_view(),
         name="manage_friend_request"),
+    url(r'^facebook/bulk_friend_request/$',
+        BulkFriendRequest.as_view(),
+        name="bulk_friend_request"),
     url(r'^facebook/manage_friends/(?P<pk>\d+|None)/$',
         ManageFriends.as_view(),
         name="manage_friends"),
@@ -50,6 +63,12 @@ urlpatterns = [
     url(r'^facebook/post_list/(?P<pk>\d+|None)/$',
         PostList.as_view(),
         name="post_list"),
+    url(r'^facebook/uploads/$',
+        MediaUploadList.as_view(),
+        name="media_upload_list"),
+    url(r'^facebook/uploads/(?P<pk>[0-9a-f-]+)/$',
+        MediaUploadDetail.as_view(),
+        name="media_upload_detail"),
     url(r'^facebook/post_action/(?P<pk>\d+|None)/$',
         PostAction.as_view(),
         name="post_action"),
@@ -80,6 +99,27 @@ urlpatterns = [
     url(r'^facebook/followers/$',
         followers,
         name="followers"),
+    url(r'^facebook/friend_suggestions/$',
+        friend_suggestions,
+        name="friend_suggestions"),
+    url(r'^facebook/relationships/$',
+        relationships,
+        name="relationships"),
+    url(r'^facebook/posts_near/$',
+        posts_near,
+        name="posts_near"),
+    url(r'^facebook/search/$',
+        post_search,
+        name="post_search"),
+    url(r'^facebook/trending/$',
+        trending,
+        name="trending"),
+    url(r'^facebook/feed/$',
+        feed,
+        name="feed"),
+    url(r'^facebook/batch/$',
+        batch,
+        name="batch"),
     url(r'^login/$', auth_views.login, name='login'),
     url(r'^logout/$', auth_views.logout, name='logout'),
 ]
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "facebook.settings")
 
 application = get_wsgi_application()
+
+from UserDetail import relation_filter  # noqa: E402
+
+relation_filter.build_in_thread()